@@ -0,0 +1,154 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Bridge that archives RabbitMQ traffic to S3 in bulk, so producers can
+" publish to RabbitMQ alone instead of teeing every message to S3.  Messages
+" are collected with ConsumerPool batch consumers and written as a segment
+" object per batch (or as individual objects uploaded concurrently) under the
+" key layout S3Consumer reads.  A batch is only acked once its S3 writes have
+" succeeded; a failed batch is nacked and requeued.
+"
+" Messages keep the key name a teeing producer sent in the muskrat-key
+" header.  Others are named when they are archived, so a routing key should
+" be archived by a single Archiver for its keys to stay in order.
+"
+" A batch that fails to write is logged and the bridge keeps consuming; the
+" batch is redelivered by RabbitMQ.
+"
+"""
+from __future__ import absolute_import
+import argparse
+import logging
+from   itertools import groupby
+
+from   muskrat.util import config_loader, s3_resource, key_prefix
+from   muskrat.producer import S3Producer, KEY_HEADER
+from   muskrat.segments import segment_key_name, encode_segment
+
+logger = logging.getLogger( __name__ )
+
+
+class Archiver(object):
+
+    def __init__(self, routing_keys, config='config.py', batch_size=1000, timeout=5000, segments=True,
+                 pool=None):
+        """
+        routing_keys
+            Routing keys to archive.
+        batch_size
+            Maximum number of messages per batch (and segment).
+        timeout
+            Milliseconds a partial batch waits for more messages before it is written.
+        segments
+            Write each batch as one segment object (see muskrat.segments).  Consumers need
+            segments='archived', since archived segments hold new messages and would be
+            skipped past compaction's max_age cutoff.  With False every message is uploaded
+            as its own object.
+        pool
+            muskrat.rmqconsumer.ConsumerPool to register the batch consumers with.  Defaults
+            to a new, connected pool.
+        """
+        self.config = config_loader( config )
+        self.routing_keys = [routing_key.upper() for routing_key in routing_keys]
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.segments = segments
+        self.pool = pool
+
+        self.producers = dict( (routing_key, S3Producer( routing_key=routing_key, config=self.config ))
+                               for routing_key in self.routing_keys )
+        self.archived = 0
+        self.failed = 0
+
+    @property
+    def bucket(self):
+        return s3_resource( self.config ).Bucket( self.config.s3_bucket )
+
+    def key_names(self, routing_key, messages):
+        """ Key names for a batch of (method, header, body) deliveries. """
+        generated = iter( self.producers[ routing_key ]._create_key_names( routing_key, len( messages ) ) )
+        names = []
+        for method, header, body in messages:
+            name = ( getattr( header, 'headers', None ) or {} ).get( KEY_HEADER )
+            if isinstance( name, bytes ):
+                name = name.decode( 'utf-8' )
+            names.append( name or next( generated ) )
+        return names
+
+    def archive(self, routing_key, messages):
+        """
+        Writes a batch of deliveries to S3.  Returns the keys written.  Raises if any write
+        failed.
+        """
+        entries = sorted( zip( self.key_names( routing_key, messages ), [body for method, header, body in messages] ) )
+
+        if self.segments:
+            bucket = self.bucket
+            #One segment per (shard) prefix
+            for prefix, group in groupby( entries, key=lambda entry: key_prefix( entry[0] ) ):
+                group = list( group )
+                bucket.put_object( Key=segment_key_name( prefix, group[-1][0] ), Body=encode_segment( group ) )
+        else:
+            results = self.producers[ routing_key ].send_many( [body for key, body in entries],
+                                                               key_names=[key for key, body in entries] )
+            for result in results:
+                if not result.ok:
+                    raise result.error
+
+        self.archived += len( entries )
+        return [key for key, body in entries]
+
+    def _archiver(self, routing_key):
+        def archive(channel, messages):
+            self.archive( routing_key, messages )
+        #ConsumerPool names the queue after the function
+        archive.__module__ = __name__
+        archive.__name__ = 'archive_' + routing_key
+        return archive
+
+    def _failed(self, error, messages):
+        """
+        Called once a batch that failed to write has been nacked and requeued.  Raising
+        would stop start_consumers() and with it the bridge.
+        """
+        self.failed += 1
+        logger.error( 'Failed to archive a batch of %d messages: %r', len( messages ), error )
+
+    def register(self):
+        """ Registers a batch consumer for every routing key with the pool. """
+        if self.pool is None:
+            from muskrat.rmqconsumer import ConsumerPool
+            self.pool = ConsumerPool( config=self.config )
+            self.pool.connect()
+
+        for routing_key in self.routing_keys:
+            self.pool.batch_consumer( routing_key, size=self.batch_size, timeout=self.timeout,
+                                      requeue=True, on_error=self._failed )( self._archiver( routing_key ) )
+
+    def run(self):
+        """ Archives until interrupted. """
+        self.register()
+        try:
+            self.pool.start_consumers()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.pool.close_connection()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser( description='Archive RabbitMQ routing keys to S3 in bulk.' )
+    parser.add_argument( 'routing_keys', nargs='+', help='Routing keys to archive' )
+    parser.add_argument( '--config', default='config.py', help='Path to the muskrat config file' )
+    parser.add_argument( '--batch-size', type=int, default=1000, help='Maximum messages per batch' )
+    parser.add_argument( '--timeout', type=int, default=5000, help='Milliseconds before a partial batch is written' )
+    parser.add_argument( '--objects', action='store_true', help='Write one object per message instead of segments' )
+    args = parser.parse_args( argv )
+
+    Archiver( args.routing_keys, config=args.config, batch_size=args.batch_size, timeout=args.timeout,
+              segments=not args.objects ).run()
+
+
+if '__main__' == __name__:
+    main()
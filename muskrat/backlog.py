@@ -0,0 +1,139 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Backlog inspection for S3 consumers.  Loads every cursor in the s3_cursor
+" location, groups them by routing key (and shard) prefix and lists each
+" prefix once, starting at its oldest cursor, to report how far behind every
+" consumer is.
+"
+"""
+from __future__ import absolute_import
+import argparse
+from   bisect import bisect_right
+from   datetime import datetime
+from   concurrent.futures import ThreadPoolExecutor
+
+try: import simplejson as json
+except ImportError: import json
+
+from   muskrat.util import config_loader, s3_resource, key_prefix, key_timestamp
+from   muskrat.s3consumer import load_cursors
+
+
+class Backlog(object):
+
+    def __init__(self, config='config.py', cursors=None, workers=8):
+        """
+        cursors
+            Names of the cursors to inspect.  Defaults to every cursor in the config's
+            s3_cursor location.
+        workers
+            Number of prefixes listed concurrently.
+        """
+        self.config = config_loader( config )
+        self.cursors = cursors
+        self.workers = workers
+
+    @property
+    def bucket(self):
+        return s3_resource( self.config ).Bucket( self.config.s3_bucket )
+
+    def cursors_by_prefix(self):
+        """ Returns a dict of prefix -> {cursor name -> position} """
+        prefixes = {}
+        for name, keys in load_cursors( self.config.s3_cursor['location'] ).items():
+            if self.cursors is not None and name not in self.cursors:
+                continue
+            for key in keys:
+                prefixes.setdefault( key_prefix( key ), {} )[ name ] = key
+        return prefixes
+
+    def list_prefix(self, prefix, marker):
+        """ Returns the (key, size) of every message under prefix after marker, in order. """
+        collection = self.bucket.objects.filter( Prefix=prefix + '/' ).filter( Marker=marker )
+        return [(obj.key, obj.size) for obj in collection.filter( Delimiter='/' )]
+
+    def _lag(self, position, newest):
+        #Seconds between the consumed message and the newest message
+        timestamp_format = self.config.s3_timestamp_format
+        try:
+            delta = datetime.strptime( key_timestamp( newest ), timestamp_format ) - \
+                    datetime.strptime( key_timestamp( position ), timestamp_format )
+        except ValueError:
+            return None
+        return max( 0.0, delta.total_seconds() )
+
+    def inspect_prefix(self, prefix, positions):
+        """
+        Lists a prefix once from its oldest cursor and returns a dict of cursor name ->
+        {'position', 'count', 'bytes', 'lag'} for the cursors positioned in it.
+        """
+        listing = self.list_prefix( prefix, min( positions.values() ) )
+        keys = [key for key, size in listing]
+
+        #Running byte totals from the end so each cursor's backlog is a single lookup
+        remaining = [0] * ( len( listing ) + 1 )
+        for i in range( len( listing ) - 1, -1, -1 ):
+            remaining[ i ] = remaining[ i + 1 ] + listing[ i ][1]
+
+        report = {}
+        for name, position in positions.items():
+            start = bisect_right( keys, position )
+            count = len( keys ) - start
+            report[ name ] = {
+                'position':position,
+                'count':count,
+                'bytes':remaining[ start ],
+                'lag':self._lag( position, keys[-1] ) if count else 0.0,
+            }
+        return report
+
+    def inspect(self):
+        """
+        Returns a dict of cursor name -> {'count', 'bytes', 'lag', 'prefixes'}.  Sharded
+        cursors are summed over their shards and report the largest lag; per prefix figures
+        are under 'prefixes'.  Lag is in seconds between the cursor position and the newest
+        message, from the key timestamps.
+        """
+        prefixes = self.cursors_by_prefix()
+
+        def inspect_item(item):
+            return item[0], self.inspect_prefix( *item )
+
+        with ThreadPoolExecutor( max_workers=max( 1, min( self.workers, len( prefixes ) ) ) ) as pool:
+            results = list( pool.map( inspect_item, prefixes.items() ) )
+
+        report = {}
+        for prefix, by_cursor in results:
+            for name, stats in by_cursor.items():
+                consumer = report.setdefault( name, {'count':0, 'bytes':0, 'lag':0.0, 'prefixes':{}} )
+                consumer['count'] += stats['count']
+                consumer['bytes'] += stats['bytes']
+                if stats['lag'] is None or consumer['lag'] is None:
+                    consumer['lag'] = None
+                else:
+                    consumer['lag'] = max( consumer['lag'], stats['lag'] )
+                consumer['prefixes'][ prefix ] = stats
+        return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser( description='Report the backlog of every S3 consumer cursor.' )
+    parser.add_argument( '--config', default='config.py', help='Path to the muskrat config file' )
+    parser.add_argument( '--cursor', action='append', dest='cursors', help='Cursor to inspect (repeatable)' )
+    parser.add_argument( '--json', action='store_true', help='Print the report as JSON' )
+    args = parser.parse_args( argv )
+
+    report = Backlog( config=args.config, cursors=args.cursors ).inspect()
+    if args.json:
+        print( json.dumps( report, indent=2, sort_keys=True ) )
+        return
+
+    for name, stats in sorted( report.items() ):
+        lag = '%.1fs' % stats['lag'] if stats['lag'] is not None else 'unknown'
+        print( '%s: %d messages, %d bytes, %s behind' % (name, stats['count'], stats['bytes'], lag) )
+
+
+if '__main__' == __name__:
+    main()
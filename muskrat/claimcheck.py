@@ -0,0 +1,188 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Claim checks for large RabbitMQ messages.  RabbitMQProducer writes payloads
+" over a size threshold to S3 under the CLAIMCHECK.<routing key> routing key
+" (the regular S3Producer key layout) and publishes a small JSON envelope
+" instead, naming the S3 key in the muskrat-claim header.  ConsumerPool
+" consumers resolve the envelope back into the payload before their callback
+" runs, through a byte bounded LRU cache; batch consumers fetch the payloads
+" of a batch concurrently.
+"
+" Claim check keys are ordinary messages, so muskrat-retention --max-age
+" cleans them up.
+"
+"""
+from __future__ import absolute_import
+import threading
+from   collections import OrderedDict
+from   concurrent.futures import ThreadPoolExecutor
+
+try: import simplejson as json
+except ImportError: import json
+
+from   muskrat.util import config_loader, s3_resource
+
+CLAIMCHECK_PREFIX = 'CLAIMCHECK'
+
+#RabbitMQ header carrying the S3 key name of a claim checked payload
+CLAIM_HEADER = 'muskrat-claim'
+
+#Payloads larger than this many bytes are claim checked when claim_check=True
+DEFAULT_THRESHOLD = 128 * 1024
+
+
+def claim_routing_key( routing_key ):
+    """ Returns the routing key the payloads of routing_key are claim checked under. """
+    return '.'.join( [CLAIMCHECK_PREFIX, routing_key.upper()] )
+
+
+def payload_size( msg ):
+    return len( msg if isinstance( msg, bytes ) else msg.encode( 'utf-8' ) )
+
+
+def encode_envelope( key, size ):
+    """ Body published in place of a claim checked payload. """
+    return json.dumps( {'claim_check':key, 'size':size} )
+
+
+def claim_key( header ):
+    """ S3 key name of a claim checked delivery, or None for a regular one. """
+    key = ( getattr( header, 'headers', None ) or {} ).get( CLAIM_HEADER )
+    if isinstance( key, bytes ):
+        key = key.decode( 'utf-8' )
+    return key
+
+
+class ClaimStore(object):
+    """ Writes payloads to S3 for RabbitMQProducer. """
+    def __init__( self, config='config.py' ):
+        self.config = config_loader( config )
+        self._producers = {}
+
+    def _producer( self, routing_key ):
+        #Imported here since RabbitMQProducer imports this module
+        from muskrat.producer import S3Producer
+        routing_key = claim_routing_key( routing_key )
+        if routing_key not in self._producers:
+            self._producers[ routing_key ] = S3Producer( routing_key=routing_key, config=self.config )
+        return self._producers[ routing_key ]
+
+    def put( self, routing_key, msg ):
+        """ Writes a payload and returns its key name. """
+        producer = self._producer( routing_key )
+        key_name = producer._create_key_name( producer.routing_key )
+        producer.send( msg, key_name=key_name )
+        return key_name
+
+    def put_many( self, routing_key, msgs ):
+        """ Writes payloads concurrently.  Returns a SendResult per payload. """
+        return self._producer( routing_key ).send_many( msgs )
+
+
+class LRUCache(object):
+    """ Least recently used cache bounded by the total size of its values.  Thread safe. """
+    def __init__( self, max_bytes ):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get( self, key ):
+        with self._lock:
+            value = self._entries.pop( key, None )
+            if value is not None:
+                self._entries[ key ] = value
+            return value
+
+    def put( self, key, value ):
+        if len( value ) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop( key, None )
+            if previous is not None:
+                self.size -= len( previous )
+            self._entries[ key ] = value
+            self.size += len( value )
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem( last=False )
+                self.size -= len( evicted )
+
+    def __len__( self ):
+        return len( self._entries )
+
+
+class ClaimResolver(object):
+
+    def __init__( self, config='config.py', cache_bytes=64 * 1024 * 1024, prefetch=8 ):
+        """
+        config
+            Config with the S3 credentials and bucket the payloads were written to.
+        cache_bytes
+            Size of the LRU cache of resolved payloads, so redeliveries and consumers sharing
+            a resolver do not fetch a payload twice.  0 disables it.
+        prefetch
+            Number of payloads of a batch fetched concurrently by resolve_many.
+        """
+        self.config = config_loader( config )
+        self.cache = LRUCache( cache_bytes )
+        self.prefetch = prefetch
+
+        self._bucket = None
+        self._pool = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def bucket( self ):
+        if self._bucket is None:
+            self._bucket = s3_resource( self.config ).Bucket( self.config.s3_bucket )
+        return self._bucket
+
+    def fetch( self, key ):
+        """ Returns the payload stored under key. """
+        body = self.cache.get( key )
+        if body is not None:
+            self.hits += 1
+            return body
+        self.misses += 1
+        body = self.bucket.Object( key ).get()['Body'].read()
+        self.cache.put( key, body )
+        return body
+
+    def resolve( self, header, body ):
+        """ Returns the payload of a delivery: its body, or the claim checked payload. """
+        key = claim_key( header )
+        if key is None:
+            return body
+        return self.fetch( key )
+
+    def resolve_many( self, messages ):
+        """
+        Resolves a batch of (method, header, body) deliveries, fetching claim checked
+        payloads concurrently.  Returns the deliveries with their payloads.
+        """
+        keys = [claim_key( header ) for method, header, body in messages]
+        pending = [key for key in keys if key is not None]
+        if not pending:
+            return messages
+
+        if len( pending ) == 1 or self.prefetch <= 1:
+            bodies = dict( (key, self.fetch( key )) for key in pending )
+        else:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor( max_workers=self.prefetch )
+            unique = list( OrderedDict.fromkeys( pending ) )
+            bodies = dict( zip( unique, self._pool.map( self.fetch, unique ) ) )
+
+        return [(method, header, body if key is None else bodies[ key ])
+                for (method, header, body), key in zip( messages, keys )]
+
+    def stats( self ):
+        return {'hits':self.hits, 'misses':self.misses, 'cached':len( self.cache ), 'cached_bytes':self.cache.size}
+
+    def close( self ):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
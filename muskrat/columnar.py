@@ -0,0 +1,216 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Columnar decoding of message batches for analytics consumers.  A batch of
+" decoded JSON objects is turned into one typed array per field plus a null
+" mask, so downstream code can work on whole columns instead of looping over
+" dicts.
+"
+" Columns are NumPy arrays when NumPy can be imported and stdlib arrays
+" otherwise.  String and object columns are object arrays under NumPy and
+" lists under the stdlib backend.
+"
+"""
+from __future__ import absolute_import
+from array import array
+from collections import OrderedDict
+
+import six
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INT = 'int'
+FLOAT = 'float'
+BOOL = 'bool'
+STR = 'str'
+OBJECT = 'object'
+
+#Numeric types widen to the later type when a field mixes them
+NUMERIC = [BOOL, INT, FLOAT]
+
+#Value stored in place of nulls
+FILL = {INT:0, FLOAT:float( 'nan' ), BOOL:False, STR:None, OBJECT:None}
+
+NUMPY_DTYPES = {INT:'int64', FLOAT:'float64', BOOL:'bool', STR:'object', OBJECT:'object'}
+ARRAY_TYPECODES = {INT:'q', FLOAT:'d', BOOL:'b'}
+
+PYTHON_TYPES = {int:INT, float:FLOAT, bool:BOOL, str:STR, object:OBJECT}
+CONVERTERS = {INT:int, FLOAT:float, BOOL:bool, STR:str}
+
+
+def _value_type( value ):
+    if isinstance( value, bool ):
+        return BOOL
+    if isinstance( value, six.integer_types ):
+        return INT
+    if isinstance( value, float ):
+        return FLOAT
+    if isinstance( value, six.string_types ):
+        return STR
+    return OBJECT
+
+
+def _widen( current, new ):
+    if current is None or current == new:
+        return new
+    if current in NUMERIC and new in NUMERIC:
+        return max( current, new, key=NUMERIC.index )
+    return OBJECT
+
+
+def infer_schema( records ):
+    """
+    Returns an ordered dict of field -> type for the top level fields of a batch of dicts.
+    Fields mixing numeric types are widened (bool < int < float); fields mixing anything
+    else, or that are always null, are objects.
+    """
+    schema = OrderedDict()
+    for record in records:
+        if not isinstance( record, dict ):
+            continue
+        for name, value in record.items():
+            current = schema.get( name )
+            if value is not None:
+                schema[ name ] = _widen( current, _value_type( value ) )
+            elif name not in schema:
+                schema[ name ] = None
+
+    for name, type in schema.items():
+        if type is None:
+            schema[ name ] = OBJECT
+    return schema
+
+
+def normalize_schema( schema ):
+    """ Accepts type names or the python types int, float, bool, str and object. """
+    normalized = OrderedDict()
+    for name, type in schema.items():
+        type = PYTHON_TYPES.get( type, type )
+        if type not in FILL:
+            raise ValueError( 'Unsupported column type %r for %s' % (type, name) )
+        normalized[ name ] = type
+    return normalized
+
+
+class Columns(object):
+    """
+    A batch of messages as columns.
+
+    columns
+        dict of field -> array of values.  Nulls hold a fill value (0, NaN, False or None).
+    nulls
+        dict of field -> boolean array that is true where the field was null or missing.
+    schema
+        Ordered dict of field -> type name.
+    """
+    def __init__( self, columns, nulls, schema, length ):
+        self.columns = columns
+        self.nulls = nulls
+        self.schema = schema
+        self.length = length
+
+    def __len__( self ):
+        return self.length
+
+    def __getitem__( self, name ):
+        return self.columns[ name ]
+
+    def __contains__( self, name ):
+        return name in self.columns
+
+    def keys( self ):
+        return list( self.schema )
+
+    def null_count( self, name ):
+        return sum( 1 for null in self.nulls[ name ] if null )
+
+
+def _build_column( type, values, backend ):
+    fill = FILL[ type ]
+    convert = CONVERTERS.get( type )
+    nulls = [value is None for value in values]
+    try:
+        if convert is None:
+            data = values
+        else:
+            data = [fill if value is None else convert( value ) for value in values]
+    except (TypeError, ValueError) as e:
+        raise ValueError( 'Value does not fit a %s column: %s' % (type, e) )
+
+    if backend == 'numpy':
+        if NUMPY_DTYPES[ type ] == 'object':
+            column = numpy.empty( len( data ), dtype=object )
+            column[:] = data
+        else:
+            column = numpy.array( data, dtype=NUMPY_DTYPES[ type ] )
+        return column, numpy.array( nulls, dtype=bool )
+
+    if type in ARRAY_TYPECODES:
+        return array( ARRAY_TYPECODES[ type ], data ), array( 'b', nulls )
+    return list( data ), array( 'b', nulls )
+
+
+def invalid_rows( records, schema=None ):
+    """
+    Returns (index, ValueError) pairs for the records to_columns rejects: records that are
+    not dicts and, with a declared schema, records holding a value that does not fit the
+    type of its field.
+    """
+    converters = []
+    if schema is not None:
+        converters = [(name, type, CONVERTERS.get( type )) for name, type in normalize_schema( schema ).items()]
+
+    invalid = []
+    for index, record in enumerate( records ):
+        if not isinstance( record, dict ):
+            invalid.append( (index, ValueError( 'Record %d is not an object: %r' % (index, record) )) )
+            continue
+        for name, type, convert in converters:
+            value = record.get( name )
+            if convert is None or value is None:
+                continue
+            try:
+                convert( value )
+            except (TypeError, ValueError) as e:
+                invalid.append( (index, ValueError( 'Record %d: %s: Value does not fit a %s column: %s' %
+                                                    (index, name, type, e) )) )
+                break
+    return invalid
+
+
+def to_columns( records, schema=None, backend=None ):
+    """
+    Converts a batch of decoded messages (dicts) into Columns.  Records that are not dicts
+    raise ValueError; see invalid_rows to find the records a batch has to drop.
+
+    schema
+        Optional dict of field -> type ('int', 'float', 'bool', 'str', 'object' or the
+        matching python types).  Only declared fields are kept and values are converted to
+        the declared type; values that cannot be converted raise ValueError.  Inferred from the batch
+        when not given.
+    backend
+        'numpy' or 'array'.  Defaults to numpy when it is installed.
+    """
+    backend = backend or ( 'numpy' if numpy is not None else 'array' )
+    if backend == 'numpy' and numpy is None:
+        raise ValueError( 'NumPy is not installed' )
+
+    records = list( records )
+    for index, record in enumerate( records ):
+        if not isinstance( record, dict ):
+            raise ValueError( 'Record %d is not an object: %r' % (index, record) )
+    schema = normalize_schema( schema ) if schema is not None else infer_schema( records )
+
+    columns = {}
+    nulls = {}
+    for name, type in schema.items():
+        try:
+            columns[ name ], nulls[ name ] = _build_column( type, [record.get( name ) for record in records],
+                                                            backend )
+        except ValueError as e:
+            raise ValueError( '%s: %s' % (name, e) )
+    return Columns( columns, nulls, schema, len( records ) )
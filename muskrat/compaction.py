@@ -0,0 +1,133 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Rolls old one-object-per-message history of a routing key into large
+" indexed segment objects (see muskrat.segments) and deletes the originals.
+" Consumers read compacted and live ranges transparently, so replaying a day
+" of messages takes a few large GETs instead of one GET per message.
+"
+" Consumers only list segments when the config defines s3_compaction (or they
+" are created with segments=True), and max_age must be longer than the
+" furthest any consumer falls behind:
+"
+"     s3_compaction = {'max_age':86400, 'segment_size':10000}
+"
+"""
+from __future__ import absolute_import
+import argparse
+from   concurrent.futures import ThreadPoolExecutor
+from   datetime import datetime, timedelta
+
+from   muskrat.util import config_loader, s3_resource, shard_prefixes, key_timestamp, chunked, delete_keys
+from   muskrat.segments import encode_segment, segment_key_name
+
+
+class Compactor(object):
+
+    def __init__(self, routing_key, config='config.py', max_age=None, segment_size=None, shards=None, workers=16):
+        """
+        routing_key
+            Routing key to compact.
+        max_age
+            Messages older than this many seconds are compacted.  Defaults to the config's
+            s3_compaction['max_age'].  It may not be shorter than the configured max_age, since
+            consumers past that cutoff would never read the segments.
+        segment_size
+            Maximum number of messages per segment.  Defaults to the config's
+            s3_compaction['segment_size'] or 10000.
+        shards
+            Number of shards the routing key is written under.  Defaults to the config's
+            s3_shards setting.
+        workers
+            Number of concurrent GETs/deletes.
+        """
+        self.config = config_loader( config )
+        self.routing_key = routing_key.upper()
+
+        settings = getattr( self.config, 's3_compaction', None ) or {}
+        self.max_age = max_age if max_age is not None else settings.get( 'max_age' )
+        if self.max_age is None:
+            raise ValueError( 'max_age must be supplied or defined in s3_compaction' )
+        if settings.get( 'max_age' ) is not None and self.max_age < settings['max_age']:
+            #Consumers skip segments once their cursor is past the configured max_age
+            raise ValueError( 'max_age %s is shorter than the configured s3_compaction max_age %s' %
+                              (self.max_age, settings['max_age']) )
+        self.segment_size = segment_size or settings.get( 'segment_size', 10000 )
+        self.shards = shards or getattr( self.config, 's3_shards', None )
+        self.workers = workers
+
+    @property
+    def bucket(self):
+        return s3_resource( self.config ).Bucket( self.config.s3_bucket )
+
+    def _prefixes(self):
+        prefix = self.routing_key.replace( '.', '/' )
+        if self.shards:
+            return shard_prefixes( prefix, self.shards )
+        return [prefix]
+
+    def _cutoff(self):
+        return ( datetime.today() - timedelta( seconds=self.max_age ) ).strftime( self.config.s3_timestamp_format )
+
+    def _old_keys(self, bucket, prefix, cutoff):
+        collection = bucket.objects.filter( Prefix=prefix + '/' ).filter( Delimiter='/' )
+        for obj in collection:
+            if key_timestamp( obj.key ) >= cutoff:
+                break
+            yield obj.key
+
+    def compact_prefix(self, prefix, cutoff=None):
+        """
+        Compacts the messages under a single routing key (or shard) prefix.  Returns the
+        number of segments written and messages compacted.
+        """
+        bucket = self.bucket
+        client = bucket.meta.client
+        cutoff = cutoff or self._cutoff()
+        segments = messages = 0
+
+        def fetch( key ):
+            return key, client.get_object( Bucket=bucket.name, Key=key )['Body'].read()
+
+        with ThreadPoolExecutor( max_workers=self.workers ) as pool:
+            for keys in chunked( self._old_keys( bucket, prefix, cutoff ), self.segment_size ):
+                entries = list( pool.map( fetch, keys ) )
+
+                #The segment has to be durable before any original is removed
+                bucket.put_object( Key=segment_key_name( prefix, keys[-1] ), Body=encode_segment( entries ) )
+                delete_keys( bucket, keys, workers=self.workers )
+
+                segments += 1
+                messages += len( keys )
+
+        return segments, messages
+
+    def compact(self):
+        """
+        Compacts every prefix of the routing key.  Returns a dict of prefix ->
+        (segments written, messages compacted).
+        """
+        cutoff = self._cutoff()
+        return dict( (prefix, self.compact_prefix( prefix, cutoff )) for prefix in self._prefixes() )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser( description='Compact old messages of routing keys into segment objects.' )
+    parser.add_argument( 'routing_keys', nargs='+', help='Routing keys to compact' )
+    parser.add_argument( '--config', default='config.py', help='Path to the muskrat config file' )
+    parser.add_argument( '--max-age', type=float,
+                         help='Compact messages older than this many seconds, at least the configured max_age' )
+    parser.add_argument( '--segment-size', type=int, help='Maximum number of messages per segment' )
+    parser.add_argument( '--shards', type=int, help='Number of shards the routing keys are written under' )
+    args = parser.parse_args( argv )
+
+    for routing_key in args.routing_keys:
+        compactor = Compactor( routing_key, config=args.config, max_age=args.max_age,
+                               segment_size=args.segment_size, shards=args.shards )
+        for prefix, (segments, messages) in sorted( compactor.compact().items() ):
+            print( '%s: %d messages compacted into %d segments' % (prefix, messages, segments) )
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,367 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Concurrency primitives shared by producers and consumers.
+"
+"""
+from __future__ import absolute_import
+import threading
+import time
+from   collections import deque
+
+
+def is_throttle( error ):
+    """
+    Returns true if the exception is S3 asking us to slow down (503 SlowDown).  Handles both
+    boto S3ResponseError and boto3/botocore ClientError.
+    """
+    if getattr( error, 'status', None ) == 503 or getattr( error, 'error_code', None ) == 'SlowDown':
+        return True
+
+    response = getattr( error, 'response', None )
+    if isinstance( response, dict ):
+        code = response.get( 'Error', {} ).get( 'Code' )
+        status = response.get( 'ResponseMetadata', {} ).get( 'HTTPStatusCode' )
+        return code in ('SlowDown', '503') or status == 503
+
+    return False
+
+
+class AIMDLimiter(object):
+    """
+    Adaptive limit on the number of in-flight requests.
+
+    The limit grows while requests succeed; by one per success until the first congestion
+    signal (slow start) and by 1/limit per success afterwards (additive increase).  It is
+    multiplied by `backoff` when a request is throttled or its latency exceeds `tolerance`
+    times the observed baseline latency (multiplicative decrease).  At most one decrease
+    is applied per baseline round trip so a burst of throttles only backs off once.
+    """
+    def __init__( self, min_limit=1, max_limit=100, initial=None, backoff=0.5, tolerance=3.0 ):
+        """
+        min_limit
+            Lower bound of the limit.
+        max_limit
+            Upper bound of the limit.
+        initial
+            Starting limit.  Defaults to min_limit.
+        backoff
+            Factor applied to the limit on congestion.
+        tolerance
+            Latency multiple of the baseline that counts as congestion.  None disables latency
+            based decreases so only throttles back off.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+
+        self.limit = float( initial if initial is not None else min_limit )
+        self.in_flight = 0
+        self.baseline = None
+        self.throttled = 0
+        self.congested = 0
+
+        self._slow_start = True
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    @property
+    def concurrency( self ):
+        """ Current number of requests allowed in flight. """
+        return int( self.limit )
+
+    def acquire( self ):
+        """ Blocks until a request slot is available. """
+        with self._cond:
+            while self.in_flight >= int( self.limit ):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release( self, latency=None, throttled=False ):
+        """
+        Returns a request slot and adjusts the limit from the outcome of the request.
+
+        latency
+            Seconds the request took.  None releases the slot without adjusting the limit.
+        throttled
+            True if the request was rejected with a throttle response.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if throttled or latency is not None:
+                self._adjust( latency, throttled )
+            self._cond.notify_all()
+
+    def _adjust( self, latency, throttled ):
+        congested = throttled
+        if latency is not None:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                #Let the baseline drift up slowly so it tracks changing conditions
+                self.baseline += ( latency - self.baseline ) * 0.01
+
+            if self.tolerance and latency > self.baseline * self.tolerance:
+                congested = True
+
+        if throttled:
+            self.throttled += 1
+
+        if congested:
+            now = time.time()
+            if now - self._last_decrease >= ( self.baseline or 0 ):
+                self.congested += 1
+                self._slow_start = False
+                self._last_decrease = now
+                self.limit = max( self.min_limit, self.limit * self.backoff )
+        elif self._slow_start:
+            self.limit = min( self.max_limit, self.limit + 1 )
+        else:
+            self.limit = min( self.max_limit, self.limit + 1.0 / self.limit )
+
+    def stats( self ):
+        """ Snapshot of the limiter state for metrics reporting. """
+        with self._cond:
+            return {
+                'concurrency':self.concurrency,
+                'in_flight':self.in_flight,
+                'baseline_latency':self.baseline,
+                'throttled':self.throttled,
+                'congested':self.congested,
+            }
+
+
+class LowWatermark(object):
+    """
+    Tracks keys handed out for processing in order and completed in any order.  The low
+    watermark is the newest key below which every key has completed, which is how far a
+    cursor can safely be advanced.
+    """
+    def __init__( self ):
+        self._pending = deque()
+        self._done = set()
+        self.watermark = None
+
+    def __len__( self ):
+        return len( self._pending )
+
+    def submit( self, key ):
+        """ Registers the next key in order. """
+        self._pending.append( key )
+
+    def complete( self, key ):
+        """
+        Marks a key completed.  Returns the (ordered) keys the watermark moved past, empty if
+        it did not move.
+        """
+        self._done.add( key )
+        passed = []
+        while self._pending and self._pending[0] in self._done:
+            first = self._pending.popleft()
+            self._done.discard( first )
+            passed.append( first )
+
+        if passed:
+            self.watermark = passed[-1]
+        return passed
+
+
+class RequestTimeout( Exception ):
+    """ Raised when a request (and its hedge) did not finish within its deadline. """
+    pass
+
+
+class LatencyTracker(object):
+    """
+    Sliding window of recent request latencies for percentile lookups.
+    """
+    def __init__( self, window=1000, min_samples=20 ):
+        """
+        window
+            Number of most recent latencies kept.
+        min_samples
+            Latencies required before percentiles are reported.
+        """
+        self.samples = deque( maxlen=window )
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record( self, latency ):
+        with self._lock:
+            self.samples.append( latency )
+
+    def percentile( self, percentile ):
+        """ Returns the latency below which percentile % of requests finished, or None. """
+        with self._lock:
+            if len( self.samples ) < self.min_samples:
+                return None
+            ordered = sorted( self.samples )
+        index = min( len( ordered ) - 1, int( len( ordered ) * percentile / 100.0 ) )
+        return ordered[ index ]
+
+
+class Hedger(object):
+    """
+    Issues requests with a deadline and hedges stragglers.  A request still running after
+    the observed `percentile` latency gets a duplicate, and whichever finishes first wins.
+    Hedges are limited to `budget` times the number of requests so a slow backend does not
+    get twice the load.  Only use it for idempotent requests; the losing request is left to
+    finish in the background.
+
+    Requests abandoned at their deadline (and losing hedges) keep their pool worker until
+    they finish.  Once `max_abandoned` of them are still running, calls fail right away with
+    RequestTimeout, so an outage cannot fill the pool with stuck requests.
+    """
+    def __init__( self, percentile=95, budget=0.05, timeout=None, workers=16, window=1000, min_samples=20,
+                  max_abandoned=None ):
+        """
+        percentile
+            Latency percentile after which a request is hedged.
+        budget
+            Maximum fraction of requests that are hedged.
+        timeout
+            Seconds after which a request (and its hedge) is abandoned with RequestTimeout.
+            None waits indefinitely.
+        workers
+            Size of the pool requests run on.  Should allow two requests per caller.
+        window, min_samples
+            Latency tracking options (see LatencyTracker).  Nothing is hedged until
+            min_samples latencies have been seen.
+        max_abandoned
+            Abandoned requests allowed to hold pool workers before calls fail fast.  Defaults
+            to half the workers.
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.timeout = timeout
+        self.workers = workers
+        self.max_abandoned = max_abandoned if max_abandoned is not None else max( 1, workers // 2 )
+        self.tracker = LatencyTracker( window=window, min_samples=min_samples )
+        self._pool = None
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.abandoned = 0
+        self.rejected = 0
+
+    @property
+    def pool( self ):
+        with self._lock:
+            if self._pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._pool = ThreadPoolExecutor( max_workers=self.workers )
+            return self._pool
+
+    def _may_hedge( self ):
+        with self._lock:
+            if self.hedged < self.budget * self.requests:
+                self.hedged += 1
+                return True
+            return False
+
+    def _abandon( self, futures ):
+        """ Tracks requests left running until they finish. """
+        with self._lock:
+            self.abandoned += len( futures )
+        for future in futures:
+            future.add_done_callback( self._finished )
+
+    def _finished( self, future ):
+        with self._lock:
+            self.abandoned -= 1
+
+    def call( self, func, *args, **kwargs ):
+        """
+        Runs func( *args, **kwargs ) and returns its result.
+
+        hedge
+            Optional callable (without arguments) issued as the duplicate request instead of
+            func, for clients that are not safe to share between two requests.
+        """
+        from concurrent.futures import wait, FIRST_COMPLETED
+
+        hedge = kwargs.pop( 'hedge', None ) or ( lambda: func( *args, **kwargs ) )
+        with self._lock:
+            if self.abandoned >= self.max_abandoned:
+                self.rejected += 1
+                raise RequestTimeout( '%d abandoned requests are still running' % self.abandoned )
+            self.requests += 1
+
+        start = time.time()
+        deadline = start + self.timeout if self.timeout is not None else None
+        delay = self.tracker.percentile( self.percentile )
+
+        first = self.pool.submit( func, *args, **kwargs )
+        futures = [first]
+        error = None
+        while futures:
+            #Wait for the hedge threshold first, then for the deadline
+            until = deadline
+            if delay is not None and len( futures ) == 1 and futures[0] is first:
+                until = start + delay if deadline is None else min( start + delay, deadline )
+            timeout = max( 0, until - time.time() ) if until is not None else None
+
+            done, _ = wait( futures, timeout=timeout, return_when=FIRST_COMPLETED )
+            for future in done:
+                futures.remove( future )
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                self.tracker.record( time.time() - start )
+                if future is not first:
+                    with self._lock:
+                        self.hedge_wins += 1
+                self._abandon( futures )
+                return future.result()
+            if done:
+                continue
+
+            if deadline is not None and time.time() >= deadline:
+                with self._lock:
+                    self.timeouts += 1
+                self._abandon( futures )
+                raise RequestTimeout( 'Request did not finish within %ss' % self.timeout )
+
+            #Past the hedge threshold; hedge once if the budget allows, else wait it out
+            delay = None
+            if self._may_hedge():
+                futures.append( self.pool.submit( hedge ) )
+
+        raise error
+
+    def stats( self ):
+        """ Counters and the current hedge threshold for metrics reporting. """
+        with self._lock:
+            return {
+                'requests':self.requests,
+                'hedged':self.hedged,
+                'hedge_wins':self.hedge_wins,
+                'timeouts':self.timeouts,
+                'abandoned':self.abandoned,
+                'rejected':self.rejected,
+                'threshold':self.tracker.percentile( self.percentile ),
+            }
+
+    def close( self ):
+        """ Shuts down the request pool.  Requests still running are left to finish. """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown( wait=False )
+
+
+def get_hedger( option ):
+    """
+    Returns the Hedger for a hedge option: None or False for none, True for the defaults, a
+    dict of Hedger options, or a Hedger instance (returned as is).
+    """
+    if not option:
+        return None
+    if isinstance( option, Hedger ):
+        return option
+    return Hedger( **( option if isinstance( option, dict ) else {} ) )
@@ -0,0 +1,121 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Dead letters for messages whose callback kept failing.  Failed messages are
+" written with S3Producer to the DLQ.<routing key> routing key together with
+" the error details, so the consumer can move on.  redrive() (and the
+" muskrat-redrive entry point) sends dead letters back to their routing key.
+"
+"""
+from __future__ import absolute_import
+import argparse
+import base64
+import traceback
+from   datetime import datetime
+
+try: import simplejson as json
+except ImportError: import json
+
+from   muskrat.producer import S3Producer
+from   muskrat.s3consumer import S3Consumer
+from   muskrat.util import key_attributes
+
+DLQ_PREFIX = 'DLQ'
+
+
+def dead_letter_routing_key( routing_key ):
+    """ Returns the routing key dead letters of routing_key are written to. """
+    return '.'.join( [DLQ_PREFIX, routing_key.upper()] )
+
+
+def format_traceback( error ):
+    """ Traceback of an exception, including the remote one of an error from a process pool. """
+    return ''.join( traceback.format_exception( type( error ), error, getattr( error, '__traceback__', None ) ) )
+
+
+def encode_dead_letter( routing_key, key, body, error, attempts, consumer=None, tb=None ):
+    """ Builds the JSON envelope stored for a dead letter.  The body is base64 encoded. """
+    if not isinstance( body, bytes ):
+        body = body.encode( 'utf-8' )
+    return json.dumps( {
+        'routing_key':routing_key,
+        'key':key,
+        'consumer':consumer,
+        'attempts':attempts,
+        'error':repr( error ),
+        'traceback':tb,
+        'failed_at':datetime.today().isoformat(),
+        'body':base64.b64encode( body ).decode( 'ascii' ),
+    } )
+
+
+def decode_dead_letter( data ):
+    """ Returns the envelope dict of a dead letter with the original body decoded. """
+    envelope = json.loads( data )
+    envelope['body'] = base64.b64decode( envelope['body'] )
+    return envelope
+
+
+class DeadLetterQueue(object):
+
+    def __init__( self, routing_key, config='config.py', consumer=None ):
+        """
+        routing_key
+            Routing key of the messages being dead lettered.
+        consumer
+            Name of the consumer the messages failed in, recorded with each dead letter.
+        """
+        self.routing_key = routing_key.upper()
+        self.consumer = consumer
+        self.producer = S3Producer( routing_key=dead_letter_routing_key( routing_key ), config=config )
+
+    def send( self, key, body, error, attempts, tb=None ):
+        """
+        Writes a failed message.  tb defaults to the traceback carried by error.
+        """
+        if tb is None:
+            tb = format_traceback( error )
+        self.producer.send( encode_dead_letter( self.routing_key, key, body, error, attempts,
+                                                consumer=self.consumer, tb=tb ) )
+
+
+def redrive( routing_key, config='config.py', target=None, name=None ):
+    """
+    Sends the dead letters of routing_key back to their original routing key (or target).
+    Progress is tracked with a cursor so every dead letter is redriven once.  Returns the
+    number of messages redriven.
+
+    name
+        Cursor name.  Defaults to one per dead letter routing key.
+    """
+    dlq = dead_letter_routing_key( routing_key )
+    producer = S3Producer( routing_key=target or routing_key, config=config )
+    count = [0]
+
+    def resend( data ):
+        envelope = decode_dead_letter( data )
+        #Attributes encoded in the original key keep the message visible to consumers that match on them
+        producer.send( envelope['body'], routing_key=target or envelope['routing_key'],
+                       attributes=key_attributes( envelope['key'] ) )
+        count[0] += 1
+
+    consumer = S3Consumer( dlq, resend, name=name or 'muskrat.deadletter.redrive.' + dlq, config=config )
+    consumer.consume()
+    return count[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser( description='Send dead letters back to their routing key.' )
+    parser.add_argument( 'routing_keys', nargs='+', help='Routing keys whose dead letters are redriven' )
+    parser.add_argument( '--config', default='config.py', help='Path to the muskrat config file' )
+    parser.add_argument( '--target', help='Routing key to send the dead letters to instead' )
+    args = parser.parse_args( argv )
+
+    for routing_key in args.routing_keys:
+        count = redrive( routing_key, config=args.config, target=args.target )
+        print( '%s: %d messages redriven' % (routing_key.upper(), count) )
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,234 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Size bounded, persisted set of recently processed message keys.  Used by
+" S3Consumer to skip messages that were processed before a crash but after
+" the last cursor write.
+"
+" Recent keys are held exactly in a window, older keys in a rotating pair of
+" Bloom filters.  The set is stored next to the cursor as a snapshot plus an
+" append-only journal of keys added since the snapshot, so every processed
+" key is on disk before the callback for the next message runs.
+"
+"""
+from __future__ import absolute_import
+import hashlib
+import math
+import os
+import struct
+from   collections import deque
+
+try: import simplejson as json
+except ImportError: import json
+
+DEDUPE_SUFFIX = '.dedupe'
+JOURNAL_SUFFIX = '.journal'
+SNAPSHOT_VERSION = 1
+
+
+class BloomFilter(object):
+    """
+    Bloom filter sized for capacity keys at the given false positive rate.
+    """
+    def __init__( self, capacity, error_rate ):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int( math.ceil( -capacity * math.log( error_rate ) / math.log( 2 ) ** 2 ) )
+        self.hashes = max( 1, int( round( self.size / float( capacity ) * math.log( 2 ) ) ) )
+        self.bits = bytearray( ( self.size + 7 ) // 8 )
+        self.count = 0
+
+    def _positions( self, key ):
+        #Double hashing; two 64 bit halves of one digest stand in for k hash functions
+        digest = hashlib.sha1( key.encode( 'utf-8' ) ).digest()
+        h1, h2 = struct.unpack( '<QQ', digest[:16] )
+        return [( h1 + i * h2 ) % self.size for i in range( self.hashes )]
+
+    def add( self, key ):
+        for position in self._positions( key ):
+            self.bits[ position >> 3 ] |= 1 << ( position & 7 )
+        self.count += 1
+
+    def __contains__( self, key ):
+        bits = self.bits
+        return all( bits[ position >> 3 ] & ( 1 << ( position & 7 ) ) for position in self._positions( key ) )
+
+
+class RotatingBloomFilter(object):
+    """
+    Two generations of Bloom filters.  Once the current generation holds capacity keys it
+    becomes the previous one and a fresh filter takes its place, so memory stays bounded
+    and keys are remembered for between one and two generations.
+    """
+    def __init__( self, capacity, error_rate ):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter( capacity, error_rate )
+        self.previous = None
+
+    def add( self, key ):
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter( self.capacity, self.error_rate )
+        self.current.add( key )
+
+    def __contains__( self, key ):
+        return key in self.current or ( self.previous is not None and key in self.previous )
+
+    @property
+    def memory( self ):
+        """ Bytes used by the filter bits. """
+        return 2 * len( self.current.bits )
+
+
+class KeyDeduper(object):
+
+    def __init__( self, path, capacity=1000000, error_rate=0.001, window=10000, max_bytes=None,
+                  snapshot_interval=10000, fsync=False ):
+        """
+        path
+            File the snapshot is written to.  The journal is stored at path + '.journal'.
+        capacity
+            Keys per Bloom filter generation.  Keys are remembered for at least this many
+            later keys.
+        error_rate
+            False positive rate of each generation; the chance a never processed key is
+            reported as seen (and skipped).
+        window
+            Number of most recent keys that are held exactly.
+        max_bytes
+            Memory budget for the Bloom filters.  Overrides capacity.
+        snapshot_interval
+            Keys added between snapshots.  The journal never grows beyond this.
+        fsync
+            fsync the journal after every key.  Without it keys survive a process crash but
+            not a host crash.
+        """
+        if max_bytes:
+            #Two generations share the budget
+            capacity = int( max_bytes * 8 / 2 * math.log( 2 ) ** 2 / -math.log( error_rate ) )
+
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window_size = window
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+
+        self.window = deque()
+        self.recent = set()
+        self.bloom = RotatingBloomFilter( capacity, error_rate )
+        self._journal = None
+        self._pending = 0
+
+        self.load()
+
+    def _make_directory( self ):
+        #The cursor directory does not exist until the first cursor write
+        directory = os.path.dirname( self.path )
+        if directory and not os.path.isdir( directory ):
+            try:
+                os.makedirs( directory )
+            except OSError:
+                #Created by another consumer in the meantime
+                pass
+
+    def seen( self, key ):
+        """ Returns true if the key was (probably) added before. """
+        return key in self.recent or key in self.bloom
+
+    def _remember( self, key ):
+        self.window.append( key )
+        self.recent.add( key )
+        if len( self.window ) > self.window_size:
+            self.recent.discard( self.window.popleft() )
+        self.bloom.add( key )
+
+    def add( self, key ):
+        """ Records a processed key.  The key is journaled before this returns. """
+        self._remember( key )
+
+        if self._journal is None:
+            self._make_directory()
+            self._journal = open( self.journal_path, 'a' )
+        self._journal.write( key + '\n' )
+        self._journal.flush()
+        if self.fsync:
+            os.fsync( self._journal.fileno() )
+
+        self._pending += 1
+        if self._pending >= self.snapshot_interval:
+            self.snapshot()
+
+    def snapshot( self ):
+        """ Writes the full set atomically and truncates the journal. """
+        header = {
+            'version':SNAPSHOT_VERSION,
+            'capacity':self.capacity,
+            'error_rate':self.error_rate,
+            'window':list( self.window ),
+            'counts':[self.bloom.current.count, self.bloom.previous.count if self.bloom.previous else None],
+        }
+        previous = self.bloom.previous.bits if self.bloom.previous else b''
+
+        self._make_directory()
+        tmp = self.path + '.tmp'
+        with open( tmp, 'wb' ) as f:
+            f.write( json.dumps( header ).encode( 'utf-8' ) + b'\n' )
+            f.write( bytes( self.bloom.current.bits ) )
+            f.write( bytes( previous ) )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.rename( tmp, self.path )
+
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open( self.journal_path, 'w' )
+        self._pending = 0
+
+    def load( self ):
+        """ Restores the set from the snapshot and replays the journal. """
+        try:
+            with open( self.path, 'rb' ) as f:
+                header = json.loads( f.readline().decode( 'utf-8' ) )
+                data = f.read()
+        except IOError:
+            header = None
+
+        if header and header.get( 'version' ) == SNAPSHOT_VERSION and \
+                header['capacity'] == self.capacity and header['error_rate'] == self.error_rate:
+            current = self.bloom.current
+            length = len( current.bits )
+            current.bits = bytearray( data[:length] )
+            current.count = header['counts'][0]
+            if header['counts'][1] is not None:
+                self.bloom.previous = BloomFilter( self.capacity, self.error_rate )
+                self.bloom.previous.bits = bytearray( data[length:2 * length] )
+                self.bloom.previous.count = header['counts'][1]
+            for key in header['window'][-self.window_size:]:
+                self.window.append( key )
+                self.recent.add( key )
+        elif header:
+            #Sizing changed; only the exact window can be carried over
+            for key in header['window']:
+                self._remember( key )
+
+        try:
+            with open( self.journal_path, 'r' ) as f:
+                for line in f:
+                    key = line.rstrip( '\n' )
+                    if key:
+                        self._remember( key )
+                        self._pending += 1
+        except IOError:
+            pass
+
+    def close( self ):
+        """ Snapshots outstanding keys and closes the journal. """
+        if self._pending:
+            self.snapshot()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,213 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Fan-out for S3 consumers in one process that subscribe to the same
+" routing key.  A SharedSubscription lists and fetches each message once,
+" starting at the oldest subscriber's cursor, and hands the body to every
+" subscriber through a bounded queue.  Subscribers keep their own cursors
+" and run their callbacks on their own thread, so a slow subscriber only
+" holds the others up once its queue is full.
+"
+"""
+from __future__ import absolute_import
+import io
+import threading
+import time
+from   collections import deque
+from   concurrent.futures import ThreadPoolExecutor
+
+import six.moves.queue
+
+from   muskrat.util import config_loader, key_prefix
+from   muskrat.s3consumer import S3Consumer, merge_shards
+
+#Marks the end of a pass in a subscriber's queue
+_DONE = object()
+
+
+class SharedMessage(object):
+    """ A message fetched once for every subscriber, shaped like an s3 object summary. """
+    def __init__(self, key, body):
+        self.key = key
+        self.body = body
+        self.size = len(body)
+
+    def get(self):
+        return {'Body':io.BytesIO(self.body)}
+
+
+class Subscriber(object):
+    """ A consumer attached to a SharedSubscription and its queue for the current pass. """
+    def __init__(self, consumer, buffer_size):
+        self.consumer = consumer
+        self.queue = six.moves.queue.Queue(maxsize=buffer_size)
+        self.positions = {}
+        self.error = None
+        self.handled = 0
+
+    def load_positions(self, prefixes):
+        """ Reads the cursor as a dict of prefix -> position. """
+        cursor = self.consumer._cursor
+        if hasattr(cursor, 'get_positions'):
+            self.positions = cursor.get_positions()
+        else:
+            position = cursor.get()
+            self.positions = dict((prefix, position) for prefix in prefixes if position)
+
+    def wants(self, key):
+        position = self.positions.get(key_prefix(key))
+        return position is None or key > position
+
+    def run(self):
+        """ Handles queued messages until the end of the pass.  Keeps draining after an error. """
+        while True:
+            obj = self.queue.get()
+            if obj is _DONE:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.consumer._handle(obj)
+                self.consumer._cursor.update(obj.key)
+                self.handled += 1
+            except Exception as e:
+                self.error = e
+
+
+class SharedSubscription(object):
+
+    def __init__(self, routing_key, config='config.py', buffer_size=1000, fetch_workers=8, shards=None,
+                 segments=None):
+        """
+        routing_key
+            Routing key every subscriber consumes.
+        buffer_size
+            Messages queued per subscriber.  Fetching pauses while any subscriber's queue is
+            full.
+        fetch_workers
+            Number of GETs issued ahead of the subscribers.
+        shards, segments
+            As for S3Consumer.  Subscribers created with subscribe() share them.
+        """
+        self.config = config_loader( config )
+        self.routing_key = routing_key.upper()
+        self.buffer_size = buffer_size
+        self.fetch_workers = fetch_workers
+        self.shards = shards
+        self.segments = segments
+        self.subscribers = []
+
+    def subscribe(self, func, name=None, **kwargs):
+        """
+        Creates an S3Consumer for the routing key that is fed by this subscription.  Takes the
+        S3Consumer options (match, dedupe, serializer, retry, ...) except workers.
+        """
+        consumer = S3Consumer( self.routing_key, func, name=name, config=self.config, shards=self.shards,
+                               segments=self.segments, **kwargs )
+        return self.add( consumer )
+
+    def add(self, consumer):
+        """ Feeds an existing S3Consumer of the same routing key from this subscription. """
+        if consumer.routing_key != self.routing_key:
+            raise ValueError( '%s does not consume %s' % (consumer.name, self.routing_key) )
+        self.subscribers.append( Subscriber( consumer, self.buffer_size ) )
+        return consumer
+
+    def _collections(self, consumer):
+        """ dict of prefix -> collection for the routing key (one per shard). """
+        collections = consumer._get_msg_iterator()
+        if not isinstance( collections, dict ):
+            collections = {consumer._gen_routing_key( self.routing_key ):collections}
+        return collections
+
+    def _listing(self, subscribers, collections):
+        """ Lists from the oldest position of any subscriber in each prefix. """
+        positions = {}
+        for prefix in collections:
+            subscriber_positions = [subscriber.positions.get( prefix ) for subscriber in subscribers]
+            if None not in subscriber_positions:
+                positions[ prefix ] = min( subscriber_positions )
+
+        if len( collections ) == 1:
+            prefix, collection = list( collections.items() )[0]
+            if positions.get( prefix ):
+                collection = collection.filter( Marker=positions[ prefix ] )
+            return collection.filter( Delimiter='/' )
+        return merge_shards( collections, positions )
+
+    def _fetch(self, obj, subscribers):
+        """ Reads the body once if any subscriber will actually issue its callback. """
+        if any( subscriber.consumer._matches( obj ) for subscriber in subscribers ):
+            return SharedMessage( obj.key, subscribers[0].consumer._read( obj ) )
+        return obj
+
+    def consume(self):
+        """
+        Streams the messages after the oldest subscriber's cursor to every subscriber that
+        has not consumed them yet.  Returns the number of messages streamed.  The first
+        subscriber error is raised once the pass is over; that subscriber's cursor is left
+        before the failed message.
+        """
+        subscribers = list( self.subscribers )
+        if not subscribers:
+            return 0
+
+        collections = self._collections( subscribers[0].consumer )
+        for subscriber in subscribers:
+            subscriber.load_positions( list( collections ) )
+            subscriber.error = None
+        listing = self._listing( subscribers, collections )
+
+        threads = [threading.Thread( target=subscriber.run ) for subscriber in subscribers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        streamed = 0
+        window = deque()
+
+        def deliver(entry):
+            future, wanting = entry
+            message = future.result()
+            for subscriber in wanting:
+                subscriber.queue.put( message )
+
+        pool = ThreadPoolExecutor( max_workers=self.fetch_workers )
+        try:
+            for obj in listing:
+                wanting = [subscriber for subscriber in subscribers if subscriber.wants( obj.key )]
+                if not wanting:
+                    continue
+                streamed += 1
+                window.append( (pool.submit( self._fetch, obj, wanting ), wanting) )
+                if len( window ) >= self.fetch_workers:
+                    deliver( window.popleft() )
+            while window:
+                deliver( window.popleft() )
+        finally:
+            for subscriber in subscribers:
+                subscriber.queue.put( _DONE )
+            for thread in threads:
+                thread.join()
+            pool.shutdown()
+
+        for subscriber in subscribers:
+            if subscriber.error is not None:
+                raise subscriber.error
+        return streamed
+
+    def consumption_loop(self, interval=2):
+        """ Streams new messages to the subscribers, checking for more every interval seconds. """
+        try:
+            while True:
+                self.consume()
+                time.sleep( interval )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        for subscriber in self.subscribers:
+            subscriber.consumer.close()
@@ -0,0 +1,319 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Local append-log broker for single host deployments and tests.  Messages
+" are appended to segment files in a directory per routing key (and shard)
+" prefix under the same key names S3Producer would use, and consumed with
+" S3Consumer's cursor semantics:
+"
+"   <location>/FRONTEND/CUSTOMER/SIGNUP/2013-01-18T12:23:13.894895.log
+"
+" Each record is
+"
+"   <key length:u32><body length:u32><key><body><record length:u32>
+"
+" so the newest key can be read from the end of the newest segment.  Writers
+" hold an exclusive flock on the prefix's .lock file while appending, which
+" keeps keys strictly increasing across processes.  Readers hold a shared
+" lock only to take the size of complete data, then scan an mmap of it.
+"
+"""
+from __future__ import absolute_import
+import fcntl
+import io
+import mmap
+import os
+import struct
+from   contextlib import contextmanager
+from   datetime import datetime, timedelta
+
+from   muskrat.producer import BaseProducer, SendResult
+from   muskrat.s3consumer import S3Consumer
+from   muskrat.util import choose_shard, encode_attributes, key_timestamp, SHARD_FORMAT
+
+HEADER = struct.Struct( '<II' )
+TRAILER = struct.Struct( '<I' )
+SEGMENT_SUFFIX = '.log'
+LOCK_NAME = '.lock'
+
+#Segments are rolled once they reach this many bytes
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def encode_record( key, body ):
+    """ Returns the bytes of a single log record. """
+    key = key.encode( 'utf-8' )
+    if not isinstance( body, bytes ):
+        body = body.encode( 'utf-8' )
+    length = HEADER.size + len( key ) + len( body ) + TRAILER.size
+    return HEADER.pack( len( key ), len( body ) ) + key + body + TRAILER.pack( length )
+
+
+def decode_records( data, offset=0 ):
+    """
+    Yields (key, body offset, body length, next offset) for the complete records of data
+    from offset.  Stops at the first incomplete or torn record.
+    """
+    end = len( data )
+    while offset + HEADER.size + TRAILER.size <= end:
+        key_length, body_length = HEADER.unpack_from( data, offset )
+        length = HEADER.size + key_length + body_length + TRAILER.size
+        if offset + length > end or TRAILER.unpack_from( data, offset + length - TRAILER.size )[0] != length:
+            return
+        key_start = offset + HEADER.size
+        key = bytes( data[ key_start:key_start + key_length ] ).decode( 'utf-8' )
+        yield key, key_start + key_length, body_length, offset + length
+        offset += length
+
+
+def _segments( directory ):
+    try:
+        names = os.listdir( directory )
+    except OSError:
+        return []
+    return sorted( name for name in names if name.endswith( SEGMENT_SUFFIX ) )
+
+
+@contextmanager
+def _locked( directory, mode ):
+    """ Holds a flock on the directory's lock file. """
+    fd = os.open( os.path.join( directory, LOCK_NAME ), os.O_RDWR | os.O_CREAT, 0o644 )
+    try:
+        fcntl.flock( fd, mode )
+        yield
+    finally:
+        fcntl.flock( fd, fcntl.LOCK_UN )
+        os.close( fd )
+
+
+class FileMessage(object):
+    """ A message read from a log segment, shaped like an s3 object summary. """
+    def __init__( self, key, body ):
+        self.key = key
+        self.body = body
+        self.size = len( body )
+
+    def get( self ):
+        return {'Body':io.BytesIO( self.body )}
+
+
+class FileCollection(object):
+    """
+    Messages of a routing key (or shard) prefix in key order.  Supports the Marker and
+    Delimiter filters S3Cursor applies to a boto3 object collection.
+    """
+    def __init__( self, location, prefix, marker=None ):
+        self.location = location
+        self.prefix = prefix
+        self.marker = marker
+
+    def filter( self, Marker=None, **kwargs ):
+        return FileCollection( self.location, self.prefix, Marker or self.marker )
+
+    @property
+    def directory( self ):
+        return os.path.join( self.location, *self.prefix.split( '/' ) )
+
+    def __iter__( self ):
+        directory = self.directory
+        segments = _segments( directory )
+        if not segments:
+            return
+
+        marker = self.marker
+        start = 0
+        if marker:
+            #Segments are named after their first key, so skip those that end before the marker
+            timestamp = key_timestamp( marker )
+            for i, name in enumerate( segments ):
+                if name[ :-len( SEGMENT_SUFFIX ) ] <= timestamp:
+                    start = i
+
+        for name in segments[ start: ]:
+            for message in self._read_segment( directory, name, marker ):
+                yield message
+
+    def _read_segment( self, directory, name, marker ):
+        with open( os.path.join( directory, name ), 'rb' ) as f:
+            #Writers append under the exclusive lock, so this size ends on a record
+            with _locked( directory, fcntl.LOCK_SH ):
+                size = os.fstat( f.fileno() ).st_size
+            if not size:
+                return
+
+            data = mmap.mmap( f.fileno(), size, access=mmap.ACCESS_READ )
+            try:
+                for key, body_offset, body_length, offset in decode_records( data ):
+                    if marker and key <= marker:
+                        continue
+                    yield FileMessage( key, data[ body_offset:body_offset + body_length ] )
+            finally:
+                data.close()
+
+
+class FileProducer( BaseProducer ):
+
+    def __init__( self, **kwargs ):
+        """
+        location
+            Directory the logs are written under.  Defaults to the config's
+            file_broker['location'].
+        segment_size
+            Bytes after which a new segment file is started.  Defaults to the config's
+            file_broker['segment_size'] or 64MB.
+        shards
+            Number of shard sub-prefixes, as for S3Producer.
+        """
+        location = kwargs.pop( 'location', None )
+        segment_size = kwargs.pop( 'segment_size', None )
+        shards = kwargs.pop( 'shards', None )
+        super( FileProducer, self ).__init__( **kwargs )
+
+        options = getattr( self.config, 'file_broker', {} )
+        self.location = location or options['location']
+        self.segment_size = segment_size or options.get( 'segment_size', DEFAULT_SEGMENT_SIZE )
+        self.shards = shards or getattr( self.config, 's3_shards', None )
+
+    def _prefix( self, routing_key, shard_key ):
+        prefix = routing_key.replace( '.', '/' )
+        if self.shards:
+            prefix = '/'.join( [prefix, SHARD_FORMAT % choose_shard( shard_key, self.shards )] )
+        return prefix
+
+    def _last_key( self, path ):
+        """ Reads the newest key of a segment from its last record. """
+        with open( path, 'rb' ) as f:
+            size = os.fstat( f.fileno() ).st_size
+            if not size:
+                return None
+            length = 0
+            if size >= TRAILER.size:
+                f.seek( size - TRAILER.size )
+                length, = TRAILER.unpack( f.read( TRAILER.size ) )
+            if HEADER.size + TRAILER.size <= length <= size:
+                f.seek( size - length )
+                record = f.read( length )
+                records = list( decode_records( record ) )
+                if records:
+                    return records[0][0]
+
+        #A torn write from a crashed writer; drop it
+        return self._recover( path )
+
+    def _recover( self, path ):
+        with open( path, 'r+b' ) as f:
+            data = f.read()
+            offset = 0
+            key = None
+            for key, body_offset, body_length, offset in decode_records( data ):
+                pass
+            f.truncate( offset )
+        return key
+
+    def _next_timestamps( self, last_key, count ):
+        #Keys must sort after the newest key in the log even if clocks step back
+        now = datetime.today()
+        timestamp_format = self.config.s3_timestamp_format
+        if last_key:
+            last = datetime.strptime( key_timestamp( last_key ), timestamp_format )
+            now = max( now, last + timedelta( microseconds=1 ) )
+        step = timedelta( microseconds=1 )
+        return [( now + step * i ).strftime( timestamp_format ) for i in range( count )]
+
+    def _append( self, prefix, msgs, attributes=None, key_names=None ):
+        """
+        Appends messages to a prefix's log under its lock.  Returns the key names written.
+        Supplied key names are used when they sort after the newest key in the log.
+        """
+        directory = os.path.join( self.location, *prefix.split( '/' ) )
+        if not os.path.isdir( directory ):
+            try:
+                os.makedirs( directory )
+            except OSError:
+                #Created by another producer in the meantime
+                pass
+
+        with _locked( directory, fcntl.LOCK_EX ):
+            segments = _segments( directory )
+            path = os.path.join( directory, segments[-1] ) if segments else None
+            last_key = self._last_key( path ) if path else None
+
+            if key_names and key_names == sorted( key_names ) and ( last_key is None or key_names[0] > last_key ):
+                keys = list( key_names )
+            else:
+                suffix = encode_attributes( attributes )
+                keys = ['/'.join( [prefix, timestamp + suffix] )
+                        for timestamp in self._next_timestamps( last_key, len( msgs ) )]
+
+            if path is None or os.path.getsize( path ) >= self.segment_size:
+                path = os.path.join( directory, key_timestamp( keys[0] ) + SEGMENT_SUFFIX )
+
+            data = b''.join( encode_record( key, msg ) for key, msg in zip( keys, msgs ) )
+            fd = os.open( path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644 )
+            try:
+                while data:
+                    data = data[ os.write( fd, data ): ]
+            finally:
+                os.close( fd )
+        return keys
+
+    def send( self, msg, **kwargs ):
+        """
+        Appends a message to the routing key's log.
+
+        shard_key
+            Messages sharing a shard_key go to the same shard.  Defaults to the timestamp.
+        attributes
+            Optional dict of attributes encoded into the key name, as for S3Producer.
+        key_name
+            Key name chosen by a teeing Producer.  Used when it sorts after the newest key
+            in the log, otherwise a new key is generated.
+        """
+        rkey = kwargs.get( 'routing_key', self.routing_key ).upper()
+        key_name = kwargs.get( 'key_name' )
+        if key_name:
+            prefix = key_name.rsplit( '/', 1 )[0]
+        else:
+            prefix = self._prefix( rkey, kwargs.get( 'shard_key' ) or datetime.today().isoformat() )
+        return self._append( prefix, [msg], attributes=kwargs.get( 'attributes' ),
+                             key_names=[key_name] if key_name else None )[0]
+
+    def send_many( self, msgs, **kwargs ):
+        """ Appends the batch to a single shard's log in one write. """
+        rkey = kwargs.get( 'routing_key', self.routing_key ).upper()
+        msgs = list( msgs )
+        if not msgs:
+            return []
+
+        key_names = kwargs.get( 'key_names' )
+        if key_names and len( set( name.rsplit( '/', 1 )[0] for name in key_names ) ) == 1:
+            prefix = key_names[0].rsplit( '/', 1 )[0]
+        else:
+            key_names = None
+            prefix = self._prefix( rkey, datetime.today().isoformat() )
+
+        try:
+            keys = self._append( prefix, msgs, attributes=kwargs.get( 'attributes' ), key_names=key_names )
+        except Exception as e:
+            return [SendResult( msg, None, e ) for msg in msgs]
+        return [SendResult( msg, key, None ) for msg, key in zip( msgs, keys )]
+
+
+class FileConsumer( S3Consumer ):
+    """
+    S3Consumer reading a routing key from FileProducer logs instead of S3.  Cursors, shards,
+    attribute matching, dedupe and concurrent callbacks work as for S3.
+    """
+    def __init__( self, routing_key, func, location=None, **kwargs ):
+        """
+        location
+            Directory the logs are written under.  Defaults to the config's
+            file_broker['location'].
+        """
+        kwargs['segments'] = False
+        super( FileConsumer, self ).__init__( routing_key, func, **kwargs )
+        self.location = location or getattr( self.config, 'file_broker', {} )['location']
+
+    def _get_collection( self, prefix ):
+        return FileCollection( self.location, prefix )
@@ -0,0 +1,167 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Hybrid consumer for routing keys teed to RabbitMQ and S3 by Producer.
+" Live messages are consumed from a RabbitMQ queue for low latency.  After
+" a (re)connect the gap since the cursor is filled from the S3 copy, which
+" the RabbitMQ message names in its muskrat-key header.  Keys are deduped
+" across the two sources and a single S3Cursor position is kept, so the
+" consumer can be replayed and resumed like any S3Consumer.
+"
+"""
+from __future__ import absolute_import
+import io
+import time
+from   itertools import islice
+from   datetime import datetime, timedelta
+
+from   muskrat.producer import KEY_HEADER
+from   muskrat.s3consumer import S3Consumer
+from   muskrat.util import key_prefix, key_timestamp
+
+
+class LiveMessage(object):
+    """ A message delivered by RabbitMQ, shaped like the s3 object summaries S3Consumer handles. """
+    def __init__(self, key, body):
+        self.key = key
+        self.body = body
+        self.size = len(body)
+
+    def get(self):
+        return {'Body':io.BytesIO(self.body)}
+
+
+class HybridConsumer(S3Consumer):
+
+    def __init__(self, routing_key, func, name=None, config='config.py', overlap=60, prefetch_count=100,
+                 dedupe=True, **kwargs):
+        """
+        Takes the S3Consumer options (except shards and workers) and:
+
+        overlap
+            Seconds before the cursor position that gap filling starts from, so messages that
+            reached S3 out of key order are not missed.  Dedupe suppresses the repeats.
+        prefetch_count
+            Maximum number of unacknowledged RabbitMQ deliveries.
+        dedupe
+            Deduper options (see S3Consumer).  Always enabled since both sources deliver
+            most messages.
+        """
+        if kwargs.get('workers'):
+            raise ValueError('HybridConsumer does not support workers')
+
+        super(HybridConsumer, self).__init__(routing_key, func, name=name, config=config,
+                                             dedupe=dedupe or True, **kwargs)
+        if self.shards:
+            raise ValueError('HybridConsumer does not support sharded routing keys')
+        self.overlap = overlap
+        self.prefetch_count = prefetch_count
+        self.position = self._cursor.get() or None
+
+        self._connection = None
+        self._channel = None
+
+    @property
+    def queue_name(self):
+        """ Durable queue named after the cursor so live messages are kept while disconnected. """
+        return self.name
+
+    def connect(self):
+        """ Connects to RabbitMQ and binds the consumer's queue to the routing key. """
+        import pika
+        self._connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.config.host))
+        channel = self._connection.channel()
+        channel.exchange_declare(exchange=self.config.exchange_name, exchange_type=self.config.exchange_type)
+        channel.basic_qos(prefetch_count=self.prefetch_count)
+
+        channel.queue_declare(queue=self.queue_name, durable=True)
+        channel.queue_bind(exchange=self.config.exchange_name, queue=self.queue_name, routing_key=self.routing_key)
+        channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_message)
+        self._channel = channel
+
+    def _advance(self, key):
+        #Both sources deliver in roughly key order; the cursor never moves back
+        if self.position is None or key > self.position:
+            self._cursor.update(key)
+            self.position = key
+
+    def _rewind(self, position):
+        """ Marker overlap seconds before position. """
+        timestamp_format = self.config.s3_timestamp_format
+        try:
+            timestamp = datetime.strptime(key_timestamp(position), timestamp_format)
+        except ValueError:
+            return position
+        timestamp -= timedelta(seconds=self.overlap)
+        return '/'.join([key_prefix(position), timestamp.strftime(timestamp_format)])
+
+    def gap_fill(self, max_messages=None):
+        """
+        Consumes the messages written to S3 since the cursor (less overlap) that have not
+        been processed yet.  Returns the number of messages handled.
+        """
+        collection = self._get_msg_iterator()
+        if self.position:
+            collection = collection.filter(Marker=self._rewind(self.position))
+
+        handled = 0
+        for obj in islice(collection.filter(Delimiter='/'), max_messages):
+            self._handle(obj)
+            self._advance(obj.key)
+            handled += 1
+        return handled
+
+    def consume(self, max_messages=None):
+        return self.gap_fill(max_messages)
+
+    def _on_message(self, channel, method, header, body):
+        """
+        Handles a live delivery.  Deliveries without a key header (not sent through a teeing
+        Producer) are processed but cannot be deduped or tracked by the cursor.
+        """
+        key = (getattr(header, 'headers', None) or {}).get(KEY_HEADER)
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+
+        try:
+            if key is None:
+                self._run(LiveMessage(None, body))
+            else:
+                self._handle(LiveMessage(key, body))
+                self._advance(key)
+        except:
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            raise
+
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def consumption_loop(self, interval=2):
+        """
+        Consumes live messages, filling the gap from S3 first on every (re)connect.  Waits
+        interval seconds before reconnecting after the connection is lost.
+        """
+        import pika
+        try:
+            while True:
+                try:
+                    #Bind before gap filling so nothing written in between is missed
+                    self.connect()
+                    self.gap_fill()
+                    self._channel.start_consuming()
+                except pika.exceptions.AMQPConnectionError:
+                    self._connection = None
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+        super(HybridConsumer, self).close()
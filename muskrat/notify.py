@@ -0,0 +1,187 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Local wake-up channel between producers and consumers on the same host.
+" Consumers bind a Unix datagram socket in a directory per routing key:
+"
+"   <location>/<routing key hash>/<name hash>-<pid>.sock
+"
+" Both levels are hashed to keep the path within the ~108 bytes AF_UNIX allows.
+" and producers send an empty datagram to every socket there after a
+" successful write.  A consumption_loop waiting between polls wakes up on the
+" datagram and lists right away instead of sleeping out its interval.
+" Notifications are best effort: the regular poll interval remains the
+" fallback when they are lost, the socket buffer is full, or the producer
+" runs on another host.
+"
+"""
+from __future__ import absolute_import
+import errno
+import hashlib
+import os
+import select
+import socket
+import tempfile
+import threading
+import time
+
+from   muskrat.util import key_prefix
+
+DEFAULT_LOCATION = os.path.join( tempfile.gettempdir(), 'muskrat-notify' )
+SOCKET_SUFFIX = '.sock'
+
+#Unix sockets are not available on every platform
+SUPPORTED = hasattr( socket, 'AF_UNIX' )
+
+
+def notify_location( option ):
+    """
+    Directory of the notification sockets for a notify option: True (the default location),
+    a directory, or a dict with a 'location'.  None when notifications are off.
+    """
+    if not option or not SUPPORTED:
+        return None
+    if option is True:
+        return DEFAULT_LOCATION
+    if isinstance( option, dict ):
+        return option.get( 'location', DEFAULT_LOCATION )
+    return option
+
+
+def routing_key_directory( location, routing_key ):
+    """ Directory the sockets of a routing key's consumers are bound in. """
+    return os.path.join( location, hashlib.sha1( routing_key.upper().encode( 'utf-8' ) ).hexdigest()[:16] )
+
+
+def key_routing_key( key_name ):
+    """ Routing key a message key was written under, without any shard sub-prefix. """
+    parts = key_prefix( key_name ).split( '/' )
+    #Routing keys are upper cased, so a lower case shard level cannot be part of one
+    if len( parts ) > 1 and parts[-1].startswith( 'shard' ):
+        parts = parts[:-1]
+    return '.'.join( parts )
+
+
+class Notifier(object):
+    """ Signals the consumers listening on a routing key.  Thread safe. """
+    def __init__( self, location=DEFAULT_LOCATION, refresh=1.0 ):
+        """
+        location
+            Directory the consumer sockets are bound under.
+        refresh
+            Seconds a routing key's list of sockets is cached for.
+        """
+        self.location = location
+        self.refresh = refresh
+        self._socket = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+        self._socket.setblocking( False )
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def _paths( self, routing_key ):
+        now = time.time()
+        with self._lock:
+            listed = self._listeners.get( routing_key )
+            if listed is not None and now - listed[0] < self.refresh:
+                return listed[1]
+
+        directory = routing_key_directory( self.location, routing_key )
+        try:
+            paths = [os.path.join( directory, name ) for name in os.listdir( directory )
+                     if name.endswith( SOCKET_SUFFIX )]
+        except OSError:
+            paths = []
+        with self._lock:
+            self._listeners[ routing_key ] = (now, paths)
+        return paths
+
+    def _drop( self, routing_key, path ):
+        with self._lock:
+            listed = self._listeners.get( routing_key )
+            if listed is not None and path in listed[1]:
+                self._listeners[ routing_key ] = (listed[0], [p for p in listed[1] if p != path])
+
+    def notify( self, routing_key ):
+        """ Wakes every consumer of the routing key.  Returns the number signalled. """
+        routing_key = routing_key.upper()
+        signalled = 0
+        for path in self._paths( routing_key ):
+            try:
+                self._socket.sendto( b'', path )
+                signalled += 1
+            except socket.error as e:
+                if e.errno in ( errno.ECONNREFUSED, errno.ENOENT ):
+                    #Left behind by a consumer that exited without closing
+                    self._drop( routing_key, path )
+                    try:
+                        os.unlink( path )
+                    except OSError:
+                        pass
+                #A full buffer means a wake-up is already pending
+        return signalled
+
+    def notify_key( self, key_name ):
+        """ Wakes the consumers of the routing key a message was written under. """
+        return self.notify( key_routing_key( key_name ) )
+
+    def close( self ):
+        self._socket.close()
+
+
+class Listener(object):
+    """ A consumer's notification socket. """
+    def __init__( self, routing_key, name, location=DEFAULT_LOCATION ):
+        directory = routing_key_directory( location, routing_key )
+        if not os.path.isdir( directory ):
+            try:
+                os.makedirs( directory )
+            except OSError:
+                #Created by another consumer in the meantime
+                pass
+
+        digest = hashlib.sha1( name.encode( 'utf-8' ) ).hexdigest()[:12]
+        self.path = os.path.join( directory, '%s-%d%s' % (digest, os.getpid(), SOCKET_SUFFIX) )
+        try:
+            os.unlink( self.path )
+        except OSError:
+            pass
+
+        self._socket = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+        self._socket.bind( self.path )
+        self._socket.setblocking( False )
+        self.wakeups = 0
+
+    def fileno( self ):
+        return self._socket.fileno()
+
+    def drain( self ):
+        """ Discards pending notifications.  Returns how many there were. """
+        count = 0
+        while True:
+            try:
+                self._socket.recv( 64 )
+            except socket.error as e:
+                if e.errno in ( errno.EAGAIN, errno.EWOULDBLOCK ):
+                    return count
+                raise
+            count += 1
+
+    def wait( self, timeout ):
+        """
+        Blocks until a producer signals or timeout seconds have passed.  Returns True when
+        woken by a notification.  Notifications received meanwhile are folded into one.
+        """
+        readable, _, _ = select.select( [self._socket], [], [], timeout )
+        if not readable:
+            return False
+        self.drain()
+        self.wakeups += 1
+        return True
+
+    def close( self ):
+        self._socket.close()
+        try:
+            os.unlink( self.path )
+        except OSError:
+            pass
@@ -5,17 +5,38 @@
 """
 from __future__ import absolute_import
 from six.moves import range
-try: import simplejson as json
-except ImportError: import json
 
 import six.moves.queue
 import threading
-from   datetime   import datetime
+import time
+from   collections import namedtuple
+from   concurrent.futures import ThreadPoolExecutor
+from   datetime   import datetime, timedelta
+
+from   muskrat.util import config_loader, choose_shard, encode_attributes, SHARD_FORMAT
+from   muskrat.serializers import get_serializer
+from   muskrat.concurrency import AIMDLimiter, RequestTimeout, get_hedger, is_throttle
+from   muskrat.retry import RetryBudget, RetryPolicy, SpillFile, is_retryable
+from   muskrat.notify import Notifier, notify_location
+from   muskrat.claimcheck import ClaimStore, CLAIM_HEADER, DEFAULT_THRESHOLD, encode_envelope, payload_size
+
+#Broker client libraries (pika, boto) are imported on first use so that using
+#one broker does not pay the import cost of the others.
+
+#RabbitMQ header carrying the S3 key name of a teed message
+KEY_HEADER = 'muskrat-key'
+
+class SendResult( namedtuple( 'SendResult', ['msg', 'key', 'error'] ) ):
+    """
+    Outcome of a single message handed to send_many.  key is the broker key the message
+    was written under (when the broker has one) and error the exception raised, if any.
+    """
+    __slots__ = ()
+
+    @property
+    def ok( self ):
+        return self.error is None
 
-import pika
-import boto
-from   muskrat.util import config_loader
-from boto.s3.connection import OrdinaryCallingFormat
 
 class BaseProducer(object):
     """
@@ -31,6 +52,9 @@ class BaseProducer(object):
             key for the data source to bind this producer to. Defaults to the config file.
         config
             Configuration file if not defined in muskrat.config.py.
+        serializer
+            Name of the serializer used by send_json (see muskrat.serializers).  Defaults
+            to the config's serializer setting or 'json'.
         """
         self.config = config_loader( config )
 
@@ -38,15 +62,46 @@ class BaseProducer(object):
         if self.routing_key:
             self.routing_key = self.routing_key.upper()
 
+        self.serializer = get_serializer( 
+                kwargs.get( 'serializer', getattr( self.config, 'serializer', 'json' ) ),
+                timeformat=getattr( self.config, 'timeformat', None ) )
+
     def send( self, msg ):
         """ Class interface method.  Needs to be implemented by children """
         raise NotImplementedError
 
-    def send_json( self, obj ):
-        """ Dumps the object to json before sending the message.  """
+    def send_many( self, msgs, **kwargs ):
+        """
+        Sends a batch of messages.  Returns a list of SendResult in the same order as msgs.
+        Brokers override this with a more efficient bulk implementation.
 
-        #Handle datetime objects
-        self.send( json.dumps( obj, default=lambda item: item.strftime(self.config.timeformat) if isinstance( item, datetime ) else None ) )
+        routing_key
+            Overrides the producer's routing key for the whole batch.
+        key_names
+            Optional S3 key name for each message (see send's key_name).
+        """
+        msgs = list( msgs )
+        key_names = kwargs.pop( 'key_names', None ) or [None] * len( msgs )
+        results = []
+        for msg, key_name in zip( msgs, key_names ):
+            try:
+                if key_name is not None:
+                    self.send( msg, key_name=key_name, **kwargs )
+                else:
+                    self.send( msg, **kwargs )
+            except Exception as e:
+                results.append( SendResult( msg, None, e ) )
+            else:
+                results.append( SendResult( msg, None, None ) )
+        return results
+
+    def send_json( self, obj, **kwargs ):
+        """ Dumps the object with the producer's serializer before sending the message.  """
+        self.send( self.serializer.dumps( obj ), **kwargs )
+
+    def send_json_many( self, objs, **kwargs ):
+        """ Serializes all objects in bulk and sends them with send_many. """
+        return self.send_many( self.serializer.dumps_many( objs ), **kwargs )
 
 
 class RabbitMQProducer( BaseProducer ):
@@ -61,21 +116,102 @@ class RabbitMQProducer( BaseProducer ):
             key for the data source to bind this producer to. Defaults to the config file.
         exchange
             name of the exchange to send messages to. Defaults to the config file.
+        claim_check
+            Write payloads larger than this many bytes to S3 and publish a small reference
+            instead (see muskrat.claimcheck).  True uses a 128KB threshold.  Defaults to the
+            config's claim_check_threshold setting; unset publishes every payload.
         """
+        import pika
+
+        #Config has to be loaded before the connection can be made
+        super( RabbitMQProducer, self ).__init__( **kwargs )
+
+        self._properties = pika.BasicProperties
         self.parameters = pika.ConnectionParameters( host=self.config.host )
         self.conn = pika.BlockingConnection( self.parameters )
         self.channel = self.conn.channel()
 
         self.exchange = kwargs.get( 'exchange', self.config.exchange_name )
-        super( RabbitMQProducer, self ).__init__( **kwargs )
-    
+
+        claim_check = kwargs.get( 'claim_check', getattr( self.config, 'claim_check_threshold', None ) )
+        if claim_check is True:
+            claim_check = DEFAULT_THRESHOLD
+        self.claim_threshold = claim_check or None
+        self._claims = None
+
+    @property
+    def claims( self ):
+        if self._claims is None:
+            self._claims = ClaimStore( self.config )
+        return self._claims
+
+    def _key_properties( self, key_name, claim=None ):
+        headers = {}
+        if key_name is not None:
+            headers[ KEY_HEADER ] = key_name
+        if claim is not None:
+            headers[ CLAIM_HEADER ] = claim
+        if not headers:
+            return None
+        return self._properties( headers=headers )
+
+    def _claim_checked( self, msg ):
+        if self.claim_threshold is None:
+            return False
+        return payload_size( msg ) > self.claim_threshold
+
     def send( self, msg, **kwargs ):
         """
         Sends the actual message to the broker.
+
+        key_name
+            S3 key name of the same message when it is teed to S3.  Sent in the muskrat-key
+            header so consumers can match the two copies (see muskrat.hybrid).
         """
         key = kwargs.get( 'routing_key', self.routing_key )
         key = key.upper()
-        self.channel.basic_publish( exchange=self.exchange, routing_key=key, body=msg )
+        claim = None
+        if self._claim_checked( msg ):
+            claim = self.claims.put( key, msg )
+            msg = encode_envelope( claim, payload_size( msg ) )
+        self.channel.basic_publish( exchange=self.exchange, routing_key=key, body=msg,
+                                    properties=self._key_properties( kwargs.get( 'key_name' ), claim ) )
+
+    def send_many( self, msgs, **kwargs ):
+        """
+        Publishes the batch back to back on the channel without waiting on the broker
+        between messages.  Claim checked payloads of the batch are uploaded concurrently
+        first.
+        """
+        key = kwargs.get( 'routing_key', self.routing_key ).upper()
+        msgs = list( msgs )
+        publish = self.channel.basic_publish
+        exchange = self.exchange
+        key_names = kwargs.get( 'key_names' ) or [None] * len( msgs )
+
+        claims = {}
+        large = [i for i, msg in enumerate( msgs ) if self._claim_checked( msg )]
+        if large:
+            for i, result in zip( large, self.claims.put_many( key, [msgs[ i ] for i in large] ) ):
+                claims[ i ] = result
+
+        results = []
+        for i, (msg, key_name) in enumerate( zip( msgs, key_names ) ):
+            claim = claims.get( i )
+            if claim is not None and not claim.ok:
+                results.append( SendResult( msg, key, claim.error ) )
+                continue
+            body = msg
+            if claim is not None:
+                body = encode_envelope( claim.key, payload_size( msg ) )
+            try:
+                publish( exchange=exchange, routing_key=key, body=body,
+                         properties=self._key_properties( key_name, claim.key if claim is not None else None ) )
+            except Exception as e:
+                results.append( SendResult( msg, key, e ) )
+            else:
+                results.append( SendResult( msg, key, None ) )
+        return results
 
 
 class S3Producer( BaseProducer ):
@@ -84,13 +220,40 @@ class S3Producer( BaseProducer ):
     """
 
     def __init__(self, **kwargs):
+        """
+        upload_threads
+            Number of concurrent uploads issued by send_many.  Defaults to 10.
+        shards
+            Spread writes for a routing key over this many shard sub-prefixes so a hot routing
+            key is not limited by S3's per-prefix request rate.  Defaults to the config's
+            s3_shards setting; unset means the unsharded layout.
+        notify
+            Signal consumers on this host after every successful write so their
+            consumption_loop polls right away (see muskrat.notify).  True, a socket directory
+            or a dict with a 'location'.  Defaults to the config's s3_notify setting.
+        """
+        self.upload_threads = kwargs.pop( 'upload_threads', 10 )
+        shards = kwargs.pop( 'shards', None )
+        notify = kwargs.pop( 'notify', None )
         super( S3Producer, self ).__init__(**kwargs)
+        self.shards = shards or getattr( self.config, 's3_shards', None )
+
+        if notify is None:
+            notify = getattr( self.config, 's3_notify', None )
+        location = notify_location( notify )
+        self.notifier = Notifier( location ) if location else None
         self._s3conn = None
+
+        #Last timestamp handed out so later sends never reuse an earlier key
+        self._last_stamp = None
+        self._stamp_lock = threading.Lock()
         self._bucket = None
 
     @property
     def s3conn(self):
         if self._s3conn is None:
+            import boto
+            from boto.s3.connection import OrdinaryCallingFormat
             self._s3conn = boto.connect_s3( self.config.s3_key, self.config.s3_secret, host=self.config.s3_host, calling_format=OrdinaryCallingFormat())
         return self._s3conn
 
@@ -108,15 +271,58 @@ class S3Producer( BaseProducer ):
     def send( self, msg, **kwargs ):
         """
         Actually sends the message to our s3 bucket.
+
+        shard_key
+            With a sharded layout, messages sharing a shard_key go to the same shard.  Defaults
+            to hashing the message's timestamp.
+        attributes
+            Optional dict of small attributes (type, tenant, priority) encoded into the key name
+            so consumers can filter messages without fetching them.
+        key_name
+            Write the message under this key name instead of generating one.  Used by the tee
+            Producer so every broker refers to the message by the same key.
         """
         rkey = kwargs.get( 'routing_key', self.routing_key )
         rkey = rkey.upper()
         try:
-            s3key_name = self._create_key_name( rkey )
+            s3key_name = kwargs.get( 'key_name' ) or \
+                         self._create_key_name( rkey, shard_key=kwargs.get( 'shard_key' ),
+                                                attributes=kwargs.get( 'attributes' ) )
             s3key = self.bucket.new_key( key_name=s3key_name )
             self._send( msg, s3key )
         except:
             raise 
+        self._notify( rkey )
+
+    def send_many( self, msgs, **kwargs ):
+        """
+        Uploads a batch of messages concurrently.  Key names for the whole batch are generated
+        up front from a single timestamp so they are unique and keep the batch order.
+        attributes, if supplied, apply to every message in the batch.
+        """
+        rkey = kwargs.get( 'routing_key', self.routing_key ).upper()
+        msgs = list( msgs )
+        key_names = kwargs.get( 'key_names' ) or \
+                    self._create_key_names( rkey, len( msgs ), attributes=kwargs.get( 'attributes' ) )
+        bucket = self.bucket
+
+        def upload( item ):
+            msg, key_name = item
+            try:
+                self._send( msg, bucket.new_key( key_name=key_name ) )
+            except Exception as e:
+                return SendResult( msg, key_name, e )
+            return SendResult( msg, key_name, None )
+
+        if len( msgs ) <= 1:
+            results = [upload( item ) for item in zip( msgs, key_names )]
+        else:
+            with ThreadPoolExecutor( max_workers=min( self.upload_threads, len( msgs ) ) ) as pool:
+                results = list( pool.map( upload, zip( msgs, key_names ) ) )
+
+        if any( result.ok for result in results ):
+            self._notify( rkey )
+        return results
 
     def _send( self, msg, s3key):
         """
@@ -124,43 +330,208 @@ class S3Producer( BaseProducer ):
         """
         s3key.set_contents_from_string( msg )
 
+    def _notify( self, routing_key ):
+        """ Wakes local consumers once a write has completed. """
+        if self.notifier is not None:
+            self.notifier.notify( routing_key )
+
     def _create_key_prefix( self, routing_key ):
         return routing_key.replace( '.', '/' )
 
-    def _create_key_name( self, routing_key ):
+    def _create_shard_prefix( self, prefix, shard_key ):
+        """
+        Appends the shard sub-prefix chosen by hashing shard_key when sharding is enabled.
+        """
+        if not self.shards:
+            return prefix
+        return '/'.join( [prefix, SHARD_FORMAT % choose_shard( shard_key, self.shards )] )
+
+    def _create_key_name( self, routing_key, shard_key=None, attributes=None ):
         """
         Creates a key based on the routing key and a timestamp of the actual item.
         """
-        return '/'.join( [self._create_key_prefix( routing_key ), datetime.today().strftime( self.config.s3_timestamp_format )] )
+        timestamp = self._next_stamps( 1 )[0].strftime( self.config.s3_timestamp_format )
+        prefix = self._create_shard_prefix( self._create_key_prefix( routing_key ), shard_key or timestamp )
+        return '/'.join( [prefix, timestamp + encode_attributes( attributes )] )
+
+    def _next_stamps( self, count ):
+        """
+        Returns count increasing timestamps for new keys.  They start at the current time,
+        or a microsecond past the last timestamp handed out when the clock has not yet
+        moved beyond it, so keys from consecutive sends never collide.
+        """
+        step = timedelta( microseconds=1 )
+        with self._stamp_lock:
+            start = datetime.today()
+            if self._last_stamp is not None and start <= self._last_stamp:
+                start = self._last_stamp + step
+            self._last_stamp = start + step * ( count - 1 )
+        return [start + step * i for i in range( count )]
+
+    def _create_key_names( self, routing_key, count, attributes=None ):
+        """
+        Creates count ordered key names for a batch.  Each message is a microsecond after
+        the previous one so no two keys in the batch, or in later sends, collide.
+        """
+        prefix = self._create_key_prefix( routing_key )
+        timestamp_format = self.config.s3_timestamp_format
+        suffix = encode_attributes( attributes )
+
+        key_names = []
+        for stamp in self._next_stamps( count ):
+            timestamp = stamp.strftime( timestamp_format )
+            key_names.append( '/'.join( [self._create_shard_prefix( prefix, timestamp ), timestamp + suffix] ) )
+        return key_names
 
     def _set_lifecycle_policy( self, policy ):
         """
-        Generates a lifecycle policy on the s3 bucket.
+        Generates a lifecycle policy on the s3 bucket that expires this producer's routing
+        key `policy` days after messages are written.  Rules for other routing keys are kept.
+        For retention based on consumer progress see muskrat.retention.
         """
-        raise NotImplementedError
+        from boto.exception import S3ResponseError
+        from boto.s3.lifecycle import Lifecycle
+
+        prefix = self._create_key_prefix( self.routing_key ) + '/'
+        lifecycle = Lifecycle()
+        try:
+            for rule in self.bucket.get_lifecycle_config():
+                if rule.id != prefix:
+                    lifecycle.append( rule )
+        except S3ResponseError:
+            #No lifecycle configuration on the bucket yet
+            pass
+
+        lifecycle.add_rule( id=prefix, prefix=prefix, status='Enabled', expiration=policy )
+        self.bucket.configure_lifecycle( lifecycle )
 
 
 class S3WriteThread( threading.Thread ):
     """
     Actual thread that can write to S3.
+
+    Failed PUTs are retried inline according to the retry policy; retryable errors
+    (throttles, timeouts, connection errors, 5xx) back off and try again while the policy
+    and its budget allow it, anything else fails right away.  The outcome of every message
+    is passed to on_result, and no error ends the thread, so queue.join() always returns.
     """
-    def __init__(self, queue, timeout=1):
+    def __init__(self, queue, timeout=1, limiter=None, hedger=None, notifier=None, retry=None, on_result=None):
         super(S3WriteThread, self).__init__()
         self.queue = queue
         self.timeout = timeout
+        self.limiter = limiter
+        self.hedger = hedger
+        self.notifier = notifier
+        if retry is None:
+            retry = RetryPolicy( attempts=5, base_delay=0.1, retryable=is_retryable )
+        self.retry = retry
+        self.on_result = on_result
 
     def run(self):
         try:
             #We want to continually process the queue if items are available
             while True:
-                msg, s3key = self.queue.get( True, self.timeout )
-                s3key.set_contents_from_string( msg )
-                self.queue.task_done()
+                self._write()
         except six.moves.queue.Empty:
             #queue.get() timeout will cause this exception and mean we are done
             #with our messages, so exit the thread.
             pass
 
+    def _put(self, msg, s3key):
+        if self.hedger is None:
+            s3key.set_contents_from_string( msg )
+        else:
+            #boto Keys carry per request state, so the hedge writes through its own Key
+            self.hedger.call( s3key.set_contents_from_string, msg,
+                              hedge=lambda: s3key.bucket.new_key( s3key.name ).set_contents_from_string( msg ) )
+        if self.notifier is not None:
+            self.notifier.notify_key( s3key.name )
+
+    def _attempt(self, msg, s3key):
+        """
+        Single PUT.  With a limiter it waits for a slot and feeds the latency and any
+        throttle response back into it.
+        """
+        if self.limiter is None:
+            return self._put( msg, s3key )
+
+        self.limiter.acquire()
+        start = time.time()
+        try:
+            self._put( msg, s3key )
+        except Exception as e:
+            if is_throttle( e ) or isinstance( e, RequestTimeout ):
+                self.limiter.release( time.time() - start, throttled=True )
+            else:
+                self.limiter.release()
+            raise
+        self.limiter.release( time.time() - start )
+
+    def _write(self):
+        msg, s3key = self.queue.get( True, self.timeout )
+        try:
+            error = self._retried_put( msg, s3key )
+            if self.on_result is not None:
+                self.on_result( msg, s3key, error )
+        except Exception:
+            #Keep writing the rest of the queue
+            pass
+        finally:
+            self.queue.task_done()
+
+    def _retried_put(self, msg, s3key):
+        """ Writes a message, retrying per the policy.  Returns the final error or None. """
+        if self.retry.budget is not None:
+            self.retry.budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                self._attempt( msg, s3key )
+                return None
+            except Exception as e:
+                if not self.retry.should_retry( e, attempt ):
+                    return e
+            time.sleep( self.retry.delay( attempt ) )
+            attempt += 1
+
+
+class WriteReport(object):
+    """
+    Outcome of the messages written by a ThreadedS3Producer since the last join().  Counts
+    every message, keeps a SendResult (with the message, so it can be resent) for up to
+    max_failures failed ones and, with track=True, a SendResult holding only the key name
+    for every successful one.
+    """
+    def __init__(self, track=False, max_failures=10000):
+        self.track = track
+        self.max_failures = max_failures
+        self.succeeded = []
+        self.failed = []
+        self.succeeded_count = 0
+        self.failed_count = 0
+
+    def add(self, result):
+        if result.ok:
+            self.succeeded_count += 1
+            if self.track:
+                self.succeeded.append( result )
+        else:
+            self.failed_count += 1
+            if len( self.failed ) < self.max_failures:
+                self.failed.append( result )
+
+    @property
+    def dropped(self):
+        """ Failures counted but not kept past max_failures. """
+        return self.failed_count - len( self.failed )
+
+    @property
+    def ok(self):
+        return self.failed_count == 0
+
+    def __len__(self):
+        return self.succeeded_count + self.failed_count
+
 
 class ThreadedS3Producer( S3Producer ):
     """
@@ -170,13 +541,109 @@ class ThreadedS3Producer( S3Producer ):
     Each thread has the potential to block for at least 1 second on cleanup.
 
     Defaults to a thread pool of 20 threads.
+
+    With adaptive=True the pool size becomes an upper bound and the number of PUTs in
+    flight is adjusted between min_threads and num_threads from observed latency and
+    S3 SlowDown responses (see muskrat.concurrency.AIMDLimiter).
+
+    hedge (True, a dict of options or a muskrat.concurrency.Hedger; defaults to the config's
+    s3_hedging setting) re-issues PUTs slower than the observed p95 and retries PUTs that
+    miss their deadline.
+
+    Failed PUTs are retried with exponential backoff and jitter while the error is
+    retryable (see muskrat.retry.is_retryable) and a retry budget shared by all threads
+    allows it.  retry sets the number of attempts or a muskrat.retry.RetryPolicy.
+    Messages that still fail are passed to on_failure( msg, key_name, error ) and/or
+    appended to the spill file (defaults to the config's s3_spill_file), and join()
+    returns a WriteReport of the messages written since the previous join(): counts and
+    the first max_failures failures, plus every success with track_results=True.
     """
     def __init__(self, *args, **kwargs):
         self.queue = six.moves.queue.Queue()
         self.num_threads = kwargs.pop( 'num_threads', 20 )
         self.threads = []
+
+        retry = kwargs.pop( 'retry', 5 )
+        if not isinstance( retry, RetryPolicy ):
+            retry = RetryPolicy( attempts=retry, base_delay=0.1, retryable=is_retryable, budget=RetryBudget() )
+        self.retry = retry
+        self.on_failure = kwargs.pop( 'on_failure', None )
+        spill = kwargs.pop( 'spill', None )
+        self.track_results = kwargs.pop( 'track_results', False )
+        self.max_failures = kwargs.pop( 'max_failures', 10000 )
+        self.report = self._new_report()
+        self._report_lock = threading.Lock()
+
+        self.limiter = None
+        adaptive = kwargs.pop( 'adaptive', False )
+        min_threads = kwargs.pop( 'min_threads', 1 )
+        if adaptive:
+            self.limiter = AIMDLimiter( min_limit=min_threads, max_limit=self.num_threads )
+        hedge = kwargs.pop( 'hedge', None )
+
         super( ThreadedS3Producer, self ).__init__( **kwargs )
 
+        if hedge is None:
+            hedge = getattr( self.config, 's3_hedging', None )
+        if hedge is True:
+            #Room for every thread's request and its hedge
+            hedge = {'workers':self.num_threads * 2}
+        self.hedger = get_hedger( hedge )
+
+        if spill is None:
+            spill = getattr( self.config, 's3_spill_file', None )
+        self.spill = SpillFile( spill ) if spill else None
+
+    @property
+    def concurrency(self):
+        """ Number of PUTs currently allowed in flight. """
+        if self.limiter is None:
+            return self.num_threads
+        return self.limiter.concurrency
+
+    def metrics(self):
+        """ Current concurrency and queue depth for metrics reporting. """
+        if self.limiter is None:
+            stats = {'concurrency':self.num_threads}
+        else:
+            stats = self.limiter.stats()
+        stats['queued'] = self.queue.qsize()
+        if self.hedger is not None:
+            stats['hedging'] = self.hedger.stats()
+        if self.retry.budget is not None:
+            stats['retries'] = self.retry.budget.stats()
+        stats['failed'] = self.report.failed_count
+        return stats
+
+    def _new_report(self):
+        return WriteReport( track=self.track_results, max_failures=self.max_failures )
+
+    def _thread(self):
+        return S3WriteThread( self.queue, limiter=self.limiter, hedger=self.hedger, notifier=self.notifier,
+                              retry=self.retry, on_result=self._record )
+
+    def _record(self, msg, s3key, error):
+        """ Called by the write threads with the outcome of each message. """
+        key_name = getattr( s3key, 'name', None )
+        if error is None:
+            with self._report_lock:
+                self.report.add( SendResult( None, key_name, None ) )
+            return
+
+        with self._report_lock:
+            self.report.add( SendResult( msg, key_name, error ) )
+        #A failing handler must not take the write thread down with it
+        if self.spill is not None:
+            try:
+                self.spill.write( key_name, msg, error )
+            except Exception:
+                pass
+        if self.on_failure is not None:
+            try:
+                self.on_failure( msg, key_name, error )
+            except Exception:
+                pass
+
 
     def _start(self):
         """
@@ -184,19 +651,19 @@ class ThreadedS3Producer( S3Producer ):
         """
         if not self.threads:
             for i in range( self.num_threads ):
-                t = S3WriteThread( self.queue )
+                t = self._thread()
                 self.threads.append( t )
                 t.start()
         else:
             for i, t in enumerate( self.threads ):
-                if not t.isAlive():
+                if not t.is_alive():
                     try:
                         #Threads can only be started once.  In the case that
                         #our thread *appears* to have finished before all of
                         #our data is proccessed (Queue was temporarily empty)
                         #Lets replace that thread with a new one and keep
                         #keep proccessing
-                        replacement_thread = S3WriteThread( self.queue )
+                        replacement_thread = self._thread()
                         self.threads[ i ] = replacement_thread
                         replacement_thread.start()
                     except RuntimeError:
@@ -210,9 +677,37 @@ class ThreadedS3Producer( S3Producer ):
         self.queue.put( (msg, s3key) ) 
         self._start()
 
+    def _notify(self, routing_key):
+        #The write threads signal once each PUT has completed
+        pass
+
+    def send_many( self, msgs, **kwargs ):
+        """
+        Enqueues the whole batch for the write threads.  Results only reflect whether a
+        message was queued, see join() for the outcome of the writes.
+        """
+        rkey = kwargs.get( 'routing_key', self.routing_key ).upper()
+        msgs = list( msgs )
+        key_names = kwargs.get( 'key_names' ) or \
+                    self._create_key_names( rkey, len( msgs ), attributes=kwargs.get( 'attributes' ) )
+        bucket = self.bucket
+        items = [(msg, bucket.new_key( key_name=key_name )) for msg, key_name in zip( msgs, key_names )]
+
+        for item in items:
+            self.queue.put_nowait( item )
+        self._start()
+
+        return [SendResult( msg, key_name, None ) for msg, key_name in zip( msgs, key_names )]
+
     def join( self ):
-        """ Blocks until all messages have been processed/sent """
+        """
+        Blocks until all messages have been processed/sent.  Returns the WriteReport of the
+        messages written since the previous join().
+        """
         self.queue.join()
+        with self._report_lock:
+            report, self.report = self.report, self._new_report()
+        return report
 
 
 
@@ -236,10 +731,45 @@ class Producer( BaseProducer ):
         for broker in brokers:
             self.brokers.append( broker( **kwargs ) )
 
+    def _key_broker( self ):
+        """ The first S3 broker, which names the message for every broker. """
+        for broker in self.brokers:
+            if isinstance( broker, S3Producer ):
+                return broker
+        return None
+
     def send( self, msg, **kwargs):
         """
-        Send the message via all available producer brokers.
+        Send the message via all available producer brokers.  When one of them is an
+        S3Producer its key name is generated once and passed to all of them as key_name.
         """
+        s3 = self._key_broker()
+        if s3 is not None and 'key_name' not in kwargs:
+            kwargs['key_name'] = s3._create_key_name( kwargs.get( 'routing_key', s3.routing_key ).upper(),
+                                                      shard_key=kwargs.get( 'shard_key' ),
+                                                      attributes=kwargs.get( 'attributes' ) )
         for broker in self.brokers:
             broker.send( msg, **kwargs )
 
+    def send_many( self, msgs, **kwargs ):
+        """
+        Hands the whole batch to each broker.  A message is only reported as successful
+        if every broker sent it; otherwise the first broker error is reported.
+        """
+        msgs = list( msgs )
+        results = [SendResult( msg, None, None ) for msg in msgs]
+
+        s3 = self._key_broker()
+        if s3 is not None and 'key_names' not in kwargs:
+            kwargs['key_names'] = s3._create_key_names( kwargs.get( 'routing_key', s3.routing_key ).upper(),
+                                                        len( msgs ), attributes=kwargs.get( 'attributes' ) )
+
+        for broker in self.brokers:
+            for i, result in enumerate( broker.send_many( msgs, **kwargs ) ):
+                current = results[ i ]
+                results[ i ] = SendResult( 
+                        current.msg, 
+                        current.key or result.key, 
+                        current.error or result.error )
+        return results
+
@@ -0,0 +1,184 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Retention for routing keys.  Deletes messages (and compacted segments)
+" that are older than a maximum age and/or have been consumed by every
+" registered cursor, using batched DeleteObjects requests issued in parallel.
+"
+"""
+from __future__ import absolute_import
+import argparse
+import sys
+from   itertools import chain
+from   datetime import datetime, timedelta
+
+from   muskrat.util import config_loader, s3_resource, shard_prefixes, key_prefix, key_timestamp, delete_keys
+from   muskrat.segments import segment_prefix, segment_key_name
+from   muskrat.s3consumer import load_cursors
+
+
+class Retention(object):
+
+    def __init__(self, routing_key, config='config.py', max_age=None, consumed=False, cursors=None,
+                 shards=None, dry_run=False, progress=None, workers=8):
+        """
+        Messages are deleted only if they satisfy every enabled policy.
+
+        routing_key
+            Routing key to expire messages for.
+        max_age
+            Delete messages older than this many seconds.
+        consumed
+            Delete messages that every registered cursor has consumed.  Cursors are read from
+            the config's s3_cursor location.
+        cursors
+            Names of the cursors that must have consumed a message.  A listed cursor without
+            a position blocks all deletes.  Required when consumed is the only policy, since a
+            consumer that has not written its first cursor would not be waited for.  With
+            max_age it defaults to every cursor in the cursor location positioned on this
+            routing key.
+        shards
+            Number of shards the routing key is written under.  Defaults to the config's
+            s3_shards setting.
+        dry_run
+            Only count the messages that would be deleted.
+        progress
+            Optional callable issued with (prefix, running total) as deletes complete.
+        workers
+            Number of concurrent DeleteObjects requests.
+        """
+        if max_age is None and not consumed:
+            raise ValueError( 'A max_age or consumed policy is required' )
+        if consumed and max_age is None and not cursors:
+            raise ValueError( 'The cursors that must have consumed a message are required without a max_age' )
+
+        self.config = config_loader( config )
+        self.routing_key = routing_key.upper()
+        self.max_age = max_age
+        self.consumed = consumed
+        self.cursors = cursors
+        self.shards = shards or getattr( self.config, 's3_shards', None )
+        self.dry_run = dry_run
+        self.progress = progress
+        self.workers = workers
+
+    @property
+    def bucket(self):
+        return s3_resource( self.config ).Bucket( self.config.s3_bucket )
+
+    def _prefixes(self):
+        prefix = self.routing_key.replace( '.', '/' )
+        if self.shards:
+            return shard_prefixes( prefix, self.shards )
+        return [prefix]
+
+    def consumed_positions(self):
+        """
+        Returns a dict of prefix -> position every registered cursor has consumed up to.  A
+        prefix missing from the dict has nothing that is safe to delete.
+        """
+        prefixes = set( self._prefixes() )
+        cursors = load_cursors( self.config.s3_cursor['location'] )
+
+        positions = {}
+        for name, keys in cursors.items():
+            if self.cursors is not None and name not in self.cursors:
+                continue
+            for key in keys:
+                prefix = key_prefix( key )
+                if prefix in prefixes:
+                    positions.setdefault( prefix, {} )[ name ] = key
+
+        required = set( self.cursors ) if self.cursors is not None else None
+        consumed = {}
+        for prefix, by_cursor in positions.items():
+            if required is not None and not required.issubset( by_cursor ):
+                continue
+            consumed[ prefix ] = min( by_cursor.values() )
+        return consumed
+
+    def _deletable(self, collection, cutoff, position):
+        """ Yields keys of the ordered collection until the first one a policy keeps. """
+        for obj in collection:
+            if cutoff is not None and key_timestamp( obj.key ) >= cutoff:
+                break
+            if position is not None and obj.key > position:
+                break
+            yield obj.key
+
+    def expire_prefix(self, prefix, cutoff=None, position=None):
+        """
+        Deletes (or counts, in dry run mode) the expired messages and fully expired segments
+        under a routing key (or shard) prefix.  Returns the number of objects.
+        """
+        bucket = self.bucket
+        live = bucket.objects.filter( Prefix=prefix + '/' ).filter( Delimiter='/' )
+        segments = bucket.objects.filter( Prefix=segment_prefix( prefix ) + '/' ).filter( Delimiter='/' )
+
+        #Segments are named after their last message, so compare them in segment key space
+        segment_position = segment_key_name( prefix, position ) if position is not None else None
+
+        keys = chain( self._deletable( segments, cutoff, segment_position ),
+                      self._deletable( live, cutoff, position ) )
+
+        if self.dry_run:
+            count = 0
+            for key in keys:
+                count += 1
+                if self.progress and count % 1000 == 0:
+                    self.progress( prefix, count )
+            return count
+
+        progress = None
+        if self.progress:
+            progress = lambda deleted: self.progress( prefix, deleted )
+        return delete_keys( bucket, keys, workers=self.workers, progress=progress )
+
+    def run(self):
+        """
+        Applies the retention policies to every prefix of the routing key.  Returns a dict of
+        prefix -> number of objects deleted (or that would be deleted).
+        """
+        cutoff = None
+        if self.max_age is not None:
+            cutoff = ( datetime.today() - timedelta( seconds=self.max_age ) ).strftime( self.config.s3_timestamp_format )
+
+        consumed = self.consumed_positions() if self.consumed else {}
+
+        results = {}
+        for prefix in self._prefixes():
+            position = None
+            if self.consumed:
+                if prefix not in consumed:
+                    results[ prefix ] = 0
+                    continue
+                position = consumed[ prefix ]
+            results[ prefix ] = self.expire_prefix( prefix, cutoff=cutoff, position=position )
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser( description='Delete expired or fully consumed messages of routing keys.' )
+    parser.add_argument( 'routing_keys', nargs='+', help='Routing keys to apply retention to' )
+    parser.add_argument( '--config', default='config.py', help='Path to the muskrat config file' )
+    parser.add_argument( '--max-age', type=float, help='Delete messages older than this many seconds' )
+    parser.add_argument( '--consumed', action='store_true', help='Delete messages consumed by every cursor' )
+    parser.add_argument( '--cursor', action='append', dest='cursors', help='Cursor that must have consumed a message (repeatable, required for --consumed without --max-age)' )
+    parser.add_argument( '--shards', type=int, help='Number of shards the routing keys are written under' )
+    parser.add_argument( '--dry-run', action='store_true', help='Only report what would be deleted' )
+    args = parser.parse_args( argv )
+
+    def progress( prefix, count ):
+        sys.stderr.write( '%s: %d\n' % (prefix, count) )
+
+    verb = 'would be deleted' if args.dry_run else 'deleted'
+    for routing_key in args.routing_keys:
+        retention = Retention( routing_key, config=args.config, max_age=args.max_age, consumed=args.consumed,
+                               cursors=args.cursors, shards=args.shards, dry_run=args.dry_run, progress=progress )
+        for prefix, count in sorted( retention.run().items() ):
+            print( '%s: %d objects %s' % (prefix, count, verb) )
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,209 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Retry policies with exponential backoff and jitter, classification of
+" retryable S3 errors, retry budgets that cap retries to a share of recent
+" requests, and a spill file for writes that failed for good.
+"
+"""
+from __future__ import absolute_import
+import base64
+import random
+import socket
+import threading
+import time
+from   collections import deque
+from   datetime import datetime
+
+try: import simplejson as json
+except ImportError: import json
+
+from   muskrat.concurrency import RequestTimeout, is_throttle
+
+#S3 error codes worth another try.  Anything else in the 4xx range will fail again.
+RETRYABLE_CODES = ('SlowDown', 'RequestTimeout', 'RequestTimeTooSkewed', 'InternalError', 'ServiceUnavailable',
+                   'OperationAborted')
+
+#botocore connection errors, matched by name so boto3 is not imported here
+RETRYABLE_NAMES = ('EndpointConnectionError', 'ConnectionClosedError', 'ReadTimeoutError', 'ConnectTimeoutError')
+
+try:
+    #Not every OSError is a network error (PermissionError, FileNotFoundError, ...)
+    NETWORK_ERRORS = ( ConnectionError, TimeoutError, socket.timeout )
+except NameError:
+    #Python 2, where socket.error is only raised by sockets
+    NETWORK_ERRORS = ( socket.error, socket.timeout )
+
+
+def is_retryable( error ):
+    """
+    Returns true if a failed S3 request may succeed when repeated: throttles, timeouts,
+    connection errors and 5xx responses.  Client errors (4xx) and programming errors are
+    fatal.  Handles boto S3ResponseError and boto3/botocore ClientError.
+    """
+    if is_throttle( error ) or isinstance( error, RequestTimeout ):
+        return True
+
+    code = getattr( error, 'error_code', None )
+    status = getattr( error, 'status', None )
+    response = getattr( error, 'response', None )
+    if isinstance( response, dict ):
+        code = response.get( 'Error', {} ).get( 'Code' )
+        status = response.get( 'ResponseMetadata', {} ).get( 'HTTPStatusCode' )
+    if code in RETRYABLE_CODES:
+        return True
+    if isinstance( status, int ):
+        return status >= 500
+
+    #Connection resets, refusals and timeouts
+    return isinstance( error, NETWORK_ERRORS ) or type( error ).__name__ in RETRYABLE_NAMES
+
+
+class RetryBudget(object):
+    """
+    Caps retries to a share of the requests made over a sliding window, plus a small
+    reserve, so a widespread outage does not multiply the load with retries.  Thread safe.
+    """
+    def __init__( self, ratio=0.2, min_per_second=10, window=10 ):
+        """
+        ratio
+            Retries allowed per request made in the window.
+        min_per_second
+            Retries always allowed per second, so a trickle of requests can still retry.
+        window
+            Length of the sliding window in seconds.
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+
+        #[second, requests, retries] per second of the window
+        self._buckets = deque()
+        self._lock = threading.Lock()
+        self.exhausted = 0
+
+    def _bucket( self, now ):
+        second = int( now )
+        while self._buckets and self._buckets[0][0] <= second - self.window:
+            self._buckets.popleft()
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append( [second, 0, 0] )
+        return self._buckets[-1]
+
+    def deposit( self ):
+        """ Records a first attempt. """
+        with self._lock:
+            self._bucket( time.time() )[1] += 1
+
+    def withdraw( self ):
+        """ Returns true, and records the retry, if the budget allows one more. """
+        with self._lock:
+            bucket = self._bucket( time.time() )
+            requests = sum( b[1] for b in self._buckets )
+            retries = sum( b[2] for b in self._buckets )
+            if retries >= self.min_per_second * self.window + self.ratio * requests:
+                self.exhausted += 1
+                return False
+            bucket[2] += 1
+            return True
+
+    def stats( self ):
+        with self._lock:
+            self._bucket( time.time() )
+            return {
+                'requests':sum( b[1] for b in self._buckets ),
+                'retries':sum( b[2] for b in self._buckets ),
+                'exhausted':self.exhausted,
+            }
+
+
+class RetryPolicy(object):
+
+    def __init__( self, attempts=3, base_delay=0.1, max_delay=10.0, jitter=True, retryable=None, budget=None ):
+        """
+        attempts
+            Total number of tries, including the first one.
+        base_delay
+            Delay in seconds before the first retry.  Doubles with every further retry.
+        max_delay
+            Upper bound of the delay between tries.
+        jitter
+            Randomize each delay between 0 and its backoff value so retries from many
+            workers do not line up.
+        retryable
+            Optional predicate over the exception deciding whether it is worth retrying (see
+            is_retryable).  Defaults to retrying every exception.
+        budget
+            Optional RetryBudget shared by everything using the policy.
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retryable = retryable
+        self.budget = budget
+
+    def delay( self, attempt ):
+        """ Seconds to wait after the given (1 based) failed attempt. """
+        delay = min( self.max_delay, self.base_delay * 2 ** ( attempt - 1 ) )
+        if self.jitter:
+            delay = random.uniform( 0, delay )
+        return delay
+
+    def should_retry( self, error, attempt ):
+        """ True if the given (1 based) failed attempt should be followed by another. """
+        if attempt >= self.attempts:
+            return False
+        if self.retryable is not None and not self.retryable( error ):
+            return False
+        return self.budget is None or self.budget.withdraw()
+
+    def call( self, func, *args, **kwargs ):
+        """
+        Calls func until it returns or no further attempt is allowed, in which case the last
+        exception is raised.
+        """
+        if self.budget is not None:
+            self.budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                return func( *args, **kwargs )
+            except Exception as e:
+                if not self.should_retry( e, attempt ):
+                    raise
+            time.sleep( self.delay( attempt ) )
+            attempt += 1
+
+
+class SpillFile(object):
+    """
+    Local file of messages that could not be written, one JSON object per line with the
+    body base64 encoded.  Read it back with read_spill to resend them.  Thread safe.
+    """
+    def __init__( self, path ):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write( self, key, body, error ):
+        if not isinstance( body, bytes ):
+            body = body.encode( 'utf-8' )
+        line = json.dumps( {
+            'key':key,
+            'error':repr( error ),
+            'failed_at':datetime.today().isoformat(),
+            'body':base64.b64encode( body ).decode( 'ascii' ),
+        } )
+        with self._lock:
+            with open( self.path, 'a' ) as f:
+                f.write( line + '\n' )
+
+
+def read_spill( path ):
+    """ Yields (key, body) of the messages in a spill file. """
+    with open( path, 'r' ) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads( line )
+                yield entry['key'], base64.b64decode( entry['body'] )
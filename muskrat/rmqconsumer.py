@@ -8,12 +8,13 @@
 "
 """
 from __future__ import absolute_import
-import exceptions
 from collections import defaultdict
 from functools   import wraps
 
 import pika
-from config      import CONFIG
+from muskrat.util import config_loader
+from muskrat.serializers import get_serializer
+from muskrat.claimcheck import ClaimResolver
 
 
 class ConsumerNameError( Exception ):
@@ -22,6 +23,83 @@ class ConsumerNameError( Exception ):
 class ChannelNotFound( Exception ):
     pass
 
+
+class BatchCollector(object):
+    """
+    Accumulates deliveries for a batch consumer and hands them to the wrapped function
+    as a single list.  A batch is flushed once it holds `size` messages or `timeout`
+    milliseconds after its first message arrived, whichever comes first.
+
+    The whole batch is acknowledged with a single multiple=True ack when the function
+    returns.  If the function raises, the batch is nacked (and optionally requeued)
+    before the exception is passed to on_error( error, messages ) or, without one,
+    re-raised.
+    """
+    def __init__(self, pool, func, size, timeout, requeue=True, serializer=None, on_error=None):
+        self.pool = pool
+        self.func = func
+        self.size = size
+        self.timeout = timeout
+        self.requeue = requeue
+        self.on_error = on_error
+        self.serializer = get_serializer( serializer ) if serializer else None
+
+        self.channel = None
+        self.messages = []
+        self._timer = None
+
+        #Let the pool name the channel/queue after the wrapped function
+        self.__module__ = getattr( func, '__module__', '' )
+        self.__name__ = func.__name__
+
+    def __call__(self, channel, method, header, body):
+        self.channel = channel
+        self.messages.append( (method, header, body) )
+
+        if len( self.messages ) >= self.size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._call_later( self.timeout / 1000.0, self.flush )
+
+    def _call_later(self, delay, callback):
+        connection = self.pool._connection
+        call_later = getattr( connection, 'call_later', None ) or connection.add_timeout
+        return call_later( delay, callback )
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self.pool._connection.remove_timeout( self._timer )
+            self._timer = None
+
+    def flush(self):
+        """
+        Issues the callback with the pending batch and acks or nacks it as a whole.
+        """
+        self._cancel_timer()
+        if not self.messages:
+            return
+
+        messages, self.messages = self.messages, []
+        delivery_tag = messages[-1][0].delivery_tag
+
+        try:
+            #Claim checked payloads of the batch are fetched concurrently
+            messages = self.pool.claims.resolve_many( messages )
+            if self.serializer is not None:
+                bodies = self.serializer.loads_many( [body for method, header, body in messages] )
+                messages = [(method, header, body) for (method, header, raw), body in zip( messages, bodies )]
+            self.func( self.channel, messages )
+        except Exception as e:
+            #Nothing of the batch is acked when it cannot be fetched, decoded or handled
+            self.channel.basic_nack( delivery_tag=delivery_tag, multiple=True, requeue=self.requeue )
+            if self.on_error is None:
+                raise
+            self.on_error( e, messages )
+            return
+
+        self.channel.basic_ack( delivery_tag=delivery_tag, multiple=True )
+
+
 class ConsumerPool(object):
     """
     Consumer object the holds a connection to rabbitmq, and all channels that message
@@ -29,16 +107,34 @@ class ConsumerPool(object):
 
     This class gets most of it's benefit by providing a decorator function that allows functions
     to register with this consumer object on specificed routing_keys.
+
+    Deliveries claim checked by RabbitMQProducer (see muskrat.claimcheck) are resolved into
+    their payload before the registered function is called.
     """
-    def __init__(self):
+    def __init__(self, config='config.py', claims=None):
+        """
+        config
+            Path to a python config file, a config object or a dict.
+        claims
+            muskrat.claimcheck.ClaimResolver used to fetch claim checked payloads.  Defaults to
+            one created from the config on first use.
+        """
+        self.config = config_loader( config )
         self.channels = {}
+        self._claims = claims
 
-        self._conn_params = pika.ConnectionParameters( CONFIG.host )
+        self._conn_params = pika.ConnectionParameters( self.config.host )
 
-        self._exchange_name = CONFIG.exchange_name
-        self._exchange_type = CONFIG.exchange_type
+        self._exchange_name = self.config.exchange_name
+        self._exchange_type = self.config.exchange_type
     
 
+    @property
+    def claims( self ):
+        if self._claims is None:
+            self._claims = ClaimResolver( self.config )
+        return self._claims
+
     def connect( self ):
         """
         Creates a connectino with rabbitmq.
@@ -91,7 +187,9 @@ class ConsumerPool(object):
         """
         #this needs to be able to get a channel from the connection and then
         #re-bind it to a specified queue
-        self.register_consumer( self.channels[ name ][ 'callback' ], self.channels[ name ]['routing_key'] )
+        self.register_consumer( self.channels[ name ][ 'callback' ], 
+                                self.channels[ name ]['routing_key'],
+                                prefetch_count=self.channels[ name ].get( 'prefetch_count' ) )
 
 
     def reconnect_channels( self ):
@@ -178,13 +276,18 @@ class ConsumerPool(object):
         else:
             raise ChannelNotFound( '%s is not a known channel name' % name )
 
-    def register_consumer(self, func, routing_key ):
+    def register_consumer(self, func, routing_key, prefetch_count=None ):
         """
         Sets up all items we need for a channel to start consuming based on the name of the func and the routing_key.
+
+        prefetch_count
+            Optional limit on unacknowledged messages delivered to this channel.
         """
         routing_key=routing_key.upper()
         channel = self._connection.channel()
-        channel.exchange_declare( exchange=self._exchange_name, type=self._exchange_type )
+        channel.exchange_declare( exchange=self._exchange_name, exchange_type=self._exchange_type )
+        if prefetch_count:
+            channel.basic_qos( prefetch_count=prefetch_count )
 
         #Make a name for this queue that can be re-attached to at a later point in the case that the
         #managing consumer dies.  Also, for our own management, attach this name to the channel we
@@ -200,14 +303,15 @@ class ConsumerPool(object):
                             routing_key=routing_key)
 
         #Setup our callback as this function
-        channel.basic_consume( func, queue=queue.method.queue )
+        channel.basic_consume( queue=queue.method.queue, on_message_callback=func )
 
         #Store this information so that we have it again in the case that the channel is closed unexpectedly and we
         #need to re-construct this interface
-        self.channels[ channel_name ] = {'channel':channel, 'queue':queue, 'routing_key':routing_key, 'callback':func }
+        self.channels[ channel_name ] = {'channel':channel, 'queue':queue, 'routing_key':routing_key, 'callback':func,
+                                         'prefetch_count':prefetch_count }
 
 
-    def consumer(self, routing_key):
+    def consumer(self, routing_key, serializer=None):
         """
         Decorator function that will attach the decorated function to a RabbitMQ queue
         defined for the specified routing key.
@@ -223,9 +327,21 @@ class ConsumerPool(object):
 
         routing_key
             The key defining the messages that the consumer will subscribe to.
+        serializer
+            Optional serializer name (see muskrat.serializers).  When set, the body passed
+            to the function is the decoded object.
         """
         def decorator(func):
-            self.register_consumer( func, routing_key )
+            loads = get_serializer( serializer ).loads if serializer else None
+
+            @wraps(func)
+            def callback(channel, method, header, body):
+                body = self.claims.resolve( header, body )
+                if loads is not None:
+                    body = loads( body )
+                return func( channel, method, header, body )
+
+            self.register_consumer( callback, routing_key )
 
             @wraps(func)
             def wrapper(*args, **kwargs):
@@ -234,3 +350,46 @@ class ConsumerPool(object):
                 return func(*args, **kwargs)
             return wrapper
         return decorator
+
+
+    def batch_consumer(self, routing_key, size=100, timeout=500, requeue=True, serializer=None, on_error=None):
+        """
+        Decorator function that registers the decorated function as a batch consumer.  Messages
+        are gathered until `size` messages are waiting or `timeout` milliseconds have passed since
+        the first one arrived, then the function is called once with the whole batch.
+
+            example:
+            cons = ConsumerPool()
+            @cons.batch_consumer( 'Frontend.Customer.Test', size=500, timeout=250 )
+            def insertMessages(channel, messages):
+                for method, header, body in messages:
+                    print '%s' % body
+
+        The batch is acked with a single multiple=True ack once the function returns.  If the
+        function raises, the batch is nacked and requeued (unless requeue is False).
+
+        routing_key
+            The key defining the messages that the consumer will subscribe to.
+        size
+            Maximum number of messages per batch.  Also used as the channel prefetch count.
+        timeout
+            Maximum time in milliseconds a partial batch waits before it is flushed.
+        requeue
+            Whether a failed batch is requeued or dropped/dead-lettered by the broker.
+        serializer
+            Optional serializer name (see muskrat.serializers) used to decode the bodies.
+        on_error
+            Optional function issued with (error, messages) once a failed batch was nacked,
+            instead of raising the error out of start_consumers().
+        """
+        def decorator(func):
+            collector = BatchCollector( self, func, size, timeout, requeue=requeue, serializer=serializer,
+                                        on_error=on_error )
+            self.register_consumer( collector, routing_key, prefetch_count=size )
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                return func(*args, **kwargs)
+            wrapper.collector = collector
+            return wrapper
+        return decorator
@@ -0,0 +1,224 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Runtime that multiplexes many S3 consumers in one process.  Instead of a
+" consumption_loop (and a process or thread) per consumer, consumers are
+" registered with a Runtime that schedules their consume calls on a single
+" asyncio event loop and runs them on a shared fetch pool.
+"
+" Scheduling is weighted fair: every run of a consumer is bounded to a
+" quantum of messages and charged to its virtual time in proportion to the
+" messages handled over its weight.  The consumer with the smallest virtual
+" time runs next.  Consumers that stopped at the quantum (and so have a
+" backlog) run again right away and win ties over consumers that are merely
+" due for a poll; caught up consumers are not polled again until their
+" interval has passed, and rejoin at the virtual time of the least served
+" backlogged consumer.
+"
+"""
+from __future__ import absolute_import
+import asyncio
+from   concurrent.futures import ThreadPoolExecutor
+
+
+class ScheduledConsumer(object):
+    """ Scheduling state of a consumer registered with a Runtime. """
+    def __init__( self, consumer, weight=1.0, interval=2 ):
+        self.consumer = consumer
+        self.weight = float( weight )
+        self.interval = interval
+
+        self.vtime = 0.0
+        self.next_run = 0.0
+        #Unknown until the first run, so assume there is one
+        self.backlog = True
+        self.running = False
+
+        self.runs = 0
+        self.messages = 0
+        self.errors = 0
+        self.last_error = None
+
+    @property
+    def name( self ):
+        return self.consumer.name
+
+    def stats( self ):
+        return {
+            'routing_key':self.consumer.routing_key,
+            'weight':self.weight,
+            'runs':self.runs,
+            'messages':self.messages,
+            'errors':self.errors,
+            'backlog':self.backlog,
+            'last_error':repr( self.last_error ) if self.last_error is not None else None,
+        }
+
+
+class Runtime(object):
+
+    def __init__( self, fetch_workers=16, callback_workers=None, quantum=100, interval=2, on_error=None ):
+        """
+        fetch_workers
+            Size of the shared pool consume calls (LIST, GET and callbacks of consumers without
+            their own concurrency) run on.  Also the number of consumers running at once.
+        callback_workers
+            Size of the shared pool callbacks of consumers registered with max_in_flight run
+            on.  Defaults to fetch_workers.
+        quantum
+            Maximum number of messages a consumer handles per run.
+        interval
+            Default seconds between polls of a caught up consumer.
+        on_error
+            Optional callable issued with (consumer, exception) when a run fails.  The
+            consumer is retried after its interval either way.
+        """
+        self.fetch_workers = fetch_workers
+        self.callback_workers = callback_workers or fetch_workers
+        self.quantum = quantum
+        self.interval = interval
+        self.on_error = on_error
+
+        self.consumers = []
+        self._fetch_pool = None
+        self._callback_pool = None
+        self._loop = None
+        self._wakeup = None
+        self._stopped = False
+
+    @property
+    def callback_pool( self ):
+        if self._callback_pool is None:
+            self._callback_pool = ThreadPoolExecutor( max_workers=self.callback_workers )
+        return self._callback_pool
+
+    def register( self, consumer, weight=1, max_in_flight=None, interval=None ):
+        """
+        Adds a consumer to the runtime.  Returns its scheduling state.
+
+        consumer
+            An S3Consumer, or a function decorated with muskrat.s3consumer.Consumer.
+        weight
+            Share of the runtime's throughput the consumer gets while others have a backlog.
+        max_in_flight
+            Run this consumer's callbacks concurrently, at most this many at once, on the
+            runtime's shared callback pool.
+        interval
+            Seconds between polls once the consumer is caught up.  Defaults to the runtime's.
+        """
+        consumer = getattr( consumer, 'consumer', consumer )
+        if max_in_flight:
+            consumer.workers = max_in_flight
+            consumer.max_in_flight = max_in_flight
+            consumer.executor = consumer._executor = self.callback_pool
+
+        entry = ScheduledConsumer( consumer, weight=weight, interval=interval or self.interval )
+        #Start new consumers level with the others so they neither starve nor get starved
+        entry.vtime = self._min_vtime()
+        self.consumers.append( entry )
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe( self._wakeup.set )
+        return entry
+
+    def _min_vtime( self ):
+        active = [entry.vtime for entry in self.consumers if entry.backlog or entry.running]
+        return min( active ) if active else max( [entry.vtime for entry in self.consumers] or [0.0] )
+
+    def _ready( self, now ):
+        """ Idle consumers due to run by virtual time, backlogged ones first on ties. """
+        ready = [entry for entry in self.consumers if not entry.running and entry.next_run <= now]
+        ready.sort( key=lambda entry: (entry.vtime, not entry.backlog) )
+        return ready
+
+    def _finished( self, entry, now, handled=0, error=None ):
+        entry.running = False
+        entry.runs += 1
+        if error is not None:
+            entry.errors += 1
+            entry.last_error = error
+            entry.backlog = False
+            entry.next_run = now + entry.interval
+            if self.on_error is not None:
+                self.on_error( entry.consumer, error )
+            return
+
+        entry.messages += handled
+        #Polls that find nothing still cost a LIST, so they are charged as one message
+        entry.vtime += max( handled, 1 ) / entry.weight
+        entry.backlog = handled >= self.quantum
+        entry.next_run = now if entry.backlog else now + entry.interval
+
+    async def _schedule( self ):
+        loop = self._loop
+        running = {}
+        self._wakeup = asyncio.Event()
+
+        while not self._stopped:
+            now = loop.time()
+            for entry in self._ready( now )[ :self.fetch_workers - len( running ) ]:
+                if not entry.backlog:
+                    #Waking from idle must not buy a burst on credit built up while idle
+                    entry.vtime = max( entry.vtime, self._min_vtime() )
+                entry.running = True
+                future = loop.run_in_executor( self._fetch_pool, entry.consumer.consume, self.quantum )
+                running[ future ] = entry
+
+            #With the pool full only a finished run can let another consumer go
+            pending = [entry.next_run for entry in self.consumers if not entry.running]
+            timeout = None
+            if pending and len( running ) < self.fetch_workers:
+                timeout = max( 0, min( pending ) - now )
+
+            self._wakeup.clear()
+            wakeup = loop.create_task( self._wakeup.wait() )
+            done, _ = await asyncio.wait( list( running ) + [wakeup], timeout=timeout,
+                                          return_when=asyncio.FIRST_COMPLETED )
+            wakeup.cancel()
+
+            now = loop.time()
+            for future in done:
+                if future is wakeup:
+                    continue
+                entry = running.pop( future )
+                error = future.exception()
+                if error is not None:
+                    self._finished( entry, now, error=error )
+                else:
+                    self._finished( entry, now, handled=future.result() or 0 )
+
+        if running:
+            await asyncio.wait( list( running ) )
+
+    def run( self ):
+        """ Runs the registered consumers until stop() is called or the process is interrupted. """
+        self._stopped = False
+        self._fetch_pool = ThreadPoolExecutor( max_workers=self.fetch_workers )
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete( self._schedule() )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._fetch_pool.shutdown()
+            self._loop.close()
+            self._loop = self._wakeup = None
+            self.close()
+
+    def stop( self ):
+        """ Stops the runtime once the consumers running now have finished their run.  Thread safe. """
+        self._stopped = True
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe( self._wakeup.set )
+
+    def close( self ):
+        """ Closes every consumer and the shared callback pool. """
+        for entry in self.consumers:
+            entry.consumer.close()
+        if self._callback_pool is not None:
+            self._callback_pool.shutdown()
+            self._callback_pool = None
+
+    def stats( self ):
+        """ Scheduling counters per consumer name. """
+        return dict( (entry.name, entry.stats()) for entry in self.consumers )
@@ -8,11 +8,21 @@
 "
 """
 from __future__ import absolute_import
+import heapq
 import os
 import time
-
-import boto3
-from   muskrat.util import config_loader
+from   itertools import islice
+from   concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from   datetime import datetime, timedelta
+
+from   muskrat.util import config_loader, shard_prefixes, key_prefix, key_timestamp, key_attributes, s3_resource
+from   muskrat.segments import SegmentedCollection, SegmentMessage
+from   muskrat.dedupe import KeyDeduper, DEDUPE_SUFFIX, JOURNAL_SUFFIX
+from   muskrat.concurrency import LowWatermark, Hedger, get_hedger
+from   muskrat.retry import RetryPolicy
+from   muskrat.serializers import get_serializer
+from   muskrat.columnar import to_columns, invalid_rows
+from   muskrat.notify import Listener, notify_location
 
 class S3Cursor(object):
     def __init__(self, name, type, **kwargs ):
@@ -90,34 +100,238 @@ class S3Cursor(object):
         collection = self.filter_collection(collection)
         return self.persist_progress(collection)
 
+    def advance(self, keys):
+        """Moves the cursor past all of the supplied (ordered) keys in a single write."""
+        if keys:
+            self.update(keys[-1])
 
-class S3Consumer(object):
 
-    def __init__(self, routing_key, func, name=None, config='config.py'):
+class ShardedS3Cursor(S3Cursor):
+    """
+    Composite cursor for sharded routing keys.  Records one position per shard prefix;
+    the file cursor stores one key per line.
+    """
+
+    def _get_file_cursor(self):
+        try:
+            with open(self.filename, 'r') as file:
+                return file.read()
+        except IOError:
+            return None
+
+    def get_positions(self):
+        """Returns a dict of shard prefix -> last consumed key in that shard."""
+        cursor = self.get()
+        if not cursor:
+            return {}
+        return dict((key_prefix(key), key) for key in cursor.split('\n') if key)
+
+    def update(self, key):
+        self.advance([key])
+
+    def advance(self, keys):
+        if not keys:
+            return
+        positions = self.get_positions()
+        for key in keys:
+            positions[key_prefix(key)] = key
+        self._update_func('\n'.join(sorted(positions.values())))
+
+    def filter_collection(self, collections):
+        """
+        Lists every shard concurrently from its own position and merges the results
+        back into timestamp order.
+
+        collections
+            dict of shard prefix -> s3 object collection for that prefix.
+        """
+        return merge_shards(collections, self.get_positions())
+
+
+def merge_shards(collections, positions):
+    """
+    Lists shard collections concurrently, each after its position, and merges them into
+    timestamp order.
+
+    collections
+        dict of shard prefix -> s3 object collection for that prefix.
+    positions
+        dict of shard prefix -> key to list after.  Shards without one are listed in full.
+    """
+    def list_shard(item):
+        prefix, collection = item
+        marker = positions.get(prefix)
+        if marker:
+            collection = collection.filter(Marker=marker)
+        return list(collection.filter(Delimiter='/'))
+
+    with ThreadPoolExecutor(max_workers=max(1, len(collections))) as pool:
+        listings = list(pool.map(list_shard, collections.items()))
+
+    return heapq.merge(*listings, key=lambda obj: (key_timestamp(obj.key), obj.key))
+
 
+def load_cursors(location):
+    """
+    Reads every file cursor in a cursor directory.  Returns a dict of cursor name -> list of
+    positions (one per shard for sharded cursors).
+    """
+    from muskrat.state import STATE_SUFFIX
+    from muskrat.window import WINDOW_SUFFIX
+    cursors = {}
+    try:
+        names = os.listdir(location)
+    except OSError:
+        return cursors
+
+    for name in names:
+        path = os.path.join(location, name)
+        if name.startswith('.') or not os.path.isfile(path):
+            continue
+        #Dedupe, window and consumer state is stored next to the cursors
+        if name.endswith(DEDUPE_SUFFIX) or name.endswith(DEDUPE_SUFFIX + JOURNAL_SUFFIX) or name.endswith('.tmp') or \
+                name.endswith(STATE_SUFFIX) or name.endswith(WINDOW_SUFFIX):
+            continue
+        with open(path, 'r') as file:
+            positions = [line.strip() for line in file.read().split('\n') if line.strip()]
+        if positions:
+            cursors[name] = positions
+    return cursors
+
+
+def _run_shared(callback, name, size, serializer=None, retry=None):
+    """
+    Runs a callback in a worker process with a body handed over through shared memory
+    rather than pickled with the call.
+    """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        body = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+    if serializer:
+        body = get_serializer(serializer).loads(body)
+    if retry is not None:
+        return retry.call(callback, body)
+    return callback(body)
+
+
+class S3Consumer(object):
+
+    def __init__(self, routing_key, func, name=None, config='config.py', serializer=None, shards=None, segments=None,
+                 match=None, dedupe=None, workers=None, executor='thread', max_in_flight=None,
+                 retry=None, dead_letter=False, hedge=None, notify=None):
+        """
+        routing_key
+            The key defining the messages that the consumer will subscribe to.
+        func
+            Callback issued with each message.
+        name
+            Name of the cursor.  Defaults to the module and name of func.
+        serializer
+            Optional serializer name (see muskrat.serializers).  When set, the callback
+            receives decoded objects instead of raw message bodies.
+        shards
+            Number of shard sub-prefixes the routing key is written under.  Must match the
+            producers.  Defaults to the config's s3_shards setting.
+        segments
+            Read messages compacted into segment objects (see muskrat.compaction).  Defaults
+            to on when the config has an s3_compaction setting.  'archived' reads segments
+            written by muskrat.archiver, which are new rather than compacted, so the compaction
+            max_age cutoff does not apply.
+        match
+            Optional predicate over the attributes producers encoded in the key name (a dict of
+            strings).  Messages it rejects are skipped without being fetched.
+        dedupe
+            Skip messages that were already processed, for example after a crash between a
+            callback and the cursor write.  True or a dict of muskrat.dedupe.KeyDeduper options
+            (capacity, error_rate, window, max_bytes, ...).  The recent key set is stored next
+            to the cursor.
+        workers
+            Run callbacks concurrently on this many workers.  Messages may complete out of order;
+            the cursor only advances to the low watermark, the newest key below which every
+            message has completed.  Defaults to running callbacks one at a time.
+        executor
+            'thread', 'process' or a concurrent.futures Executor to run callbacks on.  Process
+            pools need a picklable (module level) callback and receive bodies through shared
+            memory.
+        max_in_flight
+            Maximum number of messages being processed at once.  Defaults to twice workers.
+        retry
+            Number of attempts (or a muskrat.retry.RetryPolicy) for a failing callback, with
+            exponential backoff between them.  Retries sleep on the thread or worker handling
+            the message, so without workers the messages behind a failing one wait for its
+            retries.
+        dead_letter
+            Once the attempts are exhausted, write the message and error details to the
+            DLQ.<routing key> routing key and move on instead of raising.  See
+            muskrat.deadletter for redriving them.
+        hedge
+            Hedge slow GETs and bound them with a deadline (see muskrat.concurrency.Hedger).
+            True, a dict of Hedger options or a Hedger.  Defaults to the config's s3_hedging
+            setting.
+        notify
+            Let consumption_loop wake up as soon as a producer on this host signals a write
+            (see muskrat.notify) instead of sleeping out its interval.  True, a socket directory
+            or a dict with 'location' and 'min_interval' (the least seconds between polls,
+            0.1 by default).  Defaults to the config's s3_notify setting.
+        """
         self.config = config_loader( config )
         self.routing_key = routing_key.upper()
         self.callback = func
+        self.match = match
+
+        self.serializer = None
+        if serializer:
+            self.serializer = get_serializer( serializer, timeformat=getattr( self.config, 'timeformat', None ) )
 
         if not name:
             self.name = self._gen_name( self.callback )
         else:
             self.name = name
 
-        self._cursor = S3Cursor( 
+        self.shards = shards or getattr( self.config, 's3_shards', None )
+
+        self._compaction = getattr( self.config, 's3_compaction', None )
+        self.segments = segments if segments is not None else bool( self._compaction )
+        self._archived = segments == 'archived'
+        cursor_cls = ShardedS3Cursor if self.shards else S3Cursor
+
+        self._cursor = cursor_cls( 
                            self.name, 
                            type=self.config.s3_cursor['type'],
                            location=self.config.s3_cursor['location']
                        )
-                                 
+
+        self._deduper = None
+        if dedupe:
+            options = dedupe if isinstance( dedupe, dict ) else {}
+            self._deduper = KeyDeduper( self._cursor.filename + DEDUPE_SUFFIX, **options )
+
+        self.workers = workers
+        self.executor = executor
+        self.max_in_flight = max_in_flight or ( workers or 1 ) * 2
+        self._executor = executor if isinstance( executor, Executor ) else None
+
+        self.retry = RetryPolicy( attempts=retry ) if isinstance( retry, int ) else retry
+        self._dead_letters = None
+        if dead_letter:
+            from muskrat.deadletter import DeadLetterQueue
+            self._dead_letters = DeadLetterQueue( self.routing_key, config=self.config, consumer=self.name )
+
+        self.hedge = hedge if hedge is not None else getattr( self.config, 's3_hedging', None )
+        self._hedger = get_hedger( self.hedge )
+
+        self.notify = notify if notify is not None else getattr( self.config, 's3_notify', None )
+        self._notify_location = notify_location( self.notify )
+        self._min_interval = self.notify.get( 'min_interval', 0.1 ) if isinstance( self.notify, dict ) else 0.1
+        self._listener = None
 
     @property
     def s3conn(self):
-        return boto3.resource(
-            's3',
-            aws_access_key_id=self.config.s3_key,
-            aws_secret_access_key=self.config.s3_secret,
-        )
+        return s3_resource(self.config)
 
     @property
     def bucket(self):
@@ -130,31 +344,244 @@ class S3Consumer(object):
     def _gen_routing_key( self, routing_key ):
         return routing_key.replace( '.', '/' )
 
+    def _segment_cutoff(self):
+        """
+        Newest timestamp compaction could have rolled into a segment.  Cursors past it
+        skip listing segments.
+        """
+        max_age = (self._compaction or {}).get('max_age')
+        if max_age is None or self._archived:
+            return None
+        #Leave room for clock skew between the compactor and this host
+        cutoff = datetime.today() - timedelta(seconds=max_age) + timedelta(minutes=5)
+        return cutoff.strftime(self.config.s3_timestamp_format)
+
+    def _get_collection(self, prefix):
+        if self.segments:
+            return SegmentedCollection(self.bucket, prefix, cutoff=self._segment_cutoff())
+        return self.bucket.objects.filter(Prefix=prefix + '/')
+
     def _get_msg_iterator(self):
         #If marker is not matched to a key then the returned list is none.
-        prefix = self._gen_routing_key(self.routing_key) + '/'
-        msg_iterator = self.bucket.objects.filter(Prefix=prefix)
+        prefix = self._gen_routing_key(self.routing_key)
+        if self.shards:
+            #Separate bucket (and connection) per shard since they are listed concurrently
+            return dict((shard, self._get_collection(shard))
+                        for shard in shard_prefixes(prefix, self.shards))
+
+        msg_iterator = self._get_collection(prefix)
 
         return msg_iterator
 
-    def consume(self):
+    def consume(self, max_messages=None):
+        """
+        Consumes the messages available after the cursor.  Returns the number of messages
+        handled, including skipped ones.
+
+        max_messages
+            Stop after this many messages.  The cursor is left on the last message handled
+            so the next call picks up where this one stopped.
+        """
         #TODO - If the bucket is created, but no keys exist... this
         #attempts to do something. We should probably explicitly check for this.
         #Update: actually... this doesn't seem to be a problem...
+        if self.workers:
+            return self._consume_concurrently(max_messages)
+
         msg_iterator = self._get_msg_iterator()
 
-        for obj in self._cursor.each(msg_iterator):
-            self.callback(obj.get()['Body'].read())
+        #Update the cursor here rather than through S3Cursor.each, which only persists a
+        #message once the next one is requested and would lose it when stopping early
+        handled = 0
+        for obj in islice(self._cursor.filter_collection(msg_iterator), max_messages):
+            self._handle(obj)
+            self._cursor.update(obj.key)
+            handled += 1
+        return handled
+
+    def _skip(self, obj):
+        """ True if the object is filtered out or was already processed. """
+        if not self._matches(obj):
+            return True
+        return self._deduper is not None and self._deduper.seen(obj.key)
+
+    def _read(self, obj):
+        if self._hedger is None or isinstance(obj, SegmentMessage):
+            return obj.get()['Body'].read()
+        #boto3 resources are not thread safe, so the hedge reads through its own Object
+        return self._hedger.call(lambda: obj.get()['Body'].read(),
+                                 hedge=lambda: self.bucket.Object(obj.key).get()['Body'].read())
+
+    def _invoke(self, body):
+        return self.callback(self._decode(body))
+
+    def _run(self, obj):
+        body = self._read(obj)
+        try:
+            if self.retry is not None:
+                return self.retry.call(self._invoke, body)
+            return self._invoke(body)
+        except Exception as e:
+            if self._dead_letters is None:
+                raise
+            self._dead_letter(obj, body, e)
+
+    def _dead_letter(self, obj, body, error):
+        attempts = self.retry.attempts if self.retry is not None else 1
+        self._dead_letters.send(obj.key, body, error, attempts)
+
+    def _processed(self, obj):
+        if self._deduper is not None:
+            self._deduper.add(obj.key)
+
+    def _handle(self, obj):
+        """
+        Issues the callback for a single object unless it is filtered out or was already
+        processed.  Skipped messages still advance the cursor.
+        """
+        if self._skip(obj):
+            return
+        self._run(obj)
+        self._processed(obj)
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.executor == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _submit(self, executor, obj):
+        """
+        Submits a message to the executor.  Returns the future and, for process pools, the
+        shared memory holding the body and the body's length.
+        """
+        if not isinstance(executor, ProcessPoolExecutor):
+            return executor.submit(self._run, obj), None
+
+        from multiprocessing import shared_memory
+        body = self._read(obj)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(body)))
+        shm.buf[:len(body)] = body
+        serializer = self.serializer.name if self.serializer is not None else None
+        future = executor.submit(_run_shared, self.callback, shm.name, len(body), serializer, self.retry)
+        return future, (shm, len(body))
+
+    def _consume_concurrently(self, max_messages=None):
+        """
+        Runs callbacks on the executor with at most max_in_flight messages outstanding and
+        advances the cursor to the low watermark as they complete.  If a callback raises, no
+        further messages are submitted, the outstanding ones are drained and the exception is
+        re-raised with the cursor left before the failed message.
+        """
+        executor = self._get_executor()
+        watermark = LowWatermark()
+        futures = {}
+        errors = []
+
+        def collect(done):
+            for future in done:
+                obj, shared = futures.pop(future)
+                error = future.exception()
+                if error is not None and shared is not None and self._dead_letters is not None:
+                    #Retries already ran in the worker process
+                    shm, size = shared
+                    self._dead_letter(obj, bytes(shm.buf[:size]), error)
+                    error = None
+
+                if shared is not None:
+                    shared[0].close()
+                    shared[0].unlink()
+
+                if error is not None:
+                    errors.append(error)
+                    continue
+
+                self._processed(obj)
+                self._cursor.advance(watermark.complete(obj.key))
+
+        handled = 0
+        for obj in islice(self._cursor.filter_collection(self._get_msg_iterator()), max_messages):
+            handled += 1
+            watermark.submit(obj.key)
+            if self._skip(obj):
+                self._cursor.advance(watermark.complete(obj.key))
+                continue
+
+            future, shared = self._submit(executor, obj)
+            futures[future] = (obj, shared)
+
+            if len(futures) >= self.max_in_flight:
+                done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                collect(done)
+            if errors:
+                break
+
+        collect(wait(list(futures))[0])
+
+        if errors:
+            raise errors[0]
+        return handled
+
+    def close(self):
+        """ Shuts down the callback executor (if this consumer created it) and snapshots dedupe state. """
+        if self._executor is not None and not isinstance(self.executor, Executor):
+            self._executor.shutdown()
+            self._executor = None
+        if self._deduper is not None:
+            self._deduper.close()
+        if self._hedger is not None and not isinstance(self.hedge, Hedger):
+            self._hedger.close()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def metrics(self):
+        """ Request hedging counters for metrics reporting. """
+        stats = {}
+        if self._hedger is not None:
+            stats['hedging'] = self._hedger.stats()
+        return stats
+
+    def _matches(self, obj):
+        if self.match is None:
+            return True
+        return self.match(key_attributes(obj.key))
+
+    def _decode(self, body):
+        if self.serializer is None:
+            return body
+        return self.serializer.loads(body)
+
+    def _wait(self, interval, started):
+        """ Waits for the next poll, cut short by a producer notification when enabled. """
+        if self._notify_location is None:
+            time.sleep( interval )
+            return
+        if self._listener.wait( interval ):
+            #Coalesce bursts of writes into one poll every min_interval
+            time.sleep( max( 0, started + self._min_interval - time.time() ) )
+            self._listener.drain()
 
     def consumption_loop( self, interval=2 ):
         """
         Consumes as many messages as there are available for this object key.  Busy polls the 
-        server and checks for new messages every 2 seconds if there are no messages.
+        server and checks for new messages every 2 seconds if there are no messages.  With
+        notify, a write signalled by a producer on this host starts the next poll early.
         """
+        if self._notify_location is not None and self._listener is None:
+            #Bind before the first poll so no write after it goes unsignalled
+            try:
+                self._listener = Listener( self.routing_key, self.name, location=self._notify_location )
+            except (OSError, IOError):
+                #Notifications are best effort, fall back to polling on the interval
+                self._notify_location = None
         try:
             while True:
+                started = time.time()
                 self.consume()
-                time.sleep( interval )
+                self._wait( interval, started )
         except KeyboardInterrupt:
             pass
         except:
@@ -168,16 +595,75 @@ class S3AggregateConsumer( S3Consumer ):
     the callback with a list of messages.
     """
 
-    def consume( self ):
+    def __init__( self, routing_key, func, columns=None, **kwargs ):
+        """
+        Takes the S3Consumer options and:
+
+        columns
+            Issue the callback with the batch decoded into muskrat.columnar.Columns (a typed
+            array and null mask per field) instead of a list.  True infers the schema from
+            each batch; a dict of field -> type declares it.  Messages are decoded with the
+            serializer, JSON by default.  Messages that are not objects or do not fit the
+            schema are dead lettered (with dead_letter) or skipped and counted in rejected.
+        """
+        super( S3AggregateConsumer, self ).__init__( routing_key, func, **kwargs )
+        self.columns = columns
+        self.rejected = 0
+        if columns and self.serializer is None:
+            self.serializer = get_serializer( 'json', timeformat=getattr( self.config, 'timeformat', None ) )
+
+    def consume( self, max_messages=None ):
+        """ Issues the callback once with the available messages, at most max_messages of them. """
         msg_iterator = self._get_msg_iterator()
 
-        objs = list(self._cursor.filter_collection(msg_iterator))
-        messages = [x.get()['Body'].read() for x in objs]
+        objs = list(islice(self._cursor.filter_collection(msg_iterator), max_messages))
+        selected = [x for x in objs if self._matches(x)]
+        if self._deduper is not None:
+            selected = [x for x in selected if not self._deduper.seen(x.key)]
+
+        bodies = [self._read(x) for x in selected]
+        messages = bodies
+        if self.serializer is not None:
+            messages = self.serializer.loads_many(messages)
+
+        if messages and self.columns:
+            messages = self._to_columns( selected, bodies, messages )
 
         if messages:
-            cursor = objs[-1].key
             self.callback( messages )
-            self._cursor.update( cursor )
+            if self._deduper is not None:
+                for x in selected:
+                    self._deduper.add( x.key )
+        self._cursor.advance( [x.key for x in objs] )
+        return len(objs)
+
+    def _to_columns( self, selected, bodies, messages ):
+        """
+        Converts the batch into Columns.  Messages that cannot be converted are dead lettered
+        or counted as rejected and left out, so one of them does not block the cursor.
+        """
+        schema = self.columns if isinstance( self.columns, dict ) else None
+        try:
+            return to_columns( messages, schema=schema )
+        except ValueError:
+            invalid = invalid_rows( messages, schema )
+            if not invalid:
+                raise
+
+        for index, error in invalid:
+            if self._dead_letters is not None:
+                self._dead_letter( selected[ index ], bodies[ index ], error )
+            else:
+                self.rejected += 1
+        rejected = set( index for index, error in invalid )
+        return to_columns( [message for index, message in enumerate( messages ) if index not in rejected],
+                           schema=schema )
+
+    def metrics( self ):
+        stats = super( S3AggregateConsumer, self ).metrics()
+        if self.columns:
+            stats['rejected'] = self.rejected
+        return stats
 
 
         
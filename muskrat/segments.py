@@ -0,0 +1,125 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Segment objects hold many messages of a routing key in a single S3 object.
+" They live under the 'segments' sub-prefix of the routing key and are named
+" after the last message key they contain, so they list in message order:
+"
+"     CHATSERVER/GENERAL/segments/2013-01-18T12:23:13.894895
+"
+" A segment starts with a JSON index line of [key, offset, length] entries
+" followed by the concatenated message bodies.
+"
+"""
+from __future__ import absolute_import
+import io
+
+try: import simplejson as json
+except ImportError: import json
+
+from   muskrat.util import key_timestamp
+
+SEGMENT_DIR = 'segments'
+
+
+def segment_prefix( prefix ):
+    """ Returns the segment sub-prefix of a routing key (or shard) prefix. """
+    return '/'.join( [prefix, SEGMENT_DIR] )
+
+def segment_key_name( prefix, key ):
+    """ Returns the segment name for a segment ending with message key. """
+    return '/'.join( [segment_prefix( prefix ), key_timestamp( key )] )
+
+def encode_segment( entries ):
+    """
+    Encodes a list of (key, body) pairs into a segment body.
+    """
+    index = []
+    bodies = []
+    offset = 0
+    for key, body in entries:
+        if not isinstance( body, bytes ):
+            body = body.encode( 'utf-8' )
+        index.append( [key, offset, len( body )] )
+        bodies.append( body )
+        offset += len( body )
+
+    header = json.dumps( index ).encode( 'utf-8' )
+    return b'\n'.join( [header, b''.join( bodies )] )
+
+def decode_segment( data ):
+    """
+    Decodes a segment body into a list of (key, body) pairs.
+    """
+    header, _, payload = data.partition( b'\n' )
+    return [(key, payload[offset:offset + length]) for key, offset, length in json.loads( header.decode( 'utf-8' ) )]
+
+
+class SegmentMessage(object):
+    """
+    A message read from a segment.  Quacks like the s3 ObjectSummary objects consumers
+    get from live listings, so cursors and callbacks cannot tell them apart.
+    """
+    def __init__( self, key, body, segment_key=None ):
+        self.key = key
+        self.body = body
+        self.size = len( body )
+        self.segment_key = segment_key
+
+    def get( self ):
+        return {'Body':io.BytesIO( self.body )}
+
+
+class SegmentedCollection(object):
+    """
+    Object collection for a routing key prefix that includes messages compacted into
+    segments.  Supports the Marker/Delimiter filters S3Cursor applies to a boto3 object
+    collection.  Iterating yields the compacted messages after the marker first, then
+    the live objects.
+
+    cutoff
+        Timestamp (in s3_timestamp_format) that no compacted message is newer than.  When the
+        marker is past it the segment listing is skipped.  None always lists segments.
+    """
+    def __init__( self, bucket, prefix, marker=None, cutoff=None ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.marker = marker
+        self.cutoff = cutoff
+
+    def filter( self, Marker=None, **kwargs ):
+        #Listings are always delimited so extra key levels are ignored
+        return SegmentedCollection( self.bucket, self.prefix, Marker or self.marker, self.cutoff )
+
+    def _segments( self, marker ):
+        collection = self.bucket.objects.filter( Prefix=segment_prefix( self.prefix ) + '/' )
+        if marker:
+            collection = collection.filter( Marker=segment_key_name( self.prefix, marker ) )
+        return collection.filter( Delimiter='/' )
+
+    def _segment_messages( self, marker ):
+        for segment in self._segments( marker ):
+            for key, body in decode_segment( segment.get()['Body'].read() ):
+                if marker and key <= marker:
+                    continue
+                yield SegmentMessage( key, body, segment_key=segment.key )
+
+    def __iter__( self ):
+        marker = self.marker
+        if not ( marker and self.cutoff and key_timestamp( marker ) >= self.cutoff ):
+            for message in self._segment_messages( marker ):
+                marker = message.key
+                yield message
+
+            #A compaction may have finished since the segments were listed, in which
+            #case its originals are gone from the live listing.  Pick it up first.
+            for message in self._segment_messages( marker ):
+                marker = message.key
+                yield message
+
+        collection = self.bucket.objects.filter( Prefix=self.prefix + '/' )
+        if marker:
+            collection = collection.filter( Marker=marker )
+        for obj in collection.filter( Delimiter='/' ):
+            yield obj
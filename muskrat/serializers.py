@@ -0,0 +1,145 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Serializer registry shared by producers and consumers.  Producers use a
+" serializer to encode objects passed to send_json, consumers can use one to
+" hand already-decoded objects to their callbacks.
+"
+" The stdlib/simplejson backend is always available.  Faster JSON backends
+" (orjson, ujson) and msgpack are registered when they can be imported.
+"
+"""
+from __future__ import absolute_import
+from datetime import datetime
+from functools import partial
+
+try: import simplejson as json
+except ImportError: import json
+
+SERIALIZERS = {}
+
+#Preferred order when asking for the fastest available JSON backend
+FAST_JSON_BACKENDS = ['orjson', 'ujson', 'json']
+
+
+def register_serializer( cls ):
+    """
+    Registers a serializer class under its name.  Can be used as a class decorator.
+    """
+    SERIALIZERS[ cls.name ] = cls
+    return cls
+
+
+def get_serializer( name='json', timeformat=None ):
+    """
+    Creates a serializer instance by registered name.
+
+    name
+        Registered name of the serializer.  'fastjson' picks the fastest JSON backend
+        that is installed.  A serializer instance is returned unchanged.
+    timeformat
+        strftime format used to encode datetime objects.
+    """
+    if isinstance( name, Serializer ):
+        return name
+
+    if name == 'fastjson':
+        name = [backend for backend in FAST_JSON_BACKENDS if backend in SERIALIZERS][0]
+
+    try:
+        cls = SERIALIZERS[ name ]
+    except KeyError:
+        raise ValueError( 'Serializer %s is not available' % name )
+
+    return cls( timeformat=timeformat )
+
+
+class Serializer(object):
+    """
+    Base serializer.  Children define dumps/loads, the bulk variants default to looping
+    over them.
+    """
+    name = None
+    binary = False
+
+    def __init__( self, timeformat=None ):
+        self.timeformat = timeformat
+
+    def _default( self, item ):
+        """ Handles datetime objects, anything else unknown is encoded as null. """
+        if isinstance( item, datetime ):
+            return item.strftime( self.timeformat )
+        return None
+
+    def dumps( self, obj ):
+        raise NotImplementedError
+
+    def loads( self, data ):
+        raise NotImplementedError
+
+    def dumps_many( self, objs ):
+        dumps = self.dumps
+        return [dumps( obj ) for obj in objs]
+
+    def loads_many( self, items ):
+        loads = self.loads
+        return [loads( data ) for data in items]
+
+
+@register_serializer
+class JSONSerializer( Serializer ):
+    name = 'json'
+
+    def __init__( self, timeformat=None ):
+        super( JSONSerializer, self ).__init__( timeformat=timeformat )
+        #Bind the encoder once rather than building a default per message
+        self.dumps = partial( json.dumps, default=self._default )
+        self.loads = json.loads
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+else:
+    @register_serializer
+    class ORJSONSerializer( Serializer ):
+        name = 'orjson'
+
+        def __init__( self, timeformat=None ):
+            super( ORJSONSerializer, self ).__init__( timeformat=timeformat )
+            #Route datetimes through our default so timeformat is honored
+            self.dumps = partial( orjson.dumps, default=self._default, option=orjson.OPT_PASSTHROUGH_DATETIME )
+            self.loads = orjson.loads
+
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+else:
+    @register_serializer
+    class UJSONSerializer( Serializer ):
+        name = 'ujson'
+
+        def __init__( self, timeformat=None ):
+            super( UJSONSerializer, self ).__init__( timeformat=timeformat )
+            self.dumps = partial( ujson.dumps, default=self._default )
+            self.loads = ujson.loads
+
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+else:
+    @register_serializer
+    class MsgpackSerializer( Serializer ):
+        name = 'msgpack'
+        binary = True
+
+        def __init__( self, timeformat=None ):
+            super( MsgpackSerializer, self ).__init__( timeformat=timeformat )
+            self.dumps = partial( msgpack.packb, default=self._default, use_bin_type=True )
+            self.loads = partial( msgpack.unpackb, raw=False )
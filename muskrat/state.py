@@ -0,0 +1,207 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Stateful S3 consumers.  The callback is issued with a state object along
+" with each message, and the state is periodically snapshotted together with
+" the cursor position in a single atomic write: a renamed temp file next to
+" the cursor, or one S3 object.  A restarted consumer loads the snapshot and
+" resumes from the position it was taken at, so rebuilding the state costs
+" the messages since the last snapshot rather than the whole routing key.
+"
+" A snapshot holds a JSON header line with the cursor followed by the
+" pickled state.
+"
+"""
+from __future__ import absolute_import
+import os
+import pickle
+import time
+from   itertools import islice
+
+try: import simplejson as json
+except ImportError: import json
+
+from   muskrat.s3consumer import S3Consumer
+
+STATE_SUFFIX = '.state'
+STATE_PREFIX = 'STATE'
+SNAPSHOT_VERSION = 1
+
+
+def encode_snapshot( cursor, state ):
+    header = {'version':SNAPSHOT_VERSION, 'cursor':cursor}
+    return json.dumps( header ).encode( 'utf-8' ) + b'\n' + pickle.dumps( state, pickle.HIGHEST_PROTOCOL )
+
+
+def decode_snapshot( data ):
+    """ Returns (cursor, state) from snapshot bytes. """
+    header, _, state = data.partition( b'\n' )
+    header = json.loads( header.decode( 'utf-8' ) )
+    if header.get( 'version' ) != SNAPSHOT_VERSION:
+        raise ValueError( 'Unsupported state snapshot version %r' % header.get( 'version' ) )
+    return header['cursor'], pickle.loads( state )
+
+
+class FileStateStore(object):
+    """ Snapshots written to a local file by rename, so a crash leaves the previous one intact. """
+    def __init__( self, path ):
+        self.path = path
+
+    def save( self, data ):
+        directory = os.path.dirname( self.path )
+        if directory and not os.path.isdir( directory ):
+            try:
+                os.makedirs( directory )
+            except OSError:
+                #Created by another consumer in the meantime
+                pass
+
+        tmp = self.path + '.tmp'
+        with open( tmp, 'wb' ) as f:
+            f.write( data )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.rename( tmp, self.path )
+
+    def load( self ):
+        try:
+            with open( self.path, 'rb' ) as f:
+                return f.read()
+        except IOError:
+            return None
+
+
+class S3StateStore(object):
+    """ Snapshots written as a single S3 object, which PUT replaces atomically. """
+    def __init__( self, bucket, key ):
+        self.bucket = bucket
+        self.key = key
+
+    def save( self, data ):
+        self.bucket.put_object( Key=self.key, Body=data )
+
+    def load( self ):
+        for obj in self.bucket.objects.filter( Prefix=self.key ):
+            if obj.key == self.key:
+                return obj.get()['Body'].read()
+        return None
+
+
+class S3StatefulConsumer( S3Consumer ):
+
+    def __init__( self, routing_key, func, state=dict, store=None, snapshot_interval=10000, snapshot_seconds=60,
+                  **kwargs ):
+        """
+        Takes the S3Consumer options (except workers and dedupe) and:
+
+        func
+            Callback issued with (state, message).  A return value other than None replaces
+            the state, so immutable states such as counts can be used.  Callbacks should leave
+            the state unchanged when they raise.
+        state
+            Callable returning the initial state when there is no snapshot.  The state must be
+            picklable.
+        store
+            Where snapshots are kept: 'file' (next to the cursor), 's3' (under
+            STATE/<cursor name> in the bucket) or an object with save( data ) and load().
+            Defaults to the type of the config's s3_state setting, or 'file'.
+        snapshot_interval
+            Snapshot after this many messages.
+        snapshot_seconds
+            Snapshot after this many seconds with unsnapshotted messages, checked after each
+            message and at the end of every consume().
+        """
+        for option in ( 'workers', 'dedupe' ):
+            if kwargs.get( option ):
+                raise ValueError( 'S3StatefulConsumer does not support %s' % option )
+
+        super( S3StatefulConsumer, self ).__init__( routing_key, func, **kwargs )
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_seconds = snapshot_seconds
+        self.store = self._get_store( store )
+
+        self._pending = 0
+        self._snapshot_time = time.time()
+        self._failed = False
+        self.snapshots = 0
+        self.load( state )
+
+    def _get_store( self, store ):
+        options = getattr( self.config, 's3_state', None ) or {}
+        store = store or options.get( 'type', 'file' )
+        if store == 'file':
+            location = options.get( 'location' )
+            if location:
+                return FileStateStore( os.path.join( location, self.name + STATE_SUFFIX ) )
+            return FileStateStore( self._cursor.filename + STATE_SUFFIX )
+        if store == 's3':
+            return S3StateStore( self.bucket, '/'.join( [options.get( 'prefix', STATE_PREFIX ), self.name] ) )
+        return store
+
+    def load( self, initial=dict ):
+        """
+        Restores the state and cursor from the snapshot.  Without a snapshot the state is
+        created with initial and the routing key is consumed from the beginning, since a
+        cursor alone cannot rebuild it.
+        """
+        data = self.store.load()
+        if data is None:
+            self.state = initial()
+            cursor = ''
+        else:
+            cursor, self.state = decode_snapshot( data )
+        #Sharded cursors are stored as one position per line, so write the raw value
+        self._cursor._update_func( cursor or '' )
+
+    def snapshot( self ):
+        """ Writes the state and the cursor position in one atomic write. """
+        if self._failed:
+            raise RuntimeError( 'A callback failed since the last snapshot; restart to restore the state' )
+        self.store.save( encode_snapshot( self._cursor.get() or '', self.state ) )
+        self._pending = 0
+        self._snapshot_time = time.time()
+        self.snapshots += 1
+
+    def _snapshot_due( self ):
+        if not self._pending or self._failed:
+            return False
+        if self._pending >= self.snapshot_interval:
+            return True
+        return self.snapshot_seconds is not None and time.time() - self._snapshot_time >= self.snapshot_seconds
+
+    def _invoke( self, body ):
+        result = self.callback( self.state, self._decode( body ) )
+        if result is not None:
+            self.state = result
+        return result
+
+    def consume( self, max_messages=None ):
+        """ Consumes as S3Consumer does, snapshotting the state as it goes. """
+        handled = 0
+        try:
+            for obj in islice( self._cursor.filter_collection( self._get_msg_iterator() ), max_messages ):
+                self._handle( obj )
+                self._cursor.update( obj.key )
+                handled += 1
+                self._pending += 1
+                if self._snapshot_due():
+                    self.snapshot()
+        except Exception:
+            self._failed = True
+            raise
+
+        if self._snapshot_due():
+            self.snapshot()
+        return handled
+
+    def close( self ):
+        """ Snapshots outstanding messages unless a callback failed. """
+        if self._pending and not self._failed:
+            self.snapshot()
+        super( S3StatefulConsumer, self ).close()
+
+    def metrics( self ):
+        stats = super( S3StatefulConsumer, self ).metrics()
+        stats['state'] = {'snapshots':self.snapshots, 'pending':self._pending}
+        return stats
@@ -0,0 +1,165 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" In-memory stand-ins for S3 and RabbitMQ shared by the unit tests.
+"
+"""
+from __future__ import absolute_import
+import io
+
+from ..producer import S3Producer
+from ..s3consumer import S3Consumer
+
+PREFIX = 'MUSKRAT/TEST/SEGMENTS'
+
+
+def message_key(second):
+    return '%s/2013-02-21T00:00:%02d.000000' % (PREFIX, second)
+
+
+class FakeObject(object):
+    """ Stand-in for an s3 ObjectSummary """
+    def __init__(self, key, body):
+        self.key = key
+        self.body = body
+        self.size = len( body )
+
+    def get(self):
+        return {'Body':io.BytesIO( self.body )}
+
+class FakeCollection(object):
+    """ Stand-in for a boto3 object collection """
+    def __init__(self, objects, prefix='', marker=None, delimiter=None):
+        self.objects = objects
+        self.prefix = prefix
+        self.marker = marker
+        self.delimiter = delimiter
+
+    def filter(self, Prefix=None, Marker=None, Delimiter=None):
+        return FakeCollection( self.objects, Prefix or self.prefix, Marker or self.marker, Delimiter or self.delimiter )
+
+    def __iter__(self):
+        for key in sorted( self.objects ):
+            if not key.startswith( self.prefix ) or ( self.marker and key <= self.marker ):
+                continue
+            if self.delimiter and self.delimiter in key[len( self.prefix ):]:
+                continue
+            yield FakeObject( key, self.objects[ key ] )
+
+class FakeKey(object):
+    """ Stand-in for a boto2 key written by the producers """
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def set_contents_from_string(self, body):
+        self.bucket.put( self.name, body if isinstance( body, bytes ) else body.encode( 'utf-8' ) )
+
+class FakeBucket(object):
+    def __init__(self):
+        self.contents = {}
+        self.objects = FakeCollection( self.contents )
+
+    def put(self, key, body):
+        self.contents[ key ] = body
+
+    def new_key(self, key_name):
+        return FakeKey( self, key_name )
+
+
+class FakeDeadLetterQueue(object):
+    """ Records what a consumer dead letters """
+    def __init__(self):
+        self.letters = []
+
+    def send(self, key, body, error, attempts):
+        self.letters.append( (key, body, error, attempts) )
+
+
+class FakeBucketConsumer(S3Consumer):
+    """ S3Consumer reading from an in-memory bucket """
+    fake_bucket = None
+
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+class FakeBucketProducer(S3Producer):
+    """ S3Producer writing to an in-memory bucket """
+    fake_bucket = None
+
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+class FakeMethod(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+class FakeHeader(object):
+    def __init__(self, headers=None):
+        self.headers = headers
+
+class FakeQueue(object):
+    """ Result of queue_declare """
+    def __init__(self, queue):
+        self.method = FakeMethod( None )
+        self.method.queue = queue
+
+class FakeChannel(object):
+    """ Stand-in for a pika BlockingChannel, with the pika 1.x call signatures """
+    def __init__(self):
+        self.acks = []
+        self.nacks = []
+        self.callbacks = {}
+        self.is_open = True
+
+    def exchange_declare(self, exchange, exchange_type='direct'):
+        pass
+
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+
+    def queue_declare(self, queue, durable=False):
+        return FakeQueue( queue )
+
+    def queue_bind(self, queue, exchange, routing_key=None):
+        self.routing_key = routing_key
+
+    def basic_consume(self, queue, on_message_callback):
+        self.callbacks[ queue ] = on_message_callback
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append( delivery_tag )
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.nacks.append( (delivery_tag, requeue) )
+
+    def deliver(self, queue, delivery_tag, body, headers=None):
+        self.callbacks[ queue ]( self, FakeMethod( delivery_tag ), FakeHeader( headers ), body )
+
+class FakeConnection(object):
+    """ Stand-in for a pika BlockingConnection whose timers only fire when told to """
+    def __init__(self):
+        self.channels = []
+        self.timers = []
+
+    def channel(self):
+        self.channels.append( FakeChannel() )
+        return self.channels[-1]
+
+    def call_later(self, delay, callback):
+        self.timers.append( callback )
+        return callback
+
+    def remove_timeout(self, timer):
+        #Like pika, removing a timer that already fired is allowed
+        if timer in self.timers:
+            self.timers.remove( timer )
+
+    def fire_timers(self):
+        timers, self.timers = self.timers, []
+        for timer in timers:
+            timer()
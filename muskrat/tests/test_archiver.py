@@ -0,0 +1,196 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the RabbitMQ to S3 archiver.
+"
+"""
+from __future__ import absolute_import
+import shutil
+import tempfile
+import unittest
+
+from .. import archiver
+from ..producer import KEY_HEADER, SendResult
+from ..rmqconsumer import ConsumerPool
+from .fakes import FakeBucket, FakeBucketConsumer, FakeConnection
+
+
+class PutBucket( FakeBucket ):
+    def put_object(self, Key, Body):
+        self.put( Key, Body )
+
+
+class FakeArchiver( archiver.Archiver ):
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+class FakeProducer(object):
+    def __init__(self, bucket, fail=False):
+        self.bucket = bucket
+        self.fail = fail
+
+    def send_many(self, msgs, key_names=None):
+        if self.fail:
+            return [SendResult( msg, key, IOError( 'PUT failed' ) ) for msg, key in zip( msgs, key_names )]
+        for msg, key in zip( msgs, key_names ):
+            self.bucket.put( key, msg )
+        return [SendResult( msg, key, None ) for msg, key in zip( msgs, key_names )]
+
+
+class FakeHeader(object):
+    def __init__(self, key=None):
+        self.headers = {KEY_HEADER:key} if key else None
+
+
+class FakePool(object):
+    def __init__(self):
+        self.registered = []
+
+    def batch_consumer(self, routing_key, size, timeout, requeue, on_error=None):
+        def decorator(func):
+            self.registered.append( (routing_key, size, timeout, func.__name__) )
+            self.on_error = on_error
+            return func
+        return decorator
+
+
+class TestArchiver( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        self.bucket = PutBucket()
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def archiver(self, **kwargs):
+        a = FakeArchiver( ['Muskrat.Archive'], config=self.config, **kwargs )
+        a.fake_bucket = self.bucket
+        return a
+
+    def deliveries(self, *bodies):
+        return [(None, FakeHeader(), body) for body in bodies]
+
+    def consume(self):
+        received = []
+        consumer = FakeBucketConsumer( 'Muskrat.Archive', received.append, name='reader', config=self.config,
+                                       segments=True )
+        consumer.fake_bucket = self.bucket
+        consumer.consume()
+        return received
+
+    def test_segments(self):
+        """ Each batch becomes one segment consumers read in order """
+        a = self.archiver()
+        first = a.archive( 'MUSKRAT.ARCHIVE', self.deliveries( b'a', b'b' ) )
+        a.archive( 'MUSKRAT.ARCHIVE', self.deliveries( b'c' ) )
+
+        self.assertEqual( len( self.bucket.contents ), 2 )
+        self.assertTrue( all( '/segments/' in key for key in self.bucket.contents ) )
+        self.assertEqual( first, sorted( first ) )
+        self.assertEqual( self.consume(), [b'a', b'b', b'c'] )
+        self.assertEqual( a.archived, 3 )
+
+    def test_header_keys(self):
+        """ Key names sent by a teeing producer are kept """
+        key = 'MUSKRAT/ARCHIVE/2013-02-21T00:00:00.000000'
+        keys = self.archiver().archive( 'MUSKRAT.ARCHIVE', [(None, FakeHeader( key ), b'teed')] +
+                                                           self.deliveries( b'plain' ) )
+        self.assertEqual( keys[0], key )
+        self.assertNotEqual( keys[1], key )
+
+    def test_objects(self):
+        """ Without segments each message is uploaded as its own object """
+        a = self.archiver( segments=False )
+        a.producers['MUSKRAT.ARCHIVE'].send_many = FakeProducer( self.bucket ).send_many
+        a.archive( 'MUSKRAT.ARCHIVE', self.deliveries( b'a', b'b' ) )
+        self.assertEqual( len( self.bucket.contents ), 2 )
+        self.assertEqual( self.consume(), [b'a', b'b'] )
+
+    def test_failed_write_raises(self):
+        """ A failed upload raises so the batch is nacked rather than acked """
+        a = self.archiver( segments=False )
+        a.producers['MUSKRAT.ARCHIVE'].send_many = FakeProducer( self.bucket, fail=True ).send_many
+        with self.assertRaises( IOError ):
+            a.archive( 'MUSKRAT.ARCHIVE', self.deliveries( b'a' ) )
+        self.assertEqual( a.archived, 0 )
+
+    def test_register(self):
+        """ A batch consumer with its own queue is registered per routing key """
+        pool = FakePool()
+        a = FakeArchiver( ['Muskrat.One', 'Muskrat.Two'], config=self.config, batch_size=50, timeout=100, pool=pool )
+        a.register()
+        self.assertEqual( pool.registered, [('MUSKRAT.ONE', 50, 100, 'archive_MUSKRAT.ONE'),
+                                            ('MUSKRAT.TWO', 50, 100, 'archive_MUSKRAT.TWO')] )
+
+    def test_failed_batch_keeps_running(self):
+        """ A batch that failed to write is counted and logged rather than stopping the bridge """
+        pool = FakePool()
+        a = FakeArchiver( ['Muskrat.One'], config=self.config, pool=pool )
+        a.register()
+        pool.on_error( IOError( 'PUT failed' ), self.deliveries( b'a' ) )
+        self.assertEqual( a.failed, 1 )
+
+    def pool(self):
+        pool = ConsumerPool( config=dict( self.config, host='localhost', exchange_name='muskrat',
+                                          exchange_type='topic' ) )
+        pool._connection = FakeConnection()
+        return pool
+
+    def test_consumer_pool(self):
+        """ Batches delivered through a ConsumerPool are archived and then acked """
+        pool = self.pool()
+        a = self.archiver( batch_size=2, pool=pool )
+        a.register()
+
+        name = '%s.archive_MUSKRAT.ARCHIVE' % archiver.__name__
+        channel = pool.get_consumer_channel( name )
+        channel.deliver( name, 1, b'a' )
+        channel.deliver( name, 2, b'b' )
+        self.assertEqual( (channel.acks, channel.nacks), ([2], []) )
+        self.assertEqual( self.consume(), [b'a', b'b'] )
+
+    def test_consumer_pool_failure(self):
+        """ A batch that fails to write through a ConsumerPool is nacked and requeued """
+        pool = self.pool()
+        a = self.archiver( batch_size=1, segments=False, pool=pool )
+        a.producers['MUSKRAT.ARCHIVE'].send_many = FakeProducer( self.bucket, fail=True ).send_many
+        a.register()
+
+        name = '%s.archive_MUSKRAT.ARCHIVE' % archiver.__name__
+        channel = pool.get_consumer_channel( name )
+        channel.deliver( name, 1, b'a' )
+        self.assertEqual( (channel.acks, channel.nacks), ([], [(1, True)]) )
+        self.assertEqual( a.failed, 1 )
+        self.assertEqual( self.bucket.contents, {} )
+
+    def test_compaction_cutoff(self):
+        """ segments='archived' reads new segments that the compaction cutoff would skip """
+        a = self.archiver()
+        a.archive( 'MUSKRAT.ARCHIVE', self.deliveries( b'a' ) )
+        a.archive( 'MUSKRAT.ARCHIVE', self.deliveries( b'b' ) )
+        self.config['s3_compaction'] = {'max_age':3600}
+
+        def consume(segments):
+            received = []
+            consumer = FakeBucketConsumer( 'Muskrat.Archive', received.append, name='reader-%s' % segments,
+                                           config=self.config, segments=segments )
+            consumer.fake_bucket = self.bucket
+            #Resume past the first batch, as a consumer that is caught up would
+            consumer._cursor.update( sorted( self.bucket.contents )[0].replace( '/segments', '' ) )
+            consumer.consume()
+            return received
+
+        self.assertEqual( consume( True ), [] )
+        self.assertEqual( consume( 'archived' ), [b'b'] )
+
+
+if '__main__' == __name__:
+    unittest.main()
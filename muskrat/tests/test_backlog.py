@@ -0,0 +1,88 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for backlog inspection.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import backlog
+from .fakes import FakeBucket, PREFIX, message_key
+
+
+class FakeBacklog( backlog.Backlog ):
+    listings = 0
+
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+    def list_prefix(self, prefix, marker):
+        self.listings += 1
+        return super( FakeBacklog, self ).list_prefix( prefix, marker )
+
+
+class TestBacklog( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        self.bucket = FakeBucket()
+        for x in range( 10 ):
+            self.bucket.put( message_key( x ), b'x' * ( x + 1 ) )
+            self.bucket.put( '%s/shard%03d/2013-02-21T00:00:%02d.000000' % (PREFIX, x % 2, x), b'y' )
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def write_cursor(self, name, *keys):
+        with open( os.path.join( self.cursor_dir, name ), 'w' ) as f:
+            f.write( '\n'.join( keys ) )
+
+    def backlog(self, **kwargs):
+        b = FakeBacklog( config=self.config, **kwargs )
+        b.fake_bucket = self.bucket
+        return b
+
+    def test_one_listing_per_prefix(self):
+        """ Cursors sharing a prefix are served by one listing """
+        self.write_cursor( 'fast', message_key( 8 ) )
+        self.write_cursor( 'slow', message_key( 2 ) )
+        self.write_cursor( 'done', message_key( 9 ) )
+        b = self.backlog()
+        report = b.inspect()
+        self.assertEqual( b.listings, 1 )
+
+        self.assertEqual( (report['slow']['count'], report['slow']['bytes'], report['slow']['lag']),
+                          (7, sum( range( 4, 11 ) ), 7.0) )
+        self.assertEqual( (report['fast']['count'], report['fast']['bytes'], report['fast']['lag']), (1, 10, 1.0) )
+        self.assertEqual( (report['done']['count'], report['done']['bytes'], report['done']['lag']), (0, 0, 0.0) )
+
+    def test_sharded_cursor(self):
+        """ Sharded cursors sum their shards and report the largest lag """
+        self.write_cursor( 'sharded', '%s/shard000/2013-02-21T00:00:02.000000' % PREFIX,
+                                      '%s/shard001/2013-02-21T00:00:07.000000' % PREFIX )
+        b = self.backlog()
+        report = b.inspect()
+        self.assertEqual( b.listings, 2 )
+        self.assertEqual( report['sharded']['count'], 3 + 1 )
+        self.assertEqual( report['sharded']['lag'], 6.0 )
+        self.assertEqual( sorted( report['sharded']['prefixes'] ), ['%s/shard000' % PREFIX, '%s/shard001' % PREFIX] )
+
+    def test_cursor_filter(self):
+        """ Only the named cursors are inspected """
+        self.write_cursor( 'fast', message_key( 8 ) )
+        self.write_cursor( 'slow', message_key( 2 ) )
+        self.assertEqual( list( self.backlog( cursors=['fast'] ).inspect() ), ['fast'] )
+
+
+if '__main__' == __name__:
+    unittest.main()
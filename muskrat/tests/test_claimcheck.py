@@ -0,0 +1,146 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for claim checking large RabbitMQ payloads through S3.
+"
+"""
+from __future__ import absolute_import
+import io
+import json
+import threading
+import unittest
+
+from .. import claimcheck
+from ..producer import RabbitMQProducer, SendResult, KEY_HEADER
+
+
+class FakeS3Object(object):
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def get(self):
+        with self.bucket.lock:
+            self.bucket.gets.append( self.key )
+        return {'Body':io.BytesIO( self.bucket.contents[ self.key ] )}
+
+
+class FakeBucket(object):
+    def __init__(self):
+        self.contents = {}
+        self.gets = []
+        self.lock = threading.Lock()
+
+    def Object(self, key):
+        return FakeS3Object( self, key )
+
+
+class FakeHeader(object):
+    def __init__(self, headers=None):
+        self.headers = headers
+
+
+class FakeStore(object):
+    def __init__(self):
+        self.payloads = {}
+
+    def put(self, routing_key, msg):
+        key = 'CLAIMCHECK/%s/%d' % (routing_key.replace( '.', '/' ), len( self.payloads ))
+        self.payloads[ key ] = msg
+        return key
+
+    def put_many(self, routing_key, msgs):
+        return [SendResult( msg, self.put( routing_key, msg ), None ) for msg in msgs]
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.published = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append( (routing_key, body, properties) )
+
+
+def claim_checking_producer(threshold):
+    """ RabbitMQProducer with the broker and S3 replaced by fakes """
+    producer = RabbitMQProducer.__new__( RabbitMQProducer )
+    producer.routing_key = 'MUSKRAT.CLAIMS'
+    producer.exchange = 'muskrat'
+    producer.channel = FakeChannel()
+    producer._properties = lambda headers: headers
+    producer.claim_threshold = threshold
+    producer._claims = FakeStore()
+    return producer
+
+
+class TestClaimCheckProducer( unittest.TestCase ):
+
+    def test_large_payload_offloaded(self):
+        """ Payloads over the threshold are stored and replaced by an envelope """
+        producer = claim_checking_producer( 10 )
+        producer.send( 'small' )
+        producer.send( 'x' * 100, key_name='MUSKRAT/CLAIMS/2013' )
+
+        small, large = producer.channel.published
+        self.assertEqual( small, ('MUSKRAT.CLAIMS', 'small', None) )
+        claim = large[2][ claimcheck.CLAIM_HEADER ]
+        self.assertEqual( producer._claims.payloads[ claim ], 'x' * 100 )
+        self.assertEqual( large[2][ KEY_HEADER ], 'MUSKRAT/CLAIMS/2013' )
+        self.assertEqual( json.loads( large[1] ), {'claim_check':claim, 'size':100} )
+
+    def test_send_many(self):
+        """ Only the large payloads of a batch are claim checked """
+        producer = claim_checking_producer( 10 )
+        results = producer.send_many( ['a', 'y' * 50, 'b'] )
+        self.assertTrue( all( result.ok for result in results ) )
+        bodies = [body for routing_key, body, properties in producer.channel.published]
+        self.assertEqual( bodies[0], 'a' )
+        self.assertEqual( bodies[2], 'b' )
+        self.assertEqual( json.loads( bodies[1] )['size'], 50 )
+
+
+class TestClaimResolver( unittest.TestCase ):
+
+    def setUp(self):
+        self.resolver = claimcheck.ClaimResolver( config={}, cache_bytes=10, prefetch=4 )
+        self.resolver._bucket = self.bucket = FakeBucket()
+        self.bucket.contents.update( {'A':b'aaaa', 'B':b'bbbb', 'C':b'cccc'} )
+
+    def tearDown(self):
+        self.resolver.close()
+
+    def delivery(self, tag, claim=None, body=b'envelope'):
+        return (tag, FakeHeader( {claimcheck.CLAIM_HEADER:claim} if claim else None ), body)
+
+    def test_resolve(self):
+        """ Regular deliveries pass through, claim checked ones are fetched once """
+        method, header, body = self.delivery( 1, body=b'plain' )
+        self.assertEqual( self.resolver.resolve( header, body ), b'plain' )
+
+        method, header, body = self.delivery( 2, claim='A' )
+        self.assertEqual( self.resolver.resolve( header, body ), b'aaaa' )
+        self.assertEqual( self.resolver.resolve( header, body ), b'aaaa' )
+        self.assertEqual( self.bucket.gets, ['A'] )
+        self.assertEqual( self.resolver.stats()['hits'], 1 )
+
+    def test_lru_bound(self):
+        """ The cache evicts the least recently used payloads past its size """
+        for key in 'ABC':
+            self.resolver.fetch( key )
+        self.assertEqual( len( self.resolver.cache ), 2 )
+        self.resolver.fetch( 'A' )
+        self.assertEqual( self.bucket.gets, ['A', 'B', 'C', 'A'] )
+
+    def test_resolve_many(self):
+        """ Batches are resolved in order with each payload fetched once """
+        messages = [self.delivery( 1, claim='A' ), self.delivery( 2, body=b'plain' ), self.delivery( 3, claim='B' ),
+                    self.delivery( 4, claim='A' )]
+        resolved = self.resolver.resolve_many( messages )
+        self.assertEqual( [body for method, header, body in resolved], [b'aaaa', b'plain', b'bbbb', b'aaaa'] )
+        self.assertEqual( [method for method, header, body in resolved], [1, 2, 3, 4] )
+        self.assertEqual( sorted( self.bucket.gets ), ['A', 'B'] )
+
+
+if '__main__' == __name__:
+    unittest.main()
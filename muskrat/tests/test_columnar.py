@@ -0,0 +1,141 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for columnar batch decoding.
+"
+"""
+from __future__ import absolute_import
+import json
+import math
+import shutil
+import tempfile
+import unittest
+
+from .. import columnar
+from ..s3consumer import S3AggregateConsumer
+from .fakes import FakeBucket, FakeDeadLetterQueue, message_key
+
+RECORDS = [
+    {'user':1, 'plan':'free', 'amount':0, 'trial':True},
+    {'user':2, 'plan':'pro', 'amount':9.5},
+    {'user':3, 'plan':None, 'amount':12, 'trial':False, 'tags':['a']},
+]
+
+
+class TestColumns( unittest.TestCase ):
+
+    def test_infer_schema(self):
+        """ Numeric types widen and mixed or nested fields become objects """
+        schema = columnar.infer_schema( RECORDS + [{'user':'4'}] )
+        self.assertEqual( dict( schema ), {'user':'object', 'plan':'str', 'amount':'float', 'trial':'bool',
+                                           'tags':'object'} )
+
+    def test_array_backend(self):
+        """ Without NumPy columns are stdlib arrays with null masks """
+        columns = columnar.to_columns( RECORDS, backend='array' )
+        self.assertEqual( len( columns ), 3 )
+        self.assertEqual( columns['user'].typecode, 'q' )
+        self.assertEqual( list( columns['user'] ), [1, 2, 3] )
+        self.assertEqual( list( columns['amount'] ), [0.0, 9.5, 12.0] )
+        self.assertEqual( columns['plan'], ['free', 'pro', None] )
+        self.assertEqual( list( columns.nulls['trial'] ), [0, 1, 0] )
+        self.assertEqual( columns.null_count( 'tags' ), 2 )
+
+    def test_declared_schema(self):
+        """ Declared schemas keep only their fields and convert values """
+        columns = columnar.to_columns( RECORDS + [{'plan':'free'}], schema={'user':float, 'plan':'str'},
+                                       backend='array' )
+        self.assertEqual( columns.keys(), ['user', 'plan'] )
+        self.assertEqual( list( columns['user'] )[:3], [1.0, 2.0, 3.0] )
+        self.assertTrue( math.isnan( columns['user'][3] ) )
+        self.assertEqual( list( columns.nulls['user'] ), [0, 0, 0, 1] )
+
+    def test_not_an_object(self):
+        """ Records that are not objects raise with their row """
+        with self.assertRaises( ValueError ) as context:
+            columnar.to_columns( RECORDS + [['not', 'an', 'object']], backend='array' )
+        self.assertIn( 'Record 3', str( context.exception ) )
+
+    def test_bad_value(self):
+        """ Values that do not fit a declared type raise """
+        with self.assertRaises( ValueError ):
+            columnar.to_columns( [{'user':'abc'}], schema={'user':'int'}, backend='array' )
+
+    @unittest.skipIf( columnar.numpy is None, 'NumPy is not installed' )
+    def test_numpy_backend(self):
+        """ With NumPy columns are typed ndarrays """
+        columns = columnar.to_columns( RECORDS, backend='numpy' )
+        self.assertEqual( str( columns['user'].dtype ), 'int64' )
+        self.assertEqual( columns['amount'].sum(), 21.5 )
+        self.assertEqual( columns['plan'].dtype, object )
+        self.assertEqual( columns.nulls['plan'].tolist(), [False, False, True] )
+
+
+class FakeAggregateConsumer( S3AggregateConsumer ):
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+class TestColumnarAggregate( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        self.bucket = FakeBucket()
+        for x, record in enumerate( RECORDS ):
+            self.bucket.put( message_key( x ), json.dumps( record ).encode( 'utf-8' ) )
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def test_columnar_batches(self):
+        """ The aggregate callback receives the batch as columns """
+        batches = []
+        c = FakeAggregateConsumer( 'Muskrat.Test.Segments', batches.append, columns={'user':'int', 'amount':'float'},
+                                   name='columnar', config=self.config )
+        c.fake_bucket = self.bucket
+        self.assertEqual( c.consume(), 3 )
+        self.assertEqual( len( batches ), 1 )
+        self.assertEqual( list( batches[0]['user'] ), [1, 2, 3] )
+        self.assertEqual( sum( batches[0]['amount'] ), 21.5 )
+
+    def consumer(self, batches):
+        #Invalid messages sit between the valid ones: an array and a user that is not an int
+        self.bucket = FakeBucket()
+        bodies = [json.dumps( RECORDS[0] ), '[1, 2]', json.dumps( RECORDS[1] ), '{"user": "abc"}', json.dumps( RECORDS[2] )]
+        for x, body in enumerate( bodies ):
+            self.bucket.put( message_key( x ), body.encode( 'utf-8' ) )
+
+        c = FakeAggregateConsumer( 'Muskrat.Test.Segments', batches.append, columns={'user':'int'},
+                                   name='columnar', config=self.config )
+        c.fake_bucket = self.bucket
+        return c
+
+    def test_invalid_skipped(self):
+        """ Messages that do not fit the columns are counted and skipped and the cursor moves on """
+        batches = []
+        c = self.consumer( batches )
+        self.assertEqual( c.consume(), 5 )
+        self.assertEqual( c.consume(), 0 )
+        self.assertEqual( [list( batch['user'] ) for batch in batches], [[1, 2, 3]] )
+        self.assertEqual( c.metrics()['rejected'], 2 )
+
+    def test_invalid_dead_lettered(self):
+        """ With dead_letter, messages that do not fit the columns are dead lettered """
+        batches = []
+        c = self.consumer( batches )
+        c._dead_letters = FakeDeadLetterQueue()
+        c.consume()
+        self.assertEqual( [list( batch['user'] ) for batch in batches], [[1, 2, 3]] )
+        self.assertEqual( [(key, body) for key, body, error, attempts in c._dead_letters.letters],
+                          [(message_key( 1 ), b'[1, 2]'), (message_key( 3 ), b'{"user": "abc"}')] )
+        self.assertEqual( c.metrics()['rejected'], 0 )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for compacting a routing key prefix into segment objects.
+"
+"""
+from __future__ import absolute_import
+import io
+import unittest
+
+from ..compaction import Compactor
+from ..segments import SegmentedCollection
+from .fakes import FakeBucket, PREFIX, message_key
+
+CUTOFF = '2013-02-21T00:00:10'
+
+
+class FakeClient(object):
+    """ Stand-in for the boto3 client behind a FakeClientBucket """
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get_object(self, Bucket, Key):
+        return {'Body':io.BytesIO( self.bucket.contents[ Key ] )}
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.bucket.contents.pop( obj['Key'], None )
+        return {}
+
+class FakeClientBucket(FakeBucket):
+    """ FakeBucket exposing the put_object/client calls the compactor makes """
+    name = 'test-bucket'
+
+    def __init__(self):
+        super( FakeClientBucket, self ).__init__()
+        self.meta = type( 'Meta', (object,), {'client':FakeClient( self )} )
+
+    def put_object(self, Key, Body):
+        self.put( Key, Body )
+
+class FailingPutBucket(FakeClientBucket):
+    def put_object(self, Key, Body):
+        raise IOError( 'PUT failed' )
+
+
+class FakeBucketCompactor(Compactor):
+    """ Compactor writing to an in-memory bucket """
+    fake_bucket = None
+
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+class TestCompactor( unittest.TestCase ):
+
+    def setUp(self):
+        self.compactor = FakeBucketCompactor( 'muskrat.test.segments', config={}, max_age=0, segment_size=2 )
+
+    def fill(self, bucket):
+        for x in range( 1, 13 ):
+            bucket.put( message_key( x ), ( 'message %d' % x ).encode( 'utf-8' ) )
+        return bucket
+
+    def read(self, bucket):
+        return [(obj.key, obj.get()['Body'].read()) for obj in SegmentedCollection( bucket, PREFIX ).filter( Delimiter='/' )]
+
+    def test_compacted_reads_back(self):
+        """ A compacted prefix reads back identically through a SegmentedCollection """
+        bucket = self.compactor.fake_bucket = self.fill( FakeClientBucket() )
+        before = self.read( bucket )
+
+        self.assertEqual( self.compactor.compact_prefix( PREFIX, CUTOFF ), (5, 9) )
+        self.assertEqual( self.read( bucket ), before )
+
+        #Only the messages newer than the cutoff are left as live objects
+        live = [key for key in bucket.contents if key.startswith( PREFIX + '/2013' )]
+        self.assertEqual( sorted( live ), [message_key( x ) for x in range( 10, 13 )] )
+
+    def test_failed_put_deletes_nothing(self):
+        """ Originals are kept when their segment cannot be written """
+        bucket = self.compactor.fake_bucket = self.fill( FailingPutBucket() )
+        before = dict( bucket.contents )
+
+        self.assertRaises( IOError, self.compactor.compact_prefix, PREFIX, CUTOFF )
+        self.assertEqual( bucket.contents, before )
+
+
+    def test_max_age_below_config(self):
+        """ max_age may not undercut the cutoff consumers take from the config """
+        config = {'s3_compaction':{'max_age':3600}}
+        with self.assertRaises( ValueError ):
+            Compactor( 'muskrat.test.segments', config=config, max_age=60 )
+        self.assertEqual( Compactor( 'muskrat.test.segments', config=config, max_age=7200 ).max_age, 7200 )
+
+
+if '__main__' == __name__:
+    unittest.main()
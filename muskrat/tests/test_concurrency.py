@@ -0,0 +1,229 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for muskrat concurrency primitives.
+"
+"""
+from __future__ import absolute_import
+import unittest
+import threading
+import time
+from   six.moves.queue import Queue
+
+from .. import concurrency
+from ..producer import S3WriteThread
+from ..retry import RetryPolicy, is_retryable
+
+
+class ThrottleError( Exception ):
+    status = 503
+    error_code = 'SlowDown'
+
+
+class TestThrottleDetection( unittest.TestCase ):
+
+    def test_boto_throttle(self):
+        """ boto S3ResponseError style throttles are detected """
+        self.assertTrue( concurrency.is_throttle( ThrottleError() ) )
+
+    def test_boto3_throttle(self):
+        """ botocore ClientError style throttles are detected """
+        error = Exception()
+        error.response = {'Error':{'Code':'SlowDown'}, 'ResponseMetadata':{'HTTPStatusCode':503}}
+        self.assertTrue( concurrency.is_throttle( error ) )
+
+    def test_other_errors(self):
+        """ Other errors are not throttles """
+        self.assertFalse( concurrency.is_throttle( ValueError() ) )
+
+
+class TestAIMDLimiter( unittest.TestCase ):
+
+    def test_slow_start(self):
+        """ Limit grows by one per success until congestion """
+        limiter = concurrency.AIMDLimiter( min_limit=1, max_limit=10 )
+        for x in range( 4 ):
+            limiter.acquire()
+            limiter.release( 0.01 )
+        self.assertEqual( limiter.concurrency, 5 )
+
+    def test_bounds(self):
+        """ Limit stays within min and max """
+        limiter = concurrency.AIMDLimiter( min_limit=2, max_limit=4 )
+        for x in range( 20 ):
+            limiter.acquire()
+            limiter.release( 0.01 )
+        self.assertEqual( limiter.concurrency, 4 )
+
+        for x in range( 5 ):
+            limiter._last_decrease = 0
+            limiter.acquire()
+            limiter.release( 0.01, throttled=True )
+        self.assertEqual( limiter.concurrency, 2 )
+
+    def test_throttle_backoff(self):
+        """ Throttles halve the limit and end slow start """
+        limiter = concurrency.AIMDLimiter( min_limit=1, max_limit=100, initial=40 )
+        limiter.acquire()
+        limiter.release( 0.01, throttled=True )
+        self.assertEqual( limiter.concurrency, 20 )
+        self.assertEqual( limiter.stats()['throttled'], 1 )
+
+        limiter.acquire()
+        limiter.release( 0.01 )
+        self.assertEqual( limiter.concurrency, 20, 'Additive increase grew by a whole request' )
+
+    def test_latency_backoff(self):
+        """ Latency far above the baseline counts as congestion """
+        limiter = concurrency.AIMDLimiter( min_limit=1, max_limit=100, initial=40, tolerance=3.0 )
+        limiter.acquire()
+        limiter.release( 0.01 )
+        limiter.acquire()
+        limiter.release( 1.0 )
+        self.assertLess( limiter.concurrency, 40 )
+
+    def test_acquire_blocks(self):
+        """ acquire blocks once the limit is reached """
+        limiter = concurrency.AIMDLimiter( min_limit=1, max_limit=1 )
+        limiter.acquire()
+
+        acquired = threading.Event()
+        def worker():
+            limiter.acquire()
+            acquired.set()
+        t = threading.Thread( target=worker )
+        t.start()
+
+        self.assertFalse( acquired.wait( 0.1 ), 'acquire did not block at the limit' )
+        limiter.release()
+        self.assertTrue( acquired.wait( 1 ), 'release did not wake a waiting acquire' )
+        t.join()
+
+
+class TestHedger( unittest.TestCase ):
+
+    def hedger(self, **kwargs):
+        options = {'min_samples':5, 'budget':1.0}
+        options.update( kwargs )
+        hedger = concurrency.Hedger( **options )
+        self.addCleanup( hedger.close )
+        #Warm the tracker up with fast requests
+        for x in range( 5 ):
+            hedger.call( lambda: None )
+        return hedger
+
+    def test_latency_tracker(self):
+        """ Percentiles are only reported once enough samples were seen """
+        tracker = concurrency.LatencyTracker( min_samples=3 )
+        tracker.record( 1 )
+        tracker.record( 2 )
+        self.assertEqual( tracker.percentile( 95 ), None )
+        for x in range( 3, 101 ):
+            tracker.record( x )
+        self.assertEqual( tracker.percentile( 95 ), 96 )
+
+    def test_fast_requests_not_hedged(self):
+        """ Requests within the threshold are never duplicated """
+        hedger = self.hedger()
+        self.assertEqual( hedger.call( lambda x: x * 2, 21 ), 42 )
+        self.assertEqual( hedger.stats()['hedged'], 0 )
+
+    def test_straggler_hedged(self):
+        """ A request slower than the threshold is hedged and the hedge's result used """
+        hedger = self.hedger()
+        release = threading.Event()
+        self.addCleanup( release.set )
+
+        start = time.time()
+        self.assertEqual( hedger.call( lambda: release.wait( 5 ) and 'slow', hedge=lambda: 'hedge' ), 'hedge' )
+        self.assertTrue( time.time() - start < 1 )
+        stats = hedger.stats()
+        self.assertEqual( (stats['hedged'], stats['hedge_wins']), (1, 1) )
+
+    def test_budget(self):
+        """ Hedges are limited to the budget """
+        hedger = self.hedger( budget=0.0, timeout=0.2 )
+        with self.assertRaises( concurrency.RequestTimeout ):
+            hedger.call( time.sleep, 1, hedge=lambda: 'hedge' )
+        self.assertEqual( hedger.stats()['hedged'], 0 )
+
+    def test_timeout(self):
+        """ Requests missing the deadline raise RequestTimeout and are counted """
+        hedger = concurrency.Hedger( timeout=0.1 )
+        self.addCleanup( hedger.close )
+        with self.assertRaises( concurrency.RequestTimeout ):
+            hedger.call( time.sleep, 1 )
+        self.assertEqual( hedger.stats()['timeouts'], 1 )
+
+    def test_abandoned_cap(self):
+        """ Calls fail fast while too many abandoned requests hold the pool """
+        hedger = concurrency.Hedger( timeout=0.05, workers=4, max_abandoned=2 )
+        self.addCleanup( hedger.close )
+        release = threading.Event()
+        self.addCleanup( release.set )
+        for x in range( 2 ):
+            with self.assertRaises( concurrency.RequestTimeout ):
+                hedger.call( release.wait, 5 )
+        self.assertEqual( hedger.stats()['abandoned'], 2 )
+
+        calls = []
+        with self.assertRaises( concurrency.RequestTimeout ):
+            hedger.call( calls.append, 1 )
+        self.assertEqual( (calls, hedger.stats()['rejected']), ([], 1) )
+
+        #Requests are accepted again once the stuck ones finish
+        release.set()
+        deadline = time.time() + 5
+        while hedger.stats()['abandoned'] and time.time() < deadline:
+            time.sleep( 0.01 )
+        self.assertEqual( hedger.call( lambda: 'ok' ), 'ok' )
+
+    def test_errors(self):
+        """ Errors are raised once no request can succeed """
+        hedger = self.hedger()
+        def fail():
+            raise ValueError( 'failed' )
+        with self.assertRaises( ValueError ):
+            hedger.call( fail )
+
+    def test_get_hedger(self):
+        """ Hedge options resolve to a Hedger """
+        hedger = concurrency.Hedger()
+        self.assertIs( concurrency.get_hedger( hedger ), hedger )
+        self.assertEqual( concurrency.get_hedger( None ), None )
+        self.assertEqual( concurrency.get_hedger( {'percentile':99} ).percentile, 99 )
+
+
+class SlowOnceKey( object ):
+    """ Key whose first PUT hangs until released """
+    def __init__(self, release):
+        self.release = release
+        self.puts = []
+
+    def set_contents_from_string(self, msg):
+        self.puts.append( msg )
+        if len( self.puts ) == 1:
+            self.release.wait( 5 )
+
+
+class TestS3WriteThreadHedging( unittest.TestCase ):
+
+    def test_timeout_retried(self):
+        """ A PUT missing its deadline is retried """
+        release = threading.Event()
+        self.addCleanup( release.set )
+        key = SlowOnceKey( release )
+        queue = Queue()
+        queue.put( ('msg', key) )
+
+        hedger = concurrency.Hedger( timeout=0.1 )
+        self.addCleanup( hedger.close )
+        S3WriteThread( queue, timeout=0.2, hedger=hedger, retry=RetryPolicy( base_delay=0, retryable=is_retryable ) ).run()
+        queue.join()
+        self.assertEqual( key.puts, ['msg', 'msg'] )
+        self.assertEqual( hedger.stats()['timeouts'], 1 )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the persisted recent-key set.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import dedupe
+from .fakes import FakeBucket, FakeBucketConsumer, message_key
+
+
+def key(x):
+    return 'MUSKRAT/TEST/DEDUPE/2013-02-21T00:00:00.%06d' % x
+
+
+class TestBloomFilter( unittest.TestCase ):
+
+    def test_membership(self):
+        """ Added keys are always members """
+        bloom = dedupe.BloomFilter( 1000, 0.01 )
+        for x in range( 1000 ):
+            bloom.add( key( x ) )
+        self.assertTrue( all( key( x ) in bloom for x in range( 1000 ) ) )
+
+    def test_false_positive_rate(self):
+        """ False positives stay near the configured rate """
+        bloom = dedupe.BloomFilter( 1000, 0.01 )
+        for x in range( 1000 ):
+            bloom.add( key( x ) )
+        false_positives = sum( 1 for x in range( 1000, 11000 ) if key( x ) in bloom )
+        self.assertLess( false_positives, 300 )
+
+    def test_rotation(self):
+        """ Rotating filters forget keys after two generations """
+        bloom = dedupe.RotatingBloomFilter( 10, 0.001 )
+        bloom.add( 'first' )
+        for x in range( 10 ):
+            bloom.add( key( x ) )
+        self.assertIn( 'first', bloom )
+        for x in range( 10, 20 ):
+            bloom.add( key( x ) )
+        self.assertNotIn( 'first', bloom )
+
+
+class TestKeyDeduper( unittest.TestCase ):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join( self.dir, '__main__.consumer' + dedupe.DEDUPE_SUFFIX )
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+    def test_seen(self):
+        """ Added keys are seen, others are not """
+        d = dedupe.KeyDeduper( self.path, capacity=100, window=10 )
+        d.add( key( 1 ) )
+        self.assertTrue( d.seen( key( 1 ) ) )
+        self.assertFalse( d.seen( key( 2 ) ) )
+
+    def test_journal_recovery(self):
+        """ Keys survive a crash before any snapshot through the journal """
+        d = dedupe.KeyDeduper( self.path, capacity=100, window=10 )
+        for x in range( 5 ):
+            d.add( key( x ) )
+        #No close(); simulates a crash
+
+        recovered = dedupe.KeyDeduper( self.path, capacity=100, window=10 )
+        self.assertTrue( all( recovered.seen( key( x ) ) for x in range( 5 ) ) )
+
+    def test_snapshot_recovery(self):
+        """ Keys survive through snapshots and the journal after them """
+        d = dedupe.KeyDeduper( self.path, capacity=100, window=10, snapshot_interval=20 )
+        for x in range( 50 ):
+            d.add( key( x ) )
+        self.assertLess( os.path.getsize( d.journal_path ), 20 * len( key( 0 ) + '\n' ) )
+
+        recovered = dedupe.KeyDeduper( self.path, capacity=100, window=10, snapshot_interval=20 )
+        self.assertTrue( all( recovered.seen( key( x ) ) for x in range( 50 ) ) )
+        self.assertEqual( list( recovered.window ), [key( x ) for x in range( 40, 50 )] )
+
+    def test_missing_directory(self):
+        """ The directory is created on the first key, before any cursor write """
+        path = os.path.join( self.dir, 'cursors', 'consumer' + dedupe.DEDUPE_SUFFIX )
+        d = dedupe.KeyDeduper( path, capacity=100, window=10, snapshot_interval=2 )
+        d.add( key( 1 ) )
+        d.add( key( 2 ) )
+        self.assertTrue( os.path.exists( path ) )
+        self.assertTrue( dedupe.KeyDeduper( path, capacity=100, window=10 ).seen( key( 1 ) ) )
+
+    def test_memory_budget(self):
+        """ max_bytes bounds the Bloom filter memory """
+        d = dedupe.KeyDeduper( self.path, max_bytes=64 * 1024 )
+        self.assertLessEqual( d.bloom.memory, 64 * 1024 + 2 )
+
+
+class TestDedupeConsumer( unittest.TestCase ):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+    def test_fresh_cursor_location(self):
+        """ A deduping consumer whose cursor directory does not exist yet consumes and skips replays """
+        location = os.path.join( self.dir, 'cursors' )
+        config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':location},
+        }
+        bucket = FakeBucket()
+        for x in range( 3 ):
+            bucket.put( message_key( x ), b'%d' % x )
+
+        received = []
+        def consumer():
+            c = FakeBucketConsumer( 'Muskrat.Test.Segments', received.append, name='dedupe', config=config, dedupe=True )
+            c.fake_bucket = bucket
+            return c
+
+        c = consumer()
+        c.consume()
+        c.close()
+        self.assertEqual( received, [b'0', b'1', b'2'] )
+
+        #Without the cursor every message is replayed, and skipped through the journal
+        os.remove( os.path.join( location, 'dedupe' ) )
+        c = consumer()
+        c.consume()
+        c.close()
+        self.assertEqual( received, [b'0', b'1', b'2'] )
+
+
+if '__main__' == __name__:
+    unittest.main()
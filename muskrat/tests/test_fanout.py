@@ -0,0 +1,124 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for shared subscriptions.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try: from unittest import mock
+except ImportError: import mock
+
+from ..fanout import SharedSubscription
+from .fakes import FakeBucket, FakeBucketConsumer, FakeObject
+
+PREFIX = 'MUSKRAT/FANOUT'
+
+
+def message_key( x ):
+    return '%s/2013-02-21T00:00:%02d.000000' % (PREFIX, x)
+
+
+class TestSharedSubscription( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        self.bucket = FakeBucket()
+        for x in range( 10 ):
+            self.bucket.put( message_key( x ), ( '%d' % x ).encode( 'utf-8' ) )
+
+        self.lock = threading.Lock()
+        self.gets = 0
+        get = FakeObject.get
+        def counting_get(obj):
+            with self.lock:
+                self.gets += 1
+            return get( obj )
+        patcher = mock.patch.object( FakeObject, 'get', counting_get )
+        patcher.start()
+        self.addCleanup( patcher.stop )
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def subscriber(self, subscription, name, func, position=None, **kwargs):
+        if position is not None:
+            with open( os.path.join( self.cursor_dir, name ), 'w' ) as f:
+                f.write( position )
+        consumer = FakeBucketConsumer( 'Muskrat.Fanout', func, name=name, config=self.config, **kwargs )
+        consumer.fake_bucket = self.bucket
+        return subscription.add( consumer )
+
+    def cursor_position(self, name):
+        with open( os.path.join( self.cursor_dir, name ) ) as f:
+            return f.read()
+
+    def test_single_fetch(self):
+        """ Every message is fetched once and delivered from each subscriber's own position """
+        fresh, behind = [], []
+        subscription = SharedSubscription( 'Muskrat.Fanout', config=self.config, buffer_size=2, fetch_workers=3 )
+        self.subscriber( subscription, 'fresh', fresh.append )
+        self.subscriber( subscription, 'behind', behind.append, position=message_key( 5 ) )
+
+        self.assertEqual( subscription.consume(), 10 )
+        self.assertEqual( self.gets, 10 )
+        self.assertEqual( fresh, [( '%d' % x ).encode( 'utf-8' ) for x in range( 10 )] )
+        self.assertEqual( behind, [b'6', b'7', b'8', b'9'] )
+        self.assertEqual( self.cursor_position( 'fresh' ), message_key( 9 ) )
+        self.assertEqual( self.cursor_position( 'behind' ), message_key( 9 ) )
+
+        self.assertEqual( subscription.consume(), 0 )
+
+    def test_listing_starts_at_oldest_cursor(self):
+        """ Messages every subscriber has consumed are not listed or fetched """
+        received = []
+        subscription = SharedSubscription( 'Muskrat.Fanout', config=self.config )
+        self.subscriber( subscription, 'a', received.append, position=message_key( 7 ) )
+        self.subscriber( subscription, 'b', received.append, position=message_key( 8 ) )
+        self.assertEqual( subscription.consume(), 2 )
+        self.assertEqual( self.gets, 2 )
+        self.assertEqual( sorted( received ), [b'8', b'9', b'9'] )
+
+    def test_unmatched_not_fetched(self):
+        """ Messages no subscriber's match accepts are skipped without a GET """
+        received = []
+        subscription = SharedSubscription( 'Muskrat.Fanout', config=self.config )
+        self.subscriber( subscription, 'none', received.append, match=lambda attributes: False )
+        subscription.consume()
+        self.assertEqual( (received, self.gets), ([], 0) )
+        self.assertEqual( self.cursor_position( 'none' ), message_key( 9 ) )
+
+    def test_failing_subscriber(self):
+        """ A failing subscriber stops at the failed message without holding up the others """
+        received = []
+        def fail_third(body):
+            if body == b'3':
+                raise ValueError( 'failed' )
+
+        subscription = SharedSubscription( 'Muskrat.Fanout', config=self.config, buffer_size=1 )
+        self.subscriber( subscription, 'failing', fail_third )
+        self.subscriber( subscription, 'healthy', received.append )
+        with self.assertRaises( ValueError ):
+            subscription.consume()
+        self.assertEqual( len( received ), 10 )
+        self.assertEqual( self.cursor_position( 'failing' ), message_key( 2 ) )
+
+    def test_routing_key_mismatch(self):
+        """ Only consumers of the subscription's routing key can be added """
+        consumer = FakeBucketConsumer( 'Muskrat.Other', len, name='other', config=self.config )
+        with self.assertRaises( ValueError ):
+            SharedSubscription( 'Muskrat.Fanout', config=self.config ).add( consumer )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the local append-log broker.
+"
+"""
+from __future__ import absolute_import
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import filebroker
+from ..producer import Producer
+
+ROUTING_KEY = 'Muskrat.File'
+
+
+def config_for( location ):
+    return {
+        's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+        's3_cursor':{'type':'file', 'location':os.path.join( location, 'cursors' )},
+        'file_broker':{'location':os.path.join( location, 'log' )},
+    }
+
+
+def produce( location, worker, count ):
+    producer = filebroker.FileProducer( routing_key=ROUTING_KEY, config=config_for( location ) )
+    for x in range( count ):
+        producer.send( '%d-%d' % (worker, x) )
+
+
+class TestFileBroker( unittest.TestCase ):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.config = config_for( self.location )
+        self.received = []
+
+    def tearDown(self):
+        shutil.rmtree( self.location )
+
+    def producer(self, **kwargs):
+        return filebroker.FileProducer( routing_key=ROUTING_KEY, config=self.config, **kwargs )
+
+    def consumer(self, **kwargs):
+        return filebroker.FileConsumer( ROUTING_KEY, self.received.append, name='file', config=self.config, **kwargs )
+
+    def test_roundtrip(self):
+        """ Messages are consumed in order and the cursor resumes after the last one """
+        producer = self.producer()
+        keys = [producer.send( 'msg%d' % x ) for x in range( 5 )]
+        self.assertEqual( keys, sorted( keys ) )
+        self.assertTrue( keys[0].startswith( 'MUSKRAT/FILE/' ) )
+
+        self.consumer().consume()
+        self.assertEqual( self.received, [( 'msg%d' % x ).encode( 'utf-8' ) for x in range( 5 )] )
+
+        producer.send( 'late' )
+        self.consumer().consume()
+        self.assertEqual( self.received[5:], [b'late'] )
+
+    def test_segment_roll(self):
+        """ Small segments roll over and a cursor in a later segment skips earlier ones """
+        producer = self.producer( segment_size=64 )
+        keys = [producer.send( 'x' * 20 ) for x in range( 10 )]
+        directory = os.path.join( self.config['file_broker']['location'], 'MUSKRAT', 'FILE' )
+        self.assertTrue( len( filebroker._segments( directory ) ) > 1 )
+
+        collection = filebroker.FileCollection( self.config['file_broker']['location'], 'MUSKRAT/FILE' )
+        self.assertEqual( [m.key for m in collection.filter( Marker=keys[6] )], keys[7:] )
+
+    def test_send_many(self):
+        """ Batches are appended in one write with increasing keys """
+        results = self.producer().send_many( ['a', 'b', 'c'] )
+        self.assertTrue( all( r.ok for r in results ) )
+        self.consumer().consume()
+        self.assertEqual( self.received, [b'a', b'b', b'c'] )
+
+    def test_torn_write(self):
+        """ A partial record at the end of a log is ignored by consumers and dropped by producers """
+        producer = self.producer()
+        first = producer.send( 'first' )
+        directory = os.path.join( self.config['file_broker']['location'], 'MUSKRAT', 'FILE' )
+        path = os.path.join( directory, filebroker._segments( directory )[-1] )
+        with open( path, 'ab' ) as f:
+            f.write( filebroker.encode_record( first + '0', b'torn' )[:-3] )
+
+        self.consumer().consume()
+        self.assertEqual( self.received, [b'first'] )
+
+        producer.send( 'second' )
+        self.consumer().consume()
+        self.assertEqual( self.received, [b'first', b'second'] )
+
+    def test_short_torn_write(self):
+        """ A torn record shorter than a trailer is dropped before the next append """
+        producer = self.producer()
+        producer.send( 'first' )
+        directory = os.path.join( self.config['file_broker']['location'], 'MUSKRAT', 'FILE' )
+        path = os.path.join( directory, filebroker._segments( directory )[-1] )
+        with open( path, 'ab' ) as f:
+            f.write( b'\x01\x02' )
+
+        producer.send( 'second' )
+        self.consumer().consume()
+        self.assertEqual( self.received, [b'first', b'second'] )
+
+    def test_tee_key_name(self):
+        """ The log takes the key name chosen by a teeing Producer """
+        producer = Producer( brokers=[filebroker.FileProducer], routing_key=ROUTING_KEY, config=self.config )
+        key = producer.brokers[0].send( 'teed', key_name='MUSKRAT/FILE/2013-02-21T00:00:00.000000' )
+        self.assertEqual( key, 'MUSKRAT/FILE/2013-02-21T00:00:00.000000' )
+        #Older than the log's newest key, so a fresh one is generated
+        self.assertNotEqual( producer.brokers[0].send( 'old', key_name='MUSKRAT/FILE/2012-01-01T00:00:00.000000' ),
+                             'MUSKRAT/FILE/2012-01-01T00:00:00.000000' )
+
+    def test_multiple_processes(self):
+        """ Concurrent producer processes keep keys unique and increasing """
+        workers = [multiprocessing.Process( target=produce, args=(self.location, x, 50) ) for x in range( 4 )]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        collection = filebroker.FileCollection( self.config['file_broker']['location'], 'MUSKRAT/FILE' )
+        keys = [m.key for m in collection]
+        self.assertEqual( len( keys ), 200 )
+        self.assertEqual( keys, sorted( set( keys ) ) )
+
+    def test_sharded(self):
+        """ Sharded logs are merged back into key order """
+        producer = self.producer( shards=3 )
+        for x in range( 9 ):
+            producer.send( '%d' % x )
+        self.consumer( shards=3 ).consume()
+        self.assertEqual( self.received, [( '%d' % x ).encode( 'utf-8' ) for x in range( 9 )] )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,223 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the hybrid RabbitMQ/S3 consumer and key name teeing.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+try: from unittest import mock
+except ImportError: import mock
+
+from .. import hybrid
+from ..producer import Producer, S3Producer, BaseProducer, KEY_HEADER
+from .fakes import FakeBucket, PREFIX, message_key
+
+
+class FakeHybridConsumer( hybrid.HybridConsumer ):
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+class FakeChannel(object):
+    """ Stand-in for a pika BlockingChannel, with the pika 1.x call signatures """
+    def __init__(self):
+        self.acked = []
+        self.nacked = []
+        self.calls = []
+        self.on_message = None
+
+    def exchange_declare(self, exchange, exchange_type='direct'):
+        self.calls.append( ('exchange_declare', exchange, exchange_type) )
+
+    def basic_qos(self, prefetch_count=0):
+        self.calls.append( ('basic_qos', prefetch_count) )
+
+    def queue_declare(self, queue, durable=False):
+        self.calls.append( ('queue_declare', queue, durable) )
+
+    def queue_bind(self, queue, exchange, routing_key=None):
+        self.calls.append( ('queue_bind', queue, exchange, routing_key) )
+
+    def basic_consume(self, queue, on_message_callback):
+        self.calls.append( ('basic_consume', queue) )
+        self.on_message = on_message_callback
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append( delivery_tag )
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.nacked.append( delivery_tag )
+
+
+class FakeConnection(object):
+    def __init__(self, channel):
+        self._channel = channel
+
+    def channel(self):
+        return self._channel
+
+    def close(self):
+        pass
+
+
+class FakeMethod(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class FakeHeader(object):
+    def __init__(self, key):
+        self.headers = {KEY_HEADER:key} if key else None
+
+
+class TestHybridConsumer( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        self.bucket = FakeBucket()
+        for x in range( 5 ):
+            self.bucket.put( message_key( x ), ( '%d' % x ).encode( 'utf-8' ) )
+
+        self.received = []
+        self.channel = FakeChannel()
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def consumer(self, func=None, **kwargs):
+        c = FakeHybridConsumer( PREFIX.replace( '/', '.' ), func or self.received.append, name='hybrid',
+                                config=self.config, **kwargs )
+        c.fake_bucket = self.bucket
+        return c
+
+    def deliver(self, consumer, tag, key, body):
+        consumer._on_message( self.channel, FakeMethod( tag ), FakeHeader( key ), body )
+
+    def cursor_position(self):
+        with open( os.path.join( self.cursor_dir, 'hybrid' ) ) as f:
+            return f.read()
+
+    def test_dedupe_across_sources(self):
+        """ Messages seen on one source are skipped on the other """
+        c = self.consumer()
+        self.deliver( c, 1, message_key( 3 ), b'3' )
+        c.gap_fill()
+        self.deliver( c, 2, message_key( 4 ), b'4' )
+        self.deliver( c, 3, message_key( 5 ), b'5' )
+        c.close()
+
+        self.assertEqual( self.received, [b'3', b'0', b'1', b'2', b'4', b'5'] )
+        self.assertEqual( self.channel.acked, [1, 2, 3] )
+        self.assertEqual( self.cursor_position(), message_key( 5 ) )
+
+    def test_gap_fill_overlap(self):
+        """ Gap filling rewinds by overlap so late S3 writes are picked up """
+        c = self.consumer( overlap=3 )
+        self.deliver( c, 1, message_key( 4 ), b'4' )
+        c.gap_fill()
+        c.close()
+        #The listing starts after the message exactly overlap seconds back
+        self.assertEqual( self.received, [b'4', b'2', b'3'] )
+        self.assertEqual( self.cursor_position(), message_key( 4 ) )
+
+    def test_without_key_header(self):
+        """ Deliveries without a key are processed without moving the cursor """
+        c = self.consumer()
+        self.deliver( c, 1, None, b'plain' )
+        self.assertEqual( self.received, [b'plain'] )
+        self.assertEqual( c.position, None )
+        c.close()
+
+    def test_failure_nacks(self):
+        """ A failing callback nacks the delivery and leaves the cursor """
+        def fail(body):
+            raise ValueError( 'failed' )
+
+        c = self.consumer( fail )
+        with self.assertRaises( ValueError ):
+            self.deliver( c, 7, message_key( 3 ), b'3' )
+        c.close()
+        self.assertEqual( self.channel.nacked, [7] )
+        self.assertEqual( c.position, None )
+
+    def test_connect(self):
+        """ Connecting binds the durable queue to the routing key and consumes into the handler """
+        self.config.update( {'host':'localhost', 'exchange_name':'muskrat', 'exchange_type':'topic'} )
+        c = self.consumer()
+        with mock.patch( 'pika.BlockingConnection', return_value=FakeConnection( self.channel ) ):
+            c.connect()
+
+        self.assertEqual( self.channel.calls, [
+            ('exchange_declare', 'muskrat', 'topic'),
+            ('basic_qos', 100),
+            ('queue_declare', 'hybrid', True),
+            ('queue_bind', 'hybrid', 'muskrat', c.routing_key),
+            ('basic_consume', 'hybrid'),
+        ] )
+        self.channel.on_message( self.channel, FakeMethod( 1 ), FakeHeader( message_key( 0 ) ), b'0' )
+        c.close()
+        self.assertEqual( self.received, [b'0'] )
+        self.assertEqual( self.channel.acked, [1] )
+
+    def test_shards_unsupported(self):
+        """ Sharded routing keys are rejected """
+        with self.assertRaises( ValueError ):
+            self.consumer( shards=4 )
+
+
+class RecordingProducer( BaseProducer ):
+    def __init__(self, **kwargs):
+        super( RecordingProducer, self ).__init__( **kwargs )
+        self.sent = []
+
+    def send(self, msg, **kwargs):
+        self.sent.append( (msg, kwargs.get( 'key_name' )) )
+
+
+class RecordingS3Producer( S3Producer ):
+    def __init__(self, **kwargs):
+        super( RecordingS3Producer, self ).__init__( **kwargs )
+        self.sent = []
+
+    def send(self, msg, **kwargs):
+        self.sent.append( (msg, kwargs.get( 'key_name' )) )
+
+    def send_many(self, msgs, **kwargs):
+        return BaseProducer.send_many( self, msgs, **kwargs )
+
+
+class TestKeyTee( unittest.TestCase ):
+
+    def setUp(self):
+        self.config = {'s3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f'}
+
+    def test_send_shares_key_name(self):
+        """ Every broker receives the key name the S3 broker generated """
+        p = Producer( brokers=[RecordingS3Producer, RecordingProducer], routing_key='Muskrat.Tee', config=self.config )
+        p.send( 'msg' )
+        s3, other = p.brokers
+        self.assertEqual( s3.sent, other.sent )
+        self.assertTrue( s3.sent[0][1].startswith( 'MUSKRAT/TEE/' ) )
+
+    def test_send_many_shares_key_names(self):
+        """ Batches are named once and every broker receives the same names """
+        p = Producer( brokers=[RecordingS3Producer, RecordingProducer], routing_key='Muskrat.Tee', config=self.config )
+        p.send_many( ['a', 'b', 'c'] )
+        s3, other = p.brokers
+        self.assertEqual( s3.sent, other.sent )
+        self.assertEqual( len( set( key for msg, key in s3.sent ) ), 3 )
+
+
+if '__main__' == __name__:
+    unittest.main()
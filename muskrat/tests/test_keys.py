@@ -0,0 +1,50 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the key names producers write messages under.
+"
+"""
+from __future__ import absolute_import
+import unittest
+from   datetime import datetime
+try: from unittest import mock
+except ImportError: import mock
+
+from .. import producer
+from ..producer import S3Producer
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class FrozenDatetime( datetime ):
+    """ A clock that does not move between sends """
+    @classmethod
+    def today(cls):
+        return cls( 2013, 2, 21 )
+
+
+class TestKeyNames( unittest.TestCase ):
+
+    def setUp(self):
+        self.producer = S3Producer( config={'s3_timestamp_format':TIMESTAMP_FORMAT}, routing_key='Muskrat.Keys' )
+
+    def test_consecutive_sends(self):
+        """ Keys from consecutive sends are unique and ordered while the clock stands still """
+        with mock.patch.object( producer, 'datetime', FrozenDatetime ):
+            keys = self.producer._create_key_names( 'MUSKRAT.KEYS', 1000 )
+            keys += [self.producer._create_key_name( 'MUSKRAT.KEYS' )]
+            keys += self.producer._create_key_names( 'MUSKRAT.KEYS', 1000 )
+        self.assertEqual( len( set( keys ) ), len( keys ) )
+        self.assertEqual( sorted( keys ), keys )
+
+    def test_batch_starts_now(self):
+        """ Once the clock passes the last key, a batch is stamped from the current time """
+        self.producer._last_stamp = datetime( 2013, 2, 20 )
+        with mock.patch.object( producer, 'datetime', FrozenDatetime ):
+            key = self.producer._create_key_names( 'MUSKRAT.KEYS', 3 )[0]
+        self.assertEqual( key, 'MUSKRAT/KEYS/2013-02-21T00:00:00.000000' )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,149 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the local producer to consumer wake-up channel.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from .. import notify
+from .fakes import FakeBucket, FakeBucketConsumer, message_key
+
+
+@unittest.skipUnless( notify.SUPPORTED, 'Unix sockets are not available' )
+class TestNotify( unittest.TestCase ):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.notifier = notify.Notifier( self.location, refresh=0 )
+
+    def tearDown(self):
+        self.notifier.close()
+        shutil.rmtree( self.location )
+
+    def test_key_routing_key(self):
+        """ Shard sub-prefixes are not part of the routing key """
+        self.assertEqual( notify.key_routing_key( 'FRONTEND/SIGNUP/shard003/2013-02-21T00:00:00.000000' ),
+                          'FRONTEND.SIGNUP' )
+        self.assertEqual( notify.key_routing_key( 'FRONTEND/SIGNUP/2013-02-21T00:00:00.000000' ), 'FRONTEND.SIGNUP' )
+
+    def test_wakeup(self):
+        """ Listeners of the routing key are woken, others are not """
+        listener = notify.Listener( 'Frontend.Signup', 'consumer', location=self.location )
+        other = notify.Listener( 'Frontend.Login', 'consumer', location=self.location )
+        try:
+            self.assertFalse( listener.wait( 0 ) )
+            self.assertEqual( self.notifier.notify_key( 'FRONTEND/SIGNUP/2013-02-21T00:00:00.000000' ), 1 )
+            self.notifier.notify( 'Frontend.Signup' )
+            self.assertTrue( listener.wait( 1 ) )
+            #Both notifications were folded into one wake-up
+            self.assertFalse( listener.wait( 0 ) )
+            self.assertFalse( other.wait( 0 ) )
+        finally:
+            listener.close()
+            other.close()
+
+    def test_long_routing_key(self):
+        """ Routing keys of any length fit in a socket path """
+        routing_key = '.'.join( ['Frontend'] * 30 )
+        listener = notify.Listener( routing_key, 'consumer', location=self.location )
+        try:
+            self.assertEqual( self.notifier.notify( routing_key ), 1 )
+            self.assertTrue( listener.wait( 1 ) )
+        finally:
+            listener.close()
+
+    def test_stale_socket(self):
+        """ Sockets left by exited consumers are removed """
+        listener = notify.Listener( 'Frontend.Signup', 'consumer', location=self.location )
+        listener._socket.close()
+        self.assertEqual( self.notifier.notify( 'Frontend.Signup' ), 0 )
+        self.assertFalse( os.path.exists( listener.path ) )
+
+
+@unittest.skipUnless( notify.SUPPORTED, 'Unix sockets are not available' )
+class TestNotifiedConsumptionLoop( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.location = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+        shutil.rmtree( self.location )
+
+    def test_loop_wakes_early(self):
+        """ A signalled write is consumed well before the poll interval ends """
+        received = []
+        done = threading.Event()
+
+        def callback(body):
+            received.append( ( body, time.time() ) )
+            if body == b'stop':
+                raise KeyboardInterrupt
+
+        bucket = FakeBucket()
+        c = FakeBucketConsumer( 'Muskrat.Test.Segments', callback, name='notified', config=self.config,
+                                notify={'location':self.location, 'min_interval':0} )
+        c.fake_bucket = bucket
+
+        def loop():
+            try:
+                c.consumption_loop( interval=30 )
+            finally:
+                c.close()
+                done.set()
+
+        thread = threading.Thread( target=loop )
+        thread.daemon = True
+        thread.start()
+
+        notifier = notify.Notifier( self.location, refresh=0 )
+        try:
+            #Wait for the consumer to bind and make its first (empty) poll
+            deadline = time.time() + 5
+            while not notifier._paths( 'MUSKRAT.TEST.SEGMENTS' ) and time.time() < deadline:
+                time.sleep( 0.01 )
+            time.sleep( 0.05 )
+
+            sent = time.time()
+            bucket.put( message_key( 0 ), b'stop' )
+            notifier.notify_key( message_key( 0 ) )
+            self.assertTrue( done.wait( 5 ) )
+        finally:
+            notifier.close()
+
+        self.assertEqual( received[0][0], b'stop' )
+        self.assertLess( received[0][1] - sent, 5 )
+
+    def test_loop_without_socket(self):
+        """ A socket that cannot be bound falls back to polling """
+        def callback(body):
+            raise KeyboardInterrupt
+
+        bucket = FakeBucket()
+        bucket.put( message_key( 0 ), b'stop' )
+        #A location nested under a regular file cannot hold sockets
+        location = os.path.join( self.location, 'file' )
+        open( location, 'w' ).close()
+        c = FakeBucketConsumer( 'Muskrat.Test.Segments', callback, name='notified', config=self.config,
+                                notify={'location':os.path.join( location, 'sockets' )} )
+        c.fake_bucket = bucket
+        c.consumption_loop( interval=0 )
+        c.close()
+        self.assertIsNone( c._listener )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -67,6 +67,13 @@ class TestProducer( TestProducerBase ):
         p.send_json( self.json_msg )
         p.send_json( {'Testing':'yes', 'date':datetime.today()} )
 
+    def test_send_many(self):
+        """ Batch send through the brokers reports a result per message """
+        p = producer.Producer( routing_key = self.key )
+        results = p.send_many( [self.msg] * 3 )
+        self.assertEqual( len( results ), 3, 'Result count does not match message count' )
+        self.assertTrue( all( result.ok for result in results ), 'Batch send reported failures' )
+
         
 
 class TestS3Producer( TestProducerBase ):
@@ -101,6 +108,18 @@ class TestS3Producer( TestProducerBase ):
                 re.compile( r'%s/\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{6}' % self.key ),
                 'Key does not match expected format' )
 
+    def test_sharded_key_generation(self):
+        """ Generating sharded keys """
+        p = producer.S3Producer( routing_key = self.key, shards=4 )
+        self.assertRegexpMatches( 
+                p._create_key_name( self.key ), 
+                re.compile( r'%s/shard00[0-3]/\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{6}' % self.key.replace( '.', '/' ) ),
+                'Sharded key does not match expected format' )
+        self.assertEqual( 
+                p._create_key_name( self.key, shard_key='tenant' ).rsplit( '/', 1 )[0],
+                p._create_key_name( self.key, shard_key='tenant' ).rsplit( '/', 1 )[0],
+                'Shard key did not pin messages to a shard' )
+
     def test_send(self):
         """ Sending a message """
         routing_key = self.key + '.send'
@@ -139,12 +158,32 @@ class TestS3Producer( TestProducerBase ):
         #Wipe the key
         self.delete_key( routing_key )
 
+    def test_send_many(self):
+        """ Sending a batch of messages """
+        routing_key = self.key + '.send_many'
+        known_key = routing_key.upper().replace( '.', '/' )
+        p = producer.S3Producer( routing_key = routing_key )
+        msgs = ['Batch message %d' % x for x in range( 5 )]
+
+        results = p.send_many( msgs )
+        self.assertEqual( [result.msg for result in results], msgs, 'Results not in message order' )
+        self.assertEqual( sorted( result.key for result in results ), [result.key for result in results], 
+                          'Batch keys do not preserve message order' )
+
+        keys = self.bucket.get_all_keys( prefix=known_key )
+        self.assertEqual( 
+                [akey.get_contents_as_string() for akey in keys], 
+                msgs, 
+                'Received messages not the same as sent' )
+
+        self.delete_key( routing_key )
+
     def test_lifecycle_policy(self):
         pass
 
     def tearDown(self):
         self.delete_key( 'MUSKRAT' )
-        
+
 
 if '__main__' == __name__:
     unittest.main()
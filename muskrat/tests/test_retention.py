@@ -0,0 +1,109 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for retention policies.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import retention
+from .. import segments
+from .fakes import FakeBucket, PREFIX, message_key
+
+
+class FakeClient(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            del self.bucket.contents[ obj['Key'] ]
+        return {}
+
+class FakeMeta(object):
+    def __init__(self, bucket):
+        self.client = FakeClient( bucket )
+
+class FakeRetention( retention.Retention ):
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+class TestRetention( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+
+        self.bucket = FakeBucket()
+        self.bucket.name = 'muskrat'
+        self.bucket.meta = FakeMeta( self.bucket )
+        self.bucket.put( segments.segment_key_name( PREFIX, message_key( 2 ) ),
+                         segments.encode_segment( [(message_key( 1 ), b'1'), (message_key( 2 ), b'2')] ) )
+        for x in range( 3, 7 ):
+            self.bucket.put( message_key( x ), b'live' )
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def write_cursor(self, name, key):
+        with open( os.path.join( self.cursor_dir, name ), 'w' ) as f:
+            f.write( key )
+
+    def retention(self, **kwargs):
+        r = FakeRetention( PREFIX.replace( '/', '.' ), config=self.config, **kwargs )
+        r.fake_bucket = self.bucket
+        return r
+
+    def test_policy_required(self):
+        """ At least one policy must be enabled """
+        with self.assertRaises( ValueError ):
+            retention.Retention( PREFIX, config=self.config )
+
+    def test_cursors_required(self):
+        """ Deleting by consumed position alone needs the cursors to wait for """
+        with self.assertRaises( ValueError ):
+            retention.Retention( PREFIX, config=self.config, consumed=True )
+
+    def test_consumed_positions(self):
+        """ The consumed position is the slowest cursor's """
+        self.write_cursor( 'fast', message_key( 5 ) )
+        self.write_cursor( 'slow', message_key( 3 ) )
+        self.write_cursor( 'other', 'OTHER/KEY/2013-02-21T00:00:09.000000' )
+        self.assertEqual( self.retention( consumed=True, max_age=86400 ).consumed_positions(), {PREFIX:message_key( 3 )} )
+
+    def test_required_cursor_missing(self):
+        """ A named cursor without a position blocks deletes """
+        self.write_cursor( 'fast', message_key( 5 ) )
+        self.assertEqual( self.retention( consumed=True, cursors=['fast', 'new'] ).run(), {PREFIX:0} )
+
+    def test_consumed_delete(self):
+        """ Consumed segments and messages are deleted """
+        self.write_cursor( 'fast', message_key( 5 ) )
+        self.write_cursor( 'slow', message_key( 3 ) )
+        self.assertEqual( self.retention( consumed=True, cursors=['fast', 'slow'] ).run(), {PREFIX:2} )
+        self.assertEqual( sorted( self.bucket.contents ), [message_key( x ) for x in range( 4, 7 )] )
+
+    def test_dry_run(self):
+        """ Dry runs count without deleting """
+        self.write_cursor( 'slow', message_key( 4 ) )
+        self.assertEqual( self.retention( consumed=True, cursors=['slow'], dry_run=True ).run(), {PREFIX:3} )
+        self.assertEqual( len( self.bucket.contents ), 5 )
+
+    def test_max_age(self):
+        """ Everything older than max_age is deleted """
+        self.assertEqual( self.retention( max_age=60 ).run(), {PREFIX:5} )
+        self.assertEqual( self.bucket.contents, {} )
+
+
+if '__main__' == __name__:
+    unittest.main()
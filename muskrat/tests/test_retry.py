@@ -0,0 +1,376 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for retry policies, error classification, retry budgets, spill
+" files, S3 write thread retries, dead letter envelopes and redriving.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from   six.moves.queue import Queue
+
+try: from unittest import mock
+except ImportError: import mock
+
+from ..retry import RetryBudget, RetryPolicy, SpillFile, is_retryable, read_spill
+from ..concurrency import RequestTimeout
+from ..producer import S3WriteThread, SendResult, ThreadedS3Producer, WriteReport
+from .. import deadletter
+from ..deadletter import dead_letter_routing_key, encode_dead_letter, decode_dead_letter, format_traceback
+from .fakes import FakeBucket, FakeBucketConsumer, FakeBucketProducer
+
+
+class TestRetryPolicy( unittest.TestCase ):
+
+    def test_backoff(self):
+        """ Delays double per attempt up to max_delay """
+        policy = RetryPolicy( base_delay=1, max_delay=5, jitter=False )
+        self.assertEqual( [policy.delay( a ) for a in range( 1, 5 )], [1, 2, 4, 5] )
+
+    def test_jitter(self):
+        """ Jittered delays stay within the backoff value """
+        policy = RetryPolicy( base_delay=1, max_delay=5 )
+        for attempt in range( 1, 5 ):
+            self.assertTrue( 0 <= policy.delay( attempt ) <= min( 5, 2 ** ( attempt - 1 ) ) )
+
+    def test_call_retries(self):
+        """ call returns once func succeeds within the attempts """
+        calls = []
+        def flaky():
+            calls.append( 1 )
+            if len( calls ) < 3:
+                raise ValueError( 'flaky' )
+            return 'done'
+
+        self.assertEqual( RetryPolicy( attempts=3, base_delay=0 ).call( flaky ), 'done' )
+        self.assertEqual( len( calls ), 3 )
+
+    def test_call_exhausted(self):
+        """ The last exception is raised once the attempts are exhausted """
+        calls = []
+        def failing():
+            calls.append( 1 )
+            raise ValueError( 'failed' )
+
+        with self.assertRaises( ValueError ):
+            RetryPolicy( attempts=2, base_delay=0 ).call( failing )
+        self.assertEqual( len( calls ), 2 )
+
+    def test_call_fatal(self):
+        """ Errors the policy does not consider retryable are raised right away """
+        calls = []
+        def failing():
+            calls.append( 1 )
+            raise ValueError( 'failed' )
+
+        with self.assertRaises( ValueError ):
+            RetryPolicy( attempts=5, base_delay=0, retryable=is_retryable ).call( failing )
+        self.assertEqual( len( calls ), 1 )
+
+
+class S3Error( Exception ):
+    """ Stand-in for boto's S3ResponseError """
+    def __init__(self, status, error_code=None):
+        self.status = status
+        self.error_code = error_code
+
+
+class ClientError( Exception ):
+    """ Stand-in for botocore's ClientError """
+    def __init__(self, status, code):
+        self.response = {'Error':{'Code':code}, 'ResponseMetadata':{'HTTPStatusCode':status}}
+
+
+class TestRetryClassification( unittest.TestCase ):
+
+    def test_retryable(self):
+        """ Throttles, timeouts, connection errors and server errors are retried """
+        for error in ( S3Error( 503, 'SlowDown' ), S3Error( 500, 'InternalError' ), ClientError( 500, 'InternalError' ),
+                       S3Error( 400, 'RequestTimeout' ), RequestTimeout( 'late' ), ConnectionResetError( 'reset' ),
+                       socket.timeout() ):
+            self.assertTrue( is_retryable( error ), error )
+
+    def test_fatal(self):
+        """ Client errors and programming errors fail right away """
+        for error in ( S3Error( 403, 'AccessDenied' ), ClientError( 404, 'NoSuchBucket' ), S3Error( 400, 'InvalidArgument' ),
+                       TypeError( 'bad' ), ValueError( 'bad' ) ):
+            self.assertFalse( is_retryable( error ), error )
+
+    def test_local_os_errors(self):
+        """ OSErrors that are not network errors are fatal """
+        for error in ( PermissionError( 'denied' ), FileNotFoundError( 'missing' ), OSError( 'disk' ) ):
+            self.assertFalse( is_retryable( error ), error )
+
+
+class TestRetryBudget( unittest.TestCase ):
+
+    def test_budget(self):
+        """ Retries are capped to the reserve plus a share of the requests """
+        budget = RetryBudget( ratio=0.5, min_per_second=0.2, window=10 )
+        for i in range( 4 ):
+            budget.deposit()
+        #2 allowed for the requests and 2 for the reserve
+        self.assertEqual( [budget.withdraw() for i in range( 5 )], [True, True, True, True, False] )
+        self.assertEqual( budget.stats(), {'requests':4, 'retries':4, 'exhausted':1} )
+
+    def test_policy_budget(self):
+        """ A policy stops retrying once its budget is spent """
+        calls = []
+        def failing():
+            calls.append( 1 )
+            raise ConnectionResetError( 'reset' )
+
+        policy = RetryPolicy( attempts=10, base_delay=0, budget=RetryBudget( ratio=0, min_per_second=0.2, window=10 ) )
+        with self.assertRaises( ConnectionResetError ):
+            policy.call( failing )
+        self.assertEqual( len( calls ), 3 )
+
+
+class TestSpillFile( unittest.TestCase ):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.path = os.path.join( self.location, 'spill.jsonl' )
+
+    def tearDown(self):
+        shutil.rmtree( self.location )
+
+    def test_round_trip(self):
+        """ Spilled messages are read back with their keys and exact bodies """
+        spill = SpillFile( self.path )
+        spill.write( 'MUSKRAT/SPILL/1', b'\x00binary', S3Error( 403, 'AccessDenied' ) )
+        spill.write( 'MUSKRAT/SPILL/2', u'text', ConnectionResetError( 'reset' ) )
+        self.assertEqual( list( read_spill( self.path ) ),
+                          [('MUSKRAT/SPILL/1', b'\x00binary'), ('MUSKRAT/SPILL/2', b'text')] )
+
+
+class FailingKey( object ):
+    """ Key whose first PUTs raise the given errors """
+    def __init__(self, name, *errors):
+        self.name = name
+        self.errors = list( errors )
+        self.puts = []
+
+    def set_contents_from_string(self, msg):
+        self.puts.append( msg )
+        if self.errors:
+            raise self.errors.pop( 0 )
+
+
+class TestS3WriteThreadRetries( unittest.TestCase ):
+
+    def test_retries(self):
+        """ Retryable errors are retried, fatal ones fail at once, and the worker survives both """
+        flaky = FailingKey( 'flaky', ConnectionResetError( 'reset' ), ConnectionResetError( 'reset' ) )
+        denied = FailingKey( 'denied', TypeError( 'bad' ) )
+        down = FailingKey( 'down', *[ConnectionResetError( 'reset' )] * 5 )
+        fine = FailingKey( 'fine' )
+        queue = Queue()
+        for key in ( flaky, denied, down, fine ):
+            queue.put( ('msg', key) )
+
+        results = []
+        retry = RetryPolicy( attempts=3, base_delay=0, retryable=is_retryable )
+        thread = S3WriteThread( queue, timeout=0.1, retry=retry,
+                                on_result=lambda msg, key, error: results.append( (key.name, error) ) )
+        thread.run()
+        queue.join()
+
+        self.assertEqual( [(name, type( error )) for name, error in results],
+                          [('flaky', type( None )), ('denied', TypeError), ('down', ConnectionResetError),
+                           ('fine', type( None ))] )
+        self.assertEqual( [len( key.puts ) for key in ( flaky, denied, down, fine )], [3, 1, 3, 1] )
+
+    def test_failing_callback(self):
+        """ A raising on_result does not end the worker """
+        queue = Queue()
+        queue.put( ('msg', FailingKey( 'a' )) )
+        queue.put( ('msg', FailingKey( 'b' )) )
+        def on_result(msg, key, error):
+            raise ValueError( 'handler' )
+
+        thread = S3WriteThread( queue, timeout=0.1, on_result=on_result )
+        thread.run()
+        self.assertEqual( queue.unfinished_tasks, 0 )
+
+
+class TestWriteReport( unittest.TestCase ):
+
+    def test_counts(self):
+        """ Successes are only counted unless tracked, and kept failures are capped """
+        report = WriteReport( max_failures=2 )
+        report.add( SendResult( None, 'A', None ) )
+        for key in 'BCD':
+            report.add( SendResult( 'msg', key, ValueError( 'bad' ) ) )
+
+        self.assertFalse( report.ok )
+        self.assertEqual( (len( report ), report.succeeded_count, report.failed_count), (4, 1, 3) )
+        self.assertEqual( report.succeeded, [] )
+        self.assertEqual( [result.key for result in report.failed], ['B', 'C'] )
+        self.assertEqual( report.dropped, 1 )
+
+    def test_track(self):
+        """ track keeps a result for every success """
+        report = WriteReport( track=True )
+        report.add( SendResult( None, 'A', None ) )
+        self.assertTrue( report.ok )
+        self.assertEqual( [result.key for result in report.succeeded], ['A'] )
+
+
+class TestThreadedS3ProducerJoin( unittest.TestCase ):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.location )
+
+    def producer(self, **kwargs):
+        return ThreadedS3Producer( config={'s3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f'}, routing_key='Muskrat.Retry',
+                                   num_threads=2, retry=RetryPolicy( attempts=3, base_delay=0, retryable=is_retryable ),
+                                   **kwargs )
+
+    def join(self, producer):
+        """ Calls join() and fails the test instead of hanging when it does not return """
+        reports = []
+        thread = threading.Thread( target=lambda: reports.append( producer.join() ) )
+        thread.daemon = True
+        thread.start()
+        thread.join( 10 )
+        self.assertFalse( thread.is_alive(), 'join() did not return' )
+        return reports[0]
+
+    def test_send_many(self):
+        """ join() returns once every message of a batch was written """
+        p = FakeBucketThreadedProducer( config={'s3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f'},
+                                        routing_key='Muskrat.Retry', num_threads=2 )
+        p.fake_bucket = FakeBucket()
+        msgs = [( 'msg %d' % x ).encode( 'utf-8' ) for x in range( 50 )]
+        results = p.send_many( msgs )
+        report = self.join( p )
+
+        self.assertEqual( report.succeeded_count, 50 )
+        self.assertEqual( dict( (result.key, result.msg) for result in results ), p.fake_bucket.contents )
+
+    def test_join_reports_failures(self):
+        """ join() returns after fatal and exhausted writes and reports each message """
+        failures = []
+        spill = os.path.join( self.location, 'spill.jsonl' )
+        p = self.producer( on_failure=lambda msg, key_name, error: failures.append( key_name ), spill=spill,
+                           track_results=True )
+        keys = [FailingKey( 'good' ), FailingKey( 'denied', TypeError( 'bad' ) ),
+                FailingKey( 'down', *[ConnectionResetError( 'reset' )] * 5 ),
+                FailingKey( 'flaky', ConnectionResetError( 'reset' ) )]
+        for key in keys:
+            p._send( key.name.encode( 'utf-8' ), key )
+
+        report = self.join( p )
+        self.assertEqual( (report.succeeded_count, report.failed_count), (2, 2) )
+        self.assertEqual( sorted( result.key for result in report.succeeded ), ['flaky', 'good'] )
+        self.assertEqual( sorted( (result.key, result.msg) for result in report.failed ),
+                          [('denied', b'denied'), ('down', b'down')] )
+        self.assertEqual( sorted( failures ), ['denied', 'down'] )
+        self.assertEqual( sorted( read_spill( spill ) ), [('denied', b'denied'), ('down', b'down')] )
+        self.assertEqual( p.metrics()['failed'], 0 )
+
+        #Threads survived, and the next join() only reports the next messages
+        p._send( b'later', FailingKey( 'later' ) )
+        report = self.join( p )
+        self.assertEqual( (len( report ), report.failed, report.ok), (1, [], True) )
+
+    def test_failing_handler(self):
+        """ A raising on_failure does not stop the writes or hang join() """
+        def on_failure(msg, key_name, error):
+            raise ValueError( 'handler' )
+
+        p = self.producer( on_failure=on_failure )
+        for x in range( 4 ):
+            p._send( b'msg', FailingKey( 'denied', TypeError( 'bad' ) ) )
+        self.assertEqual( self.join( p ).failed_count, 4 )
+
+
+class FakeBucketThreadedProducer( ThreadedS3Producer ):
+    fake_bucket = None
+
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+class TestDeadLetterEnvelope( unittest.TestCase ):
+
+    def test_routing_key(self):
+        """ Dead letters are written under the DLQ prefix """
+        self.assertEqual( dead_letter_routing_key( 'Muskrat.Orders' ), 'DLQ.MUSKRAT.ORDERS' )
+
+    def test_round_trip(self):
+        """ The original body and error details survive the envelope """
+        data = encode_dead_letter( 'MUSKRAT.ORDERS', 'MUSKRAT/ORDERS/ts', b'\x00binary', ValueError( 'bad' ), 3,
+                                   consumer='orders' )
+        envelope = decode_dead_letter( data )
+        self.assertEqual( envelope['body'], b'\x00binary' )
+        self.assertEqual( envelope['key'], 'MUSKRAT/ORDERS/ts' )
+        self.assertEqual( envelope['attempts'], 3 )
+        self.assertEqual( envelope['consumer'], 'orders' )
+        self.assertIn( 'bad', envelope['error'] )
+
+    def test_traceback(self):
+        """ The traceback is taken from the error, outside of its except block """
+        def callback():
+            raise ValueError( 'bad' )
+        try:
+            callback()
+        except ValueError as e:
+            error = e
+
+        tb = format_traceback( error )
+        self.assertIn( 'in callback', tb )
+        self.assertIn( 'ValueError: bad', tb )
+
+
+
+class TestRedrive( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        bucket = FakeBucket()
+        for cls in (FakeBucketProducer, FakeBucketConsumer):
+            patcher = mock.patch.object( cls, 'fake_bucket', bucket )
+            patcher.start()
+            self.addCleanup( patcher.stop )
+        for name, cls in (('S3Producer', FakeBucketProducer), ('S3Consumer', FakeBucketConsumer)):
+            patcher = mock.patch.object( deadletter, name, cls )
+            patcher.start()
+            self.addCleanup( patcher.stop )
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def test_attributes(self):
+        """ Redriven messages keep the attributes of their original key """
+        dlq = FakeBucketProducer( routing_key=dead_letter_routing_key( 'Muskrat.Orders' ), config=self.config )
+        dlq.send( encode_dead_letter( 'MUSKRAT.ORDERS', 'MUSKRAT/ORDERS/2013-02-21T00:00:00.000000@type=refund',
+                                      b'refund', ValueError( 'bad' ), 3 ) )
+        dlq.send( encode_dead_letter( 'MUSKRAT.ORDERS', 'MUSKRAT/ORDERS/2013-02-21T00:00:01.000000@type=sale',
+                                      b'sale', ValueError( 'bad' ), 3 ) )
+        self.assertEqual( deadletter.redrive( 'Muskrat.Orders', config=self.config ), 2 )
+
+        received = []
+        consumer = FakeBucketConsumer( 'Muskrat.Orders', received.append, name='refunds', config=self.config,
+                                       match=lambda attributes: attributes.get( 'type' ) == 'refund' )
+        consumer.consume()
+        self.assertEqual( received, [b'refund'] )
+
+
+if '__main__' == __name__:
+    unittest.main()
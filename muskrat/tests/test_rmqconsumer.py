@@ -11,6 +11,8 @@ import json
 
 from .. import rmqconsumer
 from .. import producer
+from ..claimcheck import ClaimResolver, CLAIM_HEADER
+from .fakes import FakeChannel, FakeConnection, FakeMethod
 
 import pika
 
@@ -165,6 +167,170 @@ class TestProducerConsumerCommunication( TestConsumerBase ):
 
         self.assertEqual( self.body, self.received_message['body'], 'Message received as not the same as was sent!' )
 
+class TestBatchConsumer( TestConsumerBase ):
+
+    def setUp(self):
+        super( TestBatchConsumer, self ).setUp()
+        self.tp = producer.Producer( routing_key = self.routing_key )
+        self.bodies = ['Batch message 1', 'Batch message 2', 'Batch message 3']
+        self.received_batches = []
+
+    def test_batch_registration(self):
+        """ Batch consumer registers a channel named after the decorated function """
+        @self.cp.batch_consumer( self.routing_key, size=10 )
+        def test_batch( channel, messages ): pass
+
+        channel = self.cp.channels[ '%s.test_batch' % self.module ]
+        self.assertEqual( channel['prefetch_count'], 10 )
+        self.assertIsInstance( channel['callback'], rmqconsumer.BatchCollector )
+
+    def test_get_batch(self):
+        """ Messages are delivered to a batch consumer as one list """
+
+        @self.cp.batch_consumer( self.routing_key, size=len( self.bodies ), timeout=15000 )
+        def test_batch( channel, messages ):
+            self.received_batches.append( [body for method, header, body in messages] )
+            channel.stop_consuming()
+
+        for body in self.bodies:
+            self.tp.send( body )
+
+        self.cp.start_consumer_func( test_batch )
+
+        self.assertEqual( self.received_batches, [self.bodies], 'Batch received not the same as was sent!' )
+
+
+class FakeResolver(object):
+    def __init__(self, error=None):
+        self.error = error
+
+    def resolve_many(self, messages):
+        if self.error is not None:
+            raise self.error
+        return messages
+
+
+class FakePool(object):
+    def __init__(self, claims=None):
+        self.claims = claims or FakeResolver()
+        self._connection = FakeConnection()
+
+
+class TestBatchCollector( unittest.TestCase ):
+    """ Ack and nack handling of batches, without a broker """
+
+    def collector(self, func, pool=None, size=100, **kwargs):
+        self.pool = pool or FakePool()
+        collector = rmqconsumer.BatchCollector( self.pool, func, size=size, timeout=500, **kwargs )
+        collector.channel = self.channel = FakeChannel()
+        return collector
+
+    def deliver(self, collector, delivery_tag, body):
+        collector( self.channel, FakeMethod( delivery_tag ), None, body )
+
+    def test_flush_on_size(self):
+        """ A batch is flushed as soon as it holds size messages """
+        batches = []
+        collector = self.collector( lambda channel, messages: batches.append( [body for m, h, body in messages] ), size=2 )
+        self.deliver( collector, 1, b'a' )
+        self.assertEqual( batches, [] )
+        self.deliver( collector, 2, b'b' )
+        self.assertEqual( batches, [[b'a', b'b']] )
+        self.assertEqual( self.pool._connection.timers, [], 'Timer of the flushed batch was not cancelled' )
+        self.assertEqual( self.channel.acks, [2] )
+
+    def test_flush_on_timeout(self):
+        """ A partial batch is flushed when the timer of its first message fires """
+        batches = []
+        collector = self.collector( lambda channel, messages: batches.append( [body for m, h, body in messages] ) )
+        self.deliver( collector, 1, b'a' )
+        self.deliver( collector, 2, b'b' )
+        self.assertEqual( len( self.pool._connection.timers ), 1 )
+        self.pool._connection.fire_timers()
+        self.assertEqual( batches, [[b'a', b'b']] )
+        self.assertEqual( self.channel.acks, [2] )
+
+    def test_resolve_error_nacks(self):
+        """ A batch whose claim checked payloads cannot be fetched is nacked unhandled """
+        handled = []
+        collector = self.collector( lambda channel, messages: handled.append( messages ),
+                                    pool=FakePool( FakeResolver( IOError( 'GET failed' ) ) ) )
+        collector.messages = [(FakeMethod( 1 ), None, b'a')]
+        with self.assertRaises( IOError ):
+            collector.flush()
+        self.assertEqual( handled, [] )
+        self.assertEqual( (self.channel.acks, self.channel.nacks), ([], [(1, True)]) )
+
+    def test_ack(self):
+        """ A handled batch is acked up to its last delivery """
+        collector = self.collector( lambda channel, messages: None, serializer='json' )
+        collector.messages = [(FakeMethod( 1 ), None, b'{}'), (FakeMethod( 2 ), None, b'[]')]
+        collector.flush()
+        self.assertEqual( (self.channel.acks, self.channel.nacks), ([2], []) )
+
+    def test_decode_error_nacks(self):
+        """ A body that cannot be decoded nacks the whole batch """
+        handled = []
+        collector = self.collector( lambda channel, messages: handled.append( messages ), serializer='json' )
+        collector.messages = [(FakeMethod( 1 ), None, b'{}'), (FakeMethod( 2 ), None, b'not json')]
+        with self.assertRaises( ValueError ):
+            collector.flush()
+        self.assertEqual( handled, [] )
+        self.assertEqual( (self.channel.acks, self.channel.nacks), ([], [(2, True)]) )
+
+    def test_on_error(self):
+        """ on_error receives the failure of a nacked batch instead of it being raised """
+        errors = []
+        def failing(channel, messages):
+            raise IOError( 'PUT failed' )
+
+        collector = self.collector( failing, on_error=lambda error, messages: errors.append( (error, len( messages )) ) )
+        collector.messages = [(FakeMethod( 1 ), None, b'a')]
+        collector.flush()
+        self.assertEqual( [(type( error ), count) for error, count in errors], [(IOError, 1)] )
+        self.assertEqual( (self.channel.acks, self.channel.nacks), ([], [(1, True)]) )
+
+
+class TestConsumerPoolRegistration( unittest.TestCase ):
+    """ Registered consumers, over a fake connection """
+
+    def setUp(self):
+        self.claims = ClaimResolver( config={} )
+        self.claims.cache.put( 'CLAIMCHECK/TEST/KEY', b'{"claimed": true}' )
+        self.cp = rmqconsumer.ConsumerPool( config={'host':'localhost', 'exchange_name':'muskrat',
+                                                    'exchange_type':'topic'}, claims=self.claims )
+        self.cp._connection = FakeConnection()
+        self.claim = {CLAIM_HEADER:'CLAIMCHECK/TEST/KEY'}
+
+    def test_consumer(self):
+        """ Consumers receive claim checked payloads, decoded """
+        received = []
+        @self.cp.consumer( 'Muskrat.Queue.Tests', serializer='json' )
+        def receive( channel, method, header, body ):
+            received.append( body )
+
+        name = '%s.receive' % self.__module__
+        channel = self.cp.get_consumer_channel( name )
+        self.assertEqual( channel.routing_key, 'MUSKRAT.QUEUE.TESTS' )
+        channel.deliver( name, 1, b'{"claimed": false}' )
+        channel.deliver( name, 2, b'{}', headers=self.claim )
+        self.assertEqual( received, [{'claimed':False}, {'claimed':True}] )
+
+    def test_batch_consumer(self):
+        """ Batch consumers receive resolved batches and ack them once """
+        batches = []
+        @self.cp.batch_consumer( 'Muskrat.Queue.Tests', size=2, serializer='json' )
+        def receive_batch( channel, messages ):
+            batches.append( [body for method, header, body in messages] )
+
+        name = '%s.receive_batch' % self.__module__
+        channel = self.cp.get_consumer_channel( name )
+        self.assertEqual( channel.prefetch_count, 2 )
+        channel.deliver( name, 1, b'{"claimed": false}' )
+        channel.deliver( name, 2, b'{}', headers=self.claim )
+        self.assertEqual( batches, [[{'claimed':False}, {'claimed':True}]] )
+        self.assertEqual( (channel.acks, channel.nacks), ([2], []) )
+
 
 if '__main__' == __name__:
     unittest.main()
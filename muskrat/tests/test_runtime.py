@@ -0,0 +1,153 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the multiplexed consumer runtime.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ..runtime import Runtime
+from ..s3consumer import Consumer
+from .fakes import FakeBucket, FakeBucketConsumer
+
+
+class TestRuntime( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        self.bucket = FakeBucket()
+        self.lock = threading.Lock()
+        self.received = {}
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def fill(self, routing_key, count):
+        prefix = routing_key.upper().replace( '.', '/' )
+        for x in range( count ):
+            self.bucket.put( '%s/2013-02-21T00:%02d:%02d.000000' % (prefix, x // 60, x % 60), b'x' )
+
+    def consumer(self, routing_key, func=None, **kwargs):
+        def record(body):
+            with self.lock:
+                self.received[ routing_key ] = self.received.get( routing_key, 0 ) + 1
+        c = FakeBucketConsumer( routing_key, func or record, name=routing_key, config=self.config, **kwargs )
+        c.fake_bucket = self.bucket
+        return c
+
+    def cursor_position(self, name):
+        with open( os.path.join( self.cursor_dir, name ) ) as f:
+            return f.read()
+
+    def test_max_messages(self):
+        """ Stopping at max_messages keeps the cursor on the last message handled """
+        self.fill( 'Muskrat.Quantum', 10 )
+        c = self.consumer( 'Muskrat.Quantum' )
+        self.assertEqual( c.consume( max_messages=4 ), 4 )
+        self.assertEqual( self.cursor_position( 'Muskrat.Quantum' ), 'MUSKRAT/QUANTUM/2013-02-21T00:00:03.000000' )
+        self.assertEqual( c.consume( max_messages=4 ), 4 )
+        self.assertEqual( c.consume(), 2 )
+        self.assertEqual( self.received['Muskrat.Quantum'], 10 )
+
+    def test_max_messages_concurrent(self):
+        """ Concurrent consumers stop at max_messages and drain before returning """
+        self.fill( 'Muskrat.Quantum', 10 )
+        c = self.consumer( 'Muskrat.Quantum', workers=4 )
+        try:
+            self.assertEqual( c.consume( max_messages=6 ), 6 )
+            self.assertEqual( self.cursor_position( 'Muskrat.Quantum' ), 'MUSKRAT/QUANTUM/2013-02-21T00:00:05.000000' )
+        finally:
+            c.close()
+
+    def test_weighted_fair(self):
+        """ Backlogged consumers share runs in proportion to their weight """
+        runtime = Runtime( fetch_workers=1, quantum=5, interval=60 )
+        self.fill( 'Muskrat.Light', 200 )
+        self.fill( 'Muskrat.Heavy', 200 )
+
+        def stop_after(routing_key):
+            def record(body):
+                with self.lock:
+                    self.received[ routing_key ] = self.received.get( routing_key, 0 ) + 1
+                    if sum( self.received.values() ) >= 100:
+                        runtime.stop()
+            return record
+
+        runtime.register( self.consumer( 'Muskrat.Light', stop_after( 'Muskrat.Light' ) ), weight=1 )
+        runtime.register( self.consumer( 'Muskrat.Heavy', stop_after( 'Muskrat.Heavy' ) ), weight=3 )
+        runtime.run()
+
+        self.assertEqual( sum( self.received.values() ), 100 )
+        self.assertTrue( 2 <= self.received['Muskrat.Heavy'] / float( self.received['Muskrat.Light'] ) <= 4,
+                         self.received )
+
+    def test_caught_up_consumers(self):
+        """ Consumers run to the end of their backlog, decorated ones included, then idle """
+        runtime = Runtime( fetch_workers=4, quantum=3, interval=60 )
+        self.fill( 'Muskrat.One', 7 )
+        self.fill( 'Muskrat.Two', 2 )
+
+        @Consumer( 'Muskrat.Two', name='Muskrat.Two', config=self.config )
+        def two(body):
+            with self.lock:
+                self.received['Muskrat.Two'] = self.received.get( 'Muskrat.Two', 0 ) + 1
+        two.consumer.__class__ = FakeBucketConsumer
+        two.consumer.fake_bucket = self.bucket
+
+        one = runtime.register( self.consumer( 'Muskrat.One' ), max_in_flight=2 )
+        runtime.register( two )
+
+        def stop_when_idle():
+            if all( not entry.backlog and entry.runs for entry in runtime.consumers ):
+                runtime.stop()
+            else:
+                threading.Timer( 0.05, stop_when_idle ).start()
+        threading.Timer( 0.05, stop_when_idle ).start()
+        runtime.run()
+
+        self.assertEqual( self.received, {'Muskrat.One':7, 'Muskrat.Two':2} )
+        self.assertEqual( one.runs, 3 )
+        self.assertEqual( runtime.stats()['Muskrat.One']['messages'], 7 )
+
+    def test_errors(self):
+        """ A failing consumer is reported and does not stop the others """
+        runtime = Runtime( fetch_workers=2, quantum=10, interval=60 )
+        self.fill( 'Muskrat.Good', 3 )
+        self.fill( 'Muskrat.Bad', 3 )
+        errors = []
+
+        def fail(body):
+            raise ValueError( 'failed' )
+
+        def on_error(consumer, error):
+            errors.append( (consumer.name, error) )
+
+        runtime.on_error = on_error
+        runtime.register( self.consumer( 'Muskrat.Bad', fail ) )
+        runtime.register( self.consumer( 'Muskrat.Good' ) )
+
+        def stop_when_done():
+            if all( entry.runs for entry in runtime.consumers ):
+                runtime.stop()
+            else:
+                threading.Timer( 0.05, stop_when_done ).start()
+        threading.Timer( 0.05, stop_when_done ).start()
+        runtime.run()
+
+        self.assertEqual( self.received, {'Muskrat.Good':3} )
+        self.assertEqual( [name for name, error in errors], ['Muskrat.Bad'] )
+        self.assertEqual( runtime.stats()['Muskrat.Bad']['errors'], 1 )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -13,13 +13,22 @@ import tempfile
 import uuid
 from datetime import datetime
 
+import shutil
+import threading
+import time
+
 import boto
 import boto3
 
+try: from unittest import mock
+except ImportError: import mock
+
 os.environ['MUSKRAT'] = 'TEST'
 from ..producer   import S3Producer
-from ..s3consumer import S3Consumer, Consumer, S3Cursor
+from ..s3consumer import S3Consumer, Consumer, S3Cursor, ShardedS3Cursor
 from ..util      import config_loader
+from ..retry     import RetryPolicy
+from .fakes      import FakeBucket, FakeBucketConsumer, FakeDeadLetterQueue, FakeObject as FakeBodyObject
 
 config_path = 'config.py'
 TEST_KEY_PREFIX = 'Muskrat.Consumer'
@@ -33,6 +42,22 @@ class TempCursorFile():
     def __exit__(self, type, value, traceback):
         os.remove(self.path)
 
+class FakeObject(object):
+    """ Stand-in for an s3 ObjectSummary """
+    def __init__(self, key):
+        self.key = key
+
+class FakeCollection(object):
+    """ Stand-in for an s3 object collection supporting Marker filters """
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+
+    def filter(self, Marker=None, Delimiter=None, **kwargs):
+        return FakeCollection([key for key in self.keys if Marker is None or key > Marker])
+
+    def __iter__(self):
+        return iter([FakeObject(key) for key in self.keys])
+
 class TestS3ConsumerBase( unittest.TestCase ):
 
     def setUp(self):
@@ -209,5 +234,300 @@ class TestS3CollectionEach(unittest.TestCase):
             with open(path, 'r') as f:
                 self.assertEqual(last_key, f.read())
 
+class TestShardedS3Cursor(unittest.TestCase):
+    def setUp(self):
+        self.shards = {
+            'MUSKRAT/SHARDED/shard000':['MUSKRAT/SHARDED/shard000/2013-02-21T00:00:01.000000',
+                                        'MUSKRAT/SHARDED/shard000/2013-02-21T00:00:04.000000'],
+            'MUSKRAT/SHARDED/shard001':['MUSKRAT/SHARDED/shard001/2013-02-21T00:00:02.000000',
+                                        'MUSKRAT/SHARDED/shard001/2013-02-21T00:00:03.000000'],
+        }
+
+    def collections(self):
+        return dict((prefix, FakeCollection(keys)) for prefix, keys in self.shards.items())
+
+    def test_merge_order(self):
+        """ Shards are merged back into timestamp order """
+        with TempCursorFile() as path:
+            cursor = ShardedS3Cursor.at_path(path)
+            keys = [obj.key for obj in cursor.each(self.collections())]
+            self.assertEqual(keys, sorted(keys, key=lambda key: key.rsplit('/', 1)[-1]))
+            self.assertEqual(len(keys), 4)
+
+    def test_positions(self):
+        """ The cursor records and resumes from a position per shard """
+        with TempCursorFile() as path:
+            cursor = ShardedS3Cursor.at_path(path)
+            for obj in cursor.each(self.collections()):
+                if obj.key.endswith('00:00:03.000000'):
+                    break
+
+            positions = cursor.get_positions()
+            self.assertEqual(positions['MUSKRAT/SHARDED/shard000'], self.shards['MUSKRAT/SHARDED/shard000'][0])
+            self.assertEqual(positions['MUSKRAT/SHARDED/shard001'], self.shards['MUSKRAT/SHARDED/shard001'][0])
+
+            remaining = [obj.key for obj in cursor.each(self.collections())]
+            self.assertEqual(remaining, [self.shards['MUSKRAT/SHARDED/shard001'][1],
+                                         self.shards['MUSKRAT/SHARDED/shard000'][1]])
+
+    def test_advance(self):
+        """ advance records the last key of every shard """
+        with TempCursorFile() as path:
+            cursor = ShardedS3Cursor.at_path(path)
+            cursor.advance([obj.key for obj in cursor.filter_collection(self.collections())])
+            self.assertEqual(list(cursor.each(self.collections())), [])
+
+
+def shared_memory_callback(body):
+    """ Module level so it can run in a process pool """
+    if body == b'fail':
+        raise ValueError('failed')
+    return body
+
+
+class TestFakeBucketConsumerBase(unittest.TestCase):
+    """ Consumers reading 20 messages from an in-memory bucket """
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        self.fake_bucket = FakeBucket()
+        self.keys = ['MUSKRAT/CONCURRENT/2013-02-21T00:00:%02d.000000' % x for x in range(20)]
+        for x, key in enumerate(self.keys):
+            self.fake_bucket.put(key, ('%d' % x).encode('utf-8'))
+
+    def tearDown(self):
+        shutil.rmtree(self.cursor_dir)
+
+    def consumer(self, func, **kwargs):
+        consumer = FakeBucketConsumer('Muskrat.Concurrent', func, name='concurrent', config=self.config, **kwargs)
+        consumer.fake_bucket = self.fake_bucket
+        return consumer
+
+    def cursor_position(self):
+        with open(os.path.join(self.cursor_dir, 'concurrent')) as f:
+            return f.read()
+
+
+class TestConcurrentConsume(TestFakeBucketConsumerBase):
+
+    def test_out_of_order(self):
+        """ Callbacks run concurrently and the cursor ends at the last message """
+        lock = threading.Lock()
+        seen = []
+        def slow_first(body):
+            if body == b'0':
+                time.sleep(0.2)
+            with lock:
+                seen.append(body)
+
+        c = self.consumer(slow_first, workers=4)
+        try:
+            c.consume()
+        finally:
+            c.close()
+        self.assertEqual(len(seen), 20)
+        self.assertNotEqual(seen[0], b'0', 'Callbacks did not complete out of order')
+        self.assertEqual(self.cursor_position(), self.keys[-1])
+
+    def test_low_watermark_on_error(self):
+        """ A failed callback leaves the cursor before the failed message """
+        def fail_fifth(body):
+            if body == b'5':
+                raise ValueError('failed')
+
+        c = self.consumer(fail_fifth, workers=4)
+        try:
+            with self.assertRaises(ValueError):
+                c.consume()
+        finally:
+            c.close()
+        self.assertEqual(self.cursor_position(), self.keys[4])
+
+    def test_process_pool(self):
+        """ Bodies are handed to a process pool through shared memory """
+        self.fake_bucket.put(self.keys[-1] + 'X', b'fail')
+        c = self.consumer(shared_memory_callback, workers=2, executor='process')
+        try:
+            with self.assertRaises(ValueError):
+                c.consume()
+        finally:
+            c.close()
+        self.assertEqual(self.cursor_position(), self.keys[-1])
+
+
+class TestRetryDeadLetter(TestFakeBucketConsumerBase):
+
+    def consumer(self, func, **kwargs):
+        consumer = super(TestRetryDeadLetter, self).consumer(func, **kwargs)
+        consumer._dead_letters = FakeDeadLetterQueue()
+        return consumer
+
+    def test_retry_succeeds(self):
+        """ A callback failing fewer times than the attempts is retried in place """
+        calls = []
+        def flaky(body):
+            calls.append(body)
+            if body == b'3' and calls.count(body) < 3:
+                raise ValueError('flaky')
+
+        c = self.consumer(flaky, retry=RetryPolicy(attempts=3, base_delay=0))
+        c.consume()
+        self.assertEqual(calls.count(b'3'), 3)
+        self.assertEqual(c._dead_letters.letters, [])
+        self.assertEqual(self.cursor_position(), self.keys[-1])
+
+    def test_dead_letter(self):
+        """ Messages exhausting their attempts are dead lettered and consumption moves on """
+        def fail_fifth(body):
+            if body == b'5':
+                raise ValueError('failed')
+
+        c = self.consumer(fail_fifth, retry=RetryPolicy(attempts=2, base_delay=0))
+        c.consume()
+        self.assertEqual(len(c._dead_letters.letters), 1)
+        key, body, error, attempts = c._dead_letters.letters[0]
+        self.assertEqual((key, body, attempts), (self.keys[5], b'5', 2))
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(self.cursor_position(), self.keys[-1])
+
+    def test_dead_letter_concurrent(self):
+        """ Dead lettering lets the watermark pass failed messages """
+        def fail_fifth(body):
+            if body == b'5':
+                raise ValueError('failed')
+
+        c = self.consumer(fail_fifth, workers=4, retry=RetryPolicy(attempts=2, base_delay=0))
+        try:
+            c.consume()
+        finally:
+            c.close()
+        self.assertEqual([l[0] for l in c._dead_letters.letters], [self.keys[5]])
+        self.assertEqual(self.cursor_position(), self.keys[-1])
+
+    def test_dead_letter_process_pool(self):
+        """ Bodies of failed messages are recovered from shared memory for the dead letter """
+        self.fake_bucket.put(self.keys[-1] + 'X', b'fail')
+        c = self.consumer(shared_memory_callback, workers=2, executor='process')
+        try:
+            c.consume()
+        finally:
+            c.close()
+        self.assertEqual([l[:2] for l in c._dead_letters.letters], [(self.keys[-1] + 'X', b'fail')])
+        self.assertEqual(self.cursor_position(), self.keys[-1] + 'X')
+
+
+class TestHedgedReads(TestFakeBucketConsumerBase):
+
+    def test_hedged_reads(self):
+        """ Bodies are read through the hedger and reported by metrics """
+        seen = []
+        c = self.consumer(seen.append, hedge={'timeout':5})
+        try:
+            c.consume()
+            hedging = c.metrics()['hedging']
+        finally:
+            c.close()
+        self.assertEqual(len(seen), 20)
+        self.assertEqual(hedging['requests'], 20)
+        self.assertEqual(hedging['timeouts'], 0)
+        self.assertEqual(self.cursor_position(), self.keys[-1])
+
+    def test_hedge_reads_fresh_object(self):
+        """ The hedge of a slow GET reads through a new Object rather than the straggling one """
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slow_key = self.keys[5]
+        bucket = StragglerBucket(self.fake_bucket, slow_key, release)
+        self.fake_bucket = bucket
+
+        seen = []
+        c = self.consumer(seen.append, hedge={'min_samples':1, 'budget':1.0, 'timeout':5})
+        try:
+            c.consume()
+            hedging = c.metrics()['hedging']
+        finally:
+            c.close()
+        self.assertEqual(seen, [('%d' % x).encode('utf-8') for x in range(20)])
+        self.assertEqual(bucket.hedged, [slow_key])
+        self.assertEqual(hedging['hedge_wins'], 1)
+
+
+class TestMatch(TestFakeBucketConsumerBase):
+
+    def setUp(self):
+        super(TestMatch, self).setUp()
+        self.fake_bucket = FakeBucket()
+        self.keys = ['MUSKRAT/CONCURRENT/2013-02-21T00:00:%02d.000000@type=%s' % (x, 'signup' if x % 4 == 0 else 'login')
+                     for x in range(20)]
+        for x, key in enumerate(self.keys):
+            self.fake_bucket.put(key, ('%d' % x).encode('utf-8'))
+
+        self.gets = []
+        get = FakeBodyObject.get
+        def counting_get(obj):
+            self.gets.append(obj.key)
+            return get(obj)
+        patcher = mock.patch.object(FakeBodyObject, 'get', counting_get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def check(self, **kwargs):
+        seen = []
+        c = self.consumer(seen.append, match=lambda attributes: attributes.get('type') == 'signup', **kwargs)
+        try:
+            c.consume()
+        finally:
+            c.close()
+        signups = [key for key in self.keys if key.endswith('signup')]
+        self.assertEqual(sorted(seen), sorted(('%d' % x).encode('utf-8') for x in range(0, 20, 4)))
+        self.assertEqual(sorted(self.gets), signups, 'Non-matching messages were fetched')
+        self.assertTrue(self.keys[-1].endswith('login'))
+        self.assertEqual(self.cursor_position(), self.keys[-1])
+
+    def test_match(self):
+        """ Non-matching messages are never fetched but the cursor moves past them """
+        self.check()
+
+    def test_match_concurrent(self):
+        """ Matching skips GETs when consuming concurrently too """
+        self.check(workers=4)
+
+
+class StragglerCollection(object):
+    """ Object collection whose listed object for one key hangs on get() """
+    def __init__(self, collection, bucket):
+        self.collection = collection
+        self.bucket = bucket
+
+    def filter(self, **kwargs):
+        return StragglerCollection(self.collection.filter(**kwargs), self.bucket)
+
+    def __iter__(self):
+        for obj in self.collection:
+            if obj.key == self.bucket.slow_key:
+                obj.get = self.bucket.slow_get
+            yield obj
+
+
+class StragglerBucket(object):
+    def __init__(self, bucket, slow_key, release):
+        self.contents = bucket.contents
+        self.objects = StragglerCollection(bucket.objects, self)
+        self.slow_key = slow_key
+        self.release = release
+        self.hedged = []
+
+    def slow_get(self):
+        self.release.wait(5)
+        raise IOError('straggler')
+
+    def Object(self, key):
+        self.hedged.append(key)
+        return FakeBodyObject(key, self.contents[key])
+
+
 if '__main__' == __name__:
     unittest.main()
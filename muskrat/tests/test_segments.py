@@ -0,0 +1,66 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for segment objects and reading across compacted and live
+" ranges of a routing key.
+"
+"""
+from __future__ import absolute_import
+import unittest
+
+from .. import segments
+from .fakes import FakeBucket, PREFIX, message_key
+
+
+class TestSegmentFormat( unittest.TestCase ):
+
+    def test_roundtrip(self):
+        """ Segments decode to the entries they were encoded from """
+        entries = [(message_key( 1 ), b'first'), (message_key( 2 ), b''), (message_key( 3 ), b'third\nline')]
+        self.assertEqual( segments.decode_segment( segments.encode_segment( entries ) ), entries )
+
+    def test_segment_name(self):
+        """ Segments are named after their last key under the segments prefix """
+        self.assertEqual( segments.segment_key_name( PREFIX, message_key( 3 ) ),
+                          '%s/segments/2013-02-21T00:00:03.000000' % PREFIX )
+
+
+class TestSegmentedCollection( unittest.TestCase ):
+
+    def setUp(self):
+        self.bucket = FakeBucket()
+        compacted = [(message_key( x ), ( 'compacted %d' % x ).encode( 'utf-8' )) for x in range( 1, 5 )]
+        self.bucket.put( segments.segment_key_name( PREFIX, compacted[1][0] ), segments.encode_segment( compacted[:2] ) )
+        self.bucket.put( segments.segment_key_name( PREFIX, compacted[3][0] ), segments.encode_segment( compacted[2:] ) )
+        for x in range( 5, 7 ):
+            self.bucket.put( message_key( x ), ( 'live %d' % x ).encode( 'utf-8' ) )
+
+    def read(self, collection):
+        return [obj.get()['Body'].read() for obj in collection]
+
+    def test_all(self):
+        """ Compacted messages are read before live messages, in order """
+        collection = segments.SegmentedCollection( self.bucket, PREFIX ).filter( Delimiter='/' )
+        self.assertEqual( self.read( collection ), 
+                          [b'compacted 1', b'compacted 2', b'compacted 3', b'compacted 4', b'live 5', b'live 6'] )
+
+    def test_marker_in_segment(self):
+        """ A marker inside a segment resumes from the next compacted message """
+        collection = segments.SegmentedCollection( self.bucket, PREFIX ).filter( Marker=message_key( 3 ) )
+        self.assertEqual( self.read( collection ), [b'compacted 4', b'live 5', b'live 6'] )
+
+    def test_marker_in_live_range(self):
+        """ A marker in the live range skips every segment """
+        collection = segments.SegmentedCollection( self.bucket, PREFIX ).filter( Marker=message_key( 5 ) )
+        self.assertEqual( self.read( collection ), [b'live 6'] )
+
+    def test_cutoff(self):
+        """ Markers past the cutoff do not list segments """
+        collection = segments.SegmentedCollection( self.bucket, PREFIX, cutoff='2013-02-21T00:00:00' )
+        collection = collection.filter( Marker=message_key( 1 ) )
+        self.assertEqual( self.read( collection ), [b'live 5', b'live 6'] )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the serializer registry.
+"
+"""
+from __future__ import absolute_import
+import unittest
+from datetime import datetime
+
+from .. import serializers
+
+
+class TestSerializerRegistry( unittest.TestCase ):
+
+    def test_default_json(self):
+        """ The json serializer is always registered """
+        s = serializers.get_serializer( 'json' )
+        self.assertIsInstance( s, serializers.JSONSerializer )
+
+    def test_fastjson(self):
+        """ fastjson resolves to an installed JSON backend """
+        s = serializers.get_serializer( 'fastjson' )
+        self.assertIn( s.name, serializers.FAST_JSON_BACKENDS )
+
+    def test_unknown(self):
+        """ Unknown serializers raise ValueError """
+        with self.assertRaises( ValueError ):
+            serializers.get_serializer( 'not-a-serializer' )
+
+    def test_instance_passthrough(self):
+        """ Serializer instances are returned unchanged """
+        s = serializers.JSONSerializer()
+        self.assertIs( serializers.get_serializer( s ), s )
+
+
+class TestSerializers( unittest.TestCase ):
+
+    def setUp(self):
+        self.timeformat = '%Y-%m-%dT%H:%M:%S'
+        self.obj = {'Testing':'yes', 'date':datetime( 2013, 2, 21, 12, 30, 5 ), 'count':3 }
+        self.expected = {'Testing':'yes', 'date':'2013-02-21T12:30:05', 'count':3 }
+
+    def test_roundtrip(self):
+        """ Every registered serializer round trips objects and formats datetimes """
+        for name in serializers.SERIALIZERS:
+            s = serializers.get_serializer( name, timeformat=self.timeformat )
+            self.assertEqual( s.loads( s.dumps( self.obj ) ), self.expected, '%s did not round trip' % name )
+
+    def test_bulk(self):
+        """ Bulk dumps/loads match single message encoding """
+        s = serializers.get_serializer( 'json', timeformat=self.timeformat )
+        objs = [self.obj, {'other':1}]
+        encoded = s.dumps_many( objs )
+        self.assertEqual( encoded, [s.dumps( obj ) for obj in objs] )
+        self.assertEqual( s.loads_many( encoded ), [self.expected, {'other':1}] )
+
+
+if '__main__' == __name__:
+    unittest.main()
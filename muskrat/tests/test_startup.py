@@ -0,0 +1,95 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Startup benchmarks.  Guards against regressions in import time (broker
+" libraries must only be imported on first use) and config loading (config
+" files are executed once per process).
+"
+"""
+from __future__ import absolute_import
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from .. import util
+
+CONFIG_TEMPLATE = '''
+class Config(object):
+    s3_timestamp_format = '%%Y-%%m-%%dT%%H:%%M:%%S.%%f'
+    s3_bucket           = '%s'
+
+CONFIG = Config
+'''
+
+def imported_modules( module ):
+    """ Returns the top level modules loaded by importing module in a fresh interpreter """
+    code = 'import sys, %s; print(" ".join(sorted(set(m.split(".")[0] for m in sys.modules))))' % module
+    root = os.path.dirname( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+    output = subprocess.check_output( [sys.executable, '-c', code], cwd=root )
+    return output.decode( 'utf-8' ).split()
+
+
+class TestLazyImports( unittest.TestCase ):
+
+    def test_producer_imports(self):
+        """ Importing the producers does not import broker libraries """
+        modules = imported_modules( 'muskrat.producer' )
+        for broker in ('pika', 'boto', 'boto3'):
+            self.assertNotIn( broker, modules, '%s imported at module load' % broker )
+
+    def test_s3consumer_imports(self):
+        """ Importing the S3 consumer does not import boto3 """
+        self.assertNotIn( 'boto3', imported_modules( 'muskrat.s3consumer' ), 'boto3 imported at module load' )
+
+
+class TestConfigCache( unittest.TestCase ):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp( suffix='.py' )
+        os.close( fd )
+        self._write( 'first' )
+        util.invalidate_config_cache()
+
+    def tearDown(self):
+        util.invalidate_config_cache()
+        os.remove( self.path )
+
+    def _write(self, bucket, mtime=None):
+        with open( self.path, 'w' ) as f:
+            f.write( CONFIG_TEMPLATE % bucket )
+        if mtime is not None:
+            os.utime( self.path, (mtime, mtime) )
+
+    def test_cached(self):
+        """ Unchanged config files are only executed once """
+        first = util.config_loader( self.path )
+        self.assertIs( util.config_loader( self.path ), first, 'Config file was re-executed' )
+        self.assertIsNot( util.config_loader( self.path, cache=False ), first, 'Uncached load returned cached config' )
+
+    def test_mtime_change(self):
+        """ Modified config files are reloaded """
+        mtime = os.stat( self.path ).st_mtime
+        util.config_loader( self.path )
+        self._write( 'second', mtime=mtime + 10 )
+        self.assertEqual( util.config_loader( self.path ).s3_bucket, 'second', 'Modified config not reloaded' )
+
+    def test_invalidate(self):
+        """ Invalidating the cache forces a reload """
+        first = util.config_loader( self.path )
+        util.invalidate_config_cache( self.path )
+        self.assertIsNot( util.config_loader( self.path ), first, 'Invalidated config was not reloaded' )
+
+    def test_cached_load_speed(self):
+        """ Cached loads are much faster than executing the config file """
+        util.config_loader( self.path )
+        cached = min( timeit.repeat( lambda: util.config_loader( self.path ), number=200, repeat=3 ) )
+        uncached = min( timeit.repeat( lambda: util.config_loader( self.path, cache=False ), number=200, repeat=3 ) )
+        self.assertLess( cached * 5, uncached, 'Cached config load is not faster than uncached' )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for stateful consumers and their snapshots.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from   collections import Counter
+
+from .. import state
+from ..s3consumer import load_cursors
+from .fakes import FakeBucket, message_key
+
+
+class PutBucket( FakeBucket ):
+    def put_object(self, Key, Body):
+        self.put( Key, Body )
+
+
+class FakeStatefulConsumer( state.S3StatefulConsumer ):
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+def count_digits(counts, body):
+    counts[ int( body ) % 2 ] += 1
+
+
+class TestS3StatefulConsumer( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        self.bucket = PutBucket()
+        for x in range( 10 ):
+            self.bucket.put( message_key( x ), ( '%d' % x ).encode( 'utf-8' ) )
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def consumer(self, func=None, **kwargs):
+        def counted(counts, body):
+            self.calls.append( body )
+            return ( func or count_digits )( counts, body )
+
+        FakeStatefulConsumer.fake_bucket = self.bucket
+        return FakeStatefulConsumer( 'Muskrat.Test.Segments', counted, state=Counter, name='stateful',
+                                     config=self.config, **kwargs )
+
+    def test_snapshot_roundtrip(self):
+        """ Snapshots carry the cursor and the state """
+        data = state.encode_snapshot( message_key( 3 ), {'a':1} )
+        self.assertEqual( state.decode_snapshot( data ), (message_key( 3 ), {'a':1}) )
+
+    def test_resume_from_snapshot(self):
+        """ A restarted consumer restores its state and resumes at the snapshot position """
+        c = self.consumer( snapshot_interval=4 )
+        c.consume( max_messages=6 )
+        self.assertEqual( c.snapshots, 1 )
+
+        #Crash: the cursor moved past the snapshot but the state since was lost
+        restarted = self.consumer()
+        self.assertEqual( restarted.state, Counter( {0:2, 1:2} ) )
+        restarted.consume()
+        restarted.close()
+        self.assertEqual( restarted.state, Counter( {0:5, 1:5} ) )
+        self.assertEqual( len( self.calls ), 6 + 6 )
+
+        again = self.consumer()
+        self.assertEqual( again.state, Counter( {0:5, 1:5} ) )
+        self.assertEqual( again.consume(), 0 )
+
+    def test_no_snapshot_replays(self):
+        """ A cursor without a snapshot cannot rebuild the state, so the key is replayed """
+        with open( os.path.join( self.cursor_dir, 'stateful' ), 'w' ) as f:
+            f.write( message_key( 5 ) )
+        c = self.consumer()
+        self.assertEqual( c.consume(), 10 )
+
+    def test_immutable_state(self):
+        """ Returned values replace the state """
+        c = self.consumer( func=lambda total, body: ( total or 0 ) + int( body ) )
+        c.state = 0
+        c.consume()
+        self.assertEqual( c.state, 45 )
+
+    def test_failed_callback(self):
+        """ No snapshot is written once a callback failed """
+        def fail_fifth(counts, body):
+            if body == b'5':
+                raise ValueError( 'failed' )
+            count_digits( counts, body )
+
+        c = self.consumer( func=fail_fifth, snapshot_interval=100 )
+        with self.assertRaises( ValueError ):
+            c.consume()
+        c.close()
+        self.assertEqual( c.snapshots, 0 )
+        self.assertEqual( self.consumer().state, Counter() )
+
+    def test_s3_store(self):
+        """ Snapshots can be kept in the bucket """
+        c = self.consumer( store='s3' )
+        c.consume()
+        c.close()
+        self.assertIn( 'STATE/stateful', self.bucket.contents )
+        self.assertEqual( self.consumer( store='s3' ).state, Counter( {0:5, 1:5} ) )
+
+    def test_file_store_location(self):
+        """ Snapshots go to the s3_state location, which is created on the first snapshot """
+        location = os.path.join( self.cursor_dir, 'state' )
+        self.config['s3_state'] = {'type':'file', 'location':location}
+        c = self.consumer()
+        c.consume()
+        c.close()
+        self.assertTrue( os.path.exists( os.path.join( location, 'stateful' + state.STATE_SUFFIX ) ) )
+        self.assertEqual( self.consumer().state, Counter( {0:5, 1:5} ) )
+
+    def test_cursors_skip_state(self):
+        """ Snapshots next to the cursors are not read as cursors """
+        c = self.consumer()
+        c.consume()
+        c.close()
+        self.assertEqual( load_cursors( self.cursor_dir ), {'stateful':[message_key( 9 )]} )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the key layout helpers in muskrat.util.
+"
+"""
+from __future__ import absolute_import
+import unittest
+
+from .. import util
+
+TIMESTAMP = '2013-02-21T12:30:05.000001'
+
+
+class TestKeyLayout( unittest.TestCase ):
+
+    def test_shard_prefixes(self):
+        """ Shard prefixes are numbered sub-prefixes of the routing key """
+        self.assertEqual( util.shard_prefixes( 'CHATSERVER/GENERAL', 2 ),
+                          ['CHATSERVER/GENERAL/shard000', 'CHATSERVER/GENERAL/shard001'] )
+
+    def test_choose_shard(self):
+        """ Shards are chosen deterministically and within range """
+        shards = [util.choose_shard( 'value %d' % x, 8 ) for x in range( 100 )]
+        self.assertTrue( all( 0 <= shard < 8 for shard in shards ) )
+        self.assertEqual( util.choose_shard( 'tenant', 8 ), util.choose_shard( 'tenant', 8 ) )
+
+    def test_key_parts(self):
+        """ Keys split into prefix and timestamp """
+        key = 'CHATSERVER/GENERAL/shard001/' + TIMESTAMP
+        self.assertEqual( util.key_prefix( key ), 'CHATSERVER/GENERAL/shard001' )
+        self.assertEqual( util.key_timestamp( key ), TIMESTAMP )
+
+
+class TestAttributes( unittest.TestCase ):
+
+    def test_roundtrip(self):
+        """ Attributes survive encoding into a key """
+        attributes = {'type':'signup', 'tenant':42, 'note':'a,b=c/d@e'}
+        key = 'CHATSERVER/GENERAL/' + TIMESTAMP + util.encode_attributes( attributes )
+        self.assertEqual( util.key_attributes( key ), {'type':'signup', 'tenant':'42', 'note':'a,b=c/d@e'} )
+        self.assertEqual( util.key_timestamp( key ), TIMESTAMP )
+        self.assertEqual( util.key_prefix( key ), 'CHATSERVER/GENERAL' )
+
+    def test_no_attributes(self):
+        """ Keys without attributes are unchanged and have none """
+        self.assertEqual( util.encode_attributes( None ), '' )
+        self.assertEqual( util.key_attributes( 'CHATSERVER/GENERAL/' + TIMESTAMP ), {} )
+
+    def test_ordering(self):
+        """ Attributes do not change the timestamp order of keys """
+        keys = ['A/2013-02-21T12:30:05.000002', 'A/2013-02-21T12:30:05.000001' + util.encode_attributes( {'z':'z'} )]
+        self.assertEqual( sorted( keys ), keys[::-1] )
+
+    def test_length_limit(self):
+        """ Oversized attributes are rejected """
+        with self.assertRaises( ValueError ):
+            util.encode_attributes( {'big':'x' * util.MAX_ATTRIBUTES_LENGTH} )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,147 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Unit tests for the windowed aggregation consumer.
+"
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from   datetime import datetime
+
+from .. import window
+from ..s3consumer import load_cursors
+from .fakes import FakeBucket, message_key
+
+
+class FakeWindowConsumer( window.S3WindowConsumer ):
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+def add(total, body):
+    return total + int( body )
+
+
+class TestS3WindowConsumer( unittest.TestCase ):
+
+    def setUp(self):
+        self.cursor_dir = tempfile.mkdtemp()
+        self.config = {
+            's3_timestamp_format':'%Y-%m-%dT%H:%M:%S.%f',
+            's3_cursor':{'type':'file', 'location':self.cursor_dir},
+        }
+        self.bucket = FakeBucket()
+        for x in range( 25 ):
+            self.bucket.put( message_key( x ), ( '%d' % x ).encode( 'utf-8' ) )
+        self.emitted = []
+
+    def tearDown(self):
+        shutil.rmtree( self.cursor_dir )
+
+    def consumer(self, **kwargs):
+        kwargs.setdefault( 'size', 10 )
+        def emit(start, end, value):
+            self.emitted.append( (start.second, end.second, value) )
+
+        c = FakeWindowConsumer( 'Muskrat.Test.Segments', emit, add, initial=int, name='window', config=self.config,
+                                **kwargs )
+        c.fake_bucket = self.bucket
+        return c
+
+    def cursor_position(self):
+        with open( os.path.join( self.cursor_dir, 'window' ) ) as f:
+            return f.read()
+
+    def test_window_starts(self):
+        """ Messages fall in every hopping window that covers their timestamp """
+        c = self.consumer( size=10, slide=5 )
+        starts = c.window_starts( datetime( 2013, 2, 21, 0, 0, 12 ) )
+        self.assertEqual( [start.second for start in starts], [5, 10] )
+
+    def test_tumbling(self):
+        """ Windows are emitted once a newer message passes their end """
+        c = self.consumer()
+        self.assertEqual( c.consume(), 25 )
+        self.assertEqual( self.emitted, [(0, 10, sum( range( 10 ) )), (10, 20, sum( range( 10, 20 ) ))] )
+        self.assertEqual( c.metrics()['windows']['open'], 1 )
+
+    def test_hopping(self):
+        """ Every message is folded into size / slide windows """
+        c = self.consumer( size=10, slide=5 )
+        c.consume()
+        self.assertEqual( [(start, end) for start, end, value in self.emitted], [(55, 5), (0, 10), (5, 15), (10, 20)] )
+        self.assertEqual( self.emitted[2][2], sum( range( 5, 15 ) ) )
+
+    def test_cursor_at_window_boundary(self):
+        """ The cursor rests before the oldest open window and a restart emits each window once """
+        c = self.consumer()
+        c.consume()
+        self.assertEqual( self.cursor_position(), message_key( 19 ) )
+
+        for x in range( 25, 31 ):
+            self.bucket.put( message_key( x ), ( '%d' % x ).encode( 'utf-8' ) )
+        restarted = self.consumer()
+        restarted.consume()
+        self.assertEqual( self.emitted[2:], [(20, 30, sum( range( 20, 30 ) ))] )
+        self.assertEqual( self.cursor_position(), message_key( 29 ) )
+
+    def test_hopping_restart(self):
+        """ Hopping windows emitted before a restart are not emitted again """
+        self.bucket = FakeBucket()
+        for x in ( 5, 25, 45, 50, 59 ):
+            self.bucket.put( message_key( x ), ( '%d' % x ).encode( 'utf-8' ) )
+
+        c = self.consumer( size=20, slide=10 )
+        c.consume()
+        emitted = list( self.emitted )
+        self.assertIn( (30, 50, 45), emitted )
+        self.assertEqual( self.cursor_position(), message_key( 25 ) )
+
+        restarted = self.consumer( size=20, slide=10 )
+        restarted.consume()
+        restarted.flush()
+        self.assertEqual( self.emitted[:len( emitted )], emitted )
+        #Only the windows still open before the restart are emitted after it
+        self.assertEqual( self.emitted[len( emitted ):], [(40, 0, 45 + 50 + 59), (50, 10, 50 + 59)] )
+        self.assertEqual( load_cursors( self.cursor_dir ), {'window':[message_key( 59 )]} )
+
+    def test_resume_max_messages(self):
+        """ Consuming in small runs gives the same windows """
+        c = self.consumer()
+        while c.consume( max_messages=3 ):
+            pass
+        self.assertEqual( [value for start, end, value in self.emitted], [45, 145] )
+
+    def test_delay_closes_idle_windows(self):
+        """ Caught up consumers close windows by the clock and drop late messages """
+        c = self.consumer( delay=0 )
+        c.consume()
+        self.assertEqual( len( self.emitted ), 3 )
+        self.assertEqual( self.cursor_position(), message_key( 24 ) )
+
+        self.bucket.put( message_key( 24 )[ :-1 ] + '1', b'100' )
+        c.consume()
+        self.assertEqual( len( self.emitted ), 3 )
+        self.assertEqual( c.metrics()['windows']['late'], 1 )
+
+    def test_flush(self):
+        """ flush emits incomplete windows """
+        c = self.consumer()
+        c.consume()
+        c.flush()
+        self.assertEqual( self.emitted[-1], (20, 30, sum( range( 20, 25 ) )) )
+        self.assertEqual( self.cursor_position(), message_key( 24 ) )
+
+    def test_rejects_workers(self):
+        """ Folds run in key order, so concurrent callbacks are refused """
+        with self.assertRaises( ValueError ):
+            self.consumer( workers=4 )
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -9,8 +9,46 @@
 from __future__ import absolute_import
 import imp
 import os
+import threading
+import zlib
 
-def config_loader( config ):
+from six.moves.urllib.parse import quote, unquote
+
+#Sub-prefix format for sharded routing keys.  Routing keys are upper cased so
+#lower case shard names can never collide with a routing key level.
+SHARD_FORMAT = 'shard%03d'
+
+#Message attributes are appended to the timestamp of a key, ala:
+#   FRONTEND/CUSTOMER/SIGNUP/2013-01-18T12:23:13.894895@tenant=42,type=signup
+ATTRIBUTE_SEPARATOR = '@'
+MAX_ATTRIBUTES_LENGTH = 512
+
+#Process wide cache of loaded config files, keyed by path -> (mtime, CONFIG)
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+def invalidate_config_cache( path=None ):
+    """
+    Drops cached config files so the next load re-reads them.
+
+    path
+        Only drop this config file.  Resolved the same way config_loader resolves it.
+        Defaults to dropping every cached config.
+    """
+    with _config_cache_lock:
+        if path is None:
+            _config_cache.clear()
+        else:
+            _config_cache.pop( _resolve_config_path( path ), None )
+
+def _resolve_config_path( config ):
+    #Non-path filenames need to be resolved to point to the same directory as this file
+    #as per our default config loading structure
+    if os.path.basename( config ) == config:
+        config = os.path.join( os.path.dirname( __file__ ), config )
+    return os.path.abspath( config )
+
+def config_loader( config, cache=True ):
     """
     Loads the configuration from an either and external python file, python object, or dict.
 
@@ -18,13 +56,24 @@ def config_loader( config ):
         A config of 3 possible types; python filepath, python object, or dict
         If the config parameter is a python file and is not an absolute path then the
         the load is attempted from this file's directory.
+    cache
+        Python config files are only executed once per process and modification time.
+        Every producer/consumer loading the same unchanged file shares the same CONFIG
+        object.  Pass False to force a fresh load.
     """
-    #Non-path filenames need to be resolved to point to the same directory as this file
-    #as per our default config loading structure
-
     if isinstance( config, str ) and config.endswith( '.py' ):
-        if os.path.basename( config ) == config:
-            config = os.path.join( os.path.dirname( __file__ ), config )
+        config = _resolve_config_path( config )
+
+        try:
+            mtime = os.stat( config ).st_mtime
+        except OSError:
+            #Let the load below raise the descriptive error
+            mtime = None
+
+        if cache and mtime is not None:
+            cached = _config_cache.get( config )
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
 
         #Load config as a new module and place in this module's global scope
         d = imp.new_module('config')
@@ -36,6 +85,9 @@ def config_loader( config ):
             e.strerror = 'Unable to load configuration file (%s)' % e.strerror
             raise
         
+        with _config_cache_lock:
+            _config_cache[ config ] = (mtime, d.CONFIG)
+
         return d.CONFIG
 
     elif isinstance( config, dict ):
@@ -49,3 +101,104 @@ def config_loader( config ):
         raise TypeError('Config type not recognized')
 
 
+def shard_prefixes( prefix, shards ):
+    """
+    Returns the key prefixes of every shard for a routing key prefix.
+    """
+    return ['/'.join( [prefix, SHARD_FORMAT % shard] ) for shard in range( shards )]
+
+def choose_shard( value, shards ):
+    """
+    Hashes value (a string) onto one of shards shards.
+    """
+    if not isinstance( value, bytes ):
+        value = value.encode( 'utf-8' )
+    return ( zlib.crc32( value ) & 0xffffffff ) % shards
+
+def key_prefix( key ):
+    """ Returns the prefix (routing key directory, including any shard) of a message key. """
+    return key.rsplit( '/', 1 )[0]
+
+def key_timestamp( key ):
+    """ Returns the timestamp portion of a message key. """
+    return key.rsplit( '/', 1 )[-1].split( ATTRIBUTE_SEPARATOR, 1 )[0]
+
+def encode_attributes( attributes ):
+    """
+    Encodes a dict of message attributes into a key suffix.  Attributes are meant to be small
+    (type, tenant, priority); the encoded suffix is limited to MAX_ATTRIBUTES_LENGTH characters.
+    """
+    if not attributes:
+        return ''
+    encoded = ','.join( '%s=%s' % (quote( str( name ), safe='' ), quote( str( value ), safe='' ))
+                        for name, value in sorted( attributes.items() ) )
+    if len( encoded ) > MAX_ATTRIBUTES_LENGTH:
+        raise ValueError( 'Encoded message attributes exceed %d characters' % MAX_ATTRIBUTES_LENGTH )
+    return ATTRIBUTE_SEPARATOR + encoded
+
+def key_attributes( key ):
+    """ Returns the dict of attributes encoded in a message key.  Values are strings. """
+    parts = key.rsplit( '/', 1 )[-1].split( ATTRIBUTE_SEPARATOR, 1 )
+    if len( parts ) == 1 or not parts[1]:
+        return {}
+    return dict( (unquote( name ), unquote( value ))
+                 for name, value in (item.split( '=', 1 ) for item in parts[1].split( ',' )) )
+
+def s3_resource( config ):
+    """ Creates a boto3 S3 resource from the config's credentials. """
+    import boto3
+    return boto3.resource(
+        's3',
+        aws_access_key_id=config.s3_key,
+        aws_secret_access_key=config.s3_secret,
+    )
+
+def chunked( iterable, size ):
+    """ Yields lists of up to size items from iterable. """
+    chunk = []
+    for item in iterable:
+        chunk.append( item )
+        if len( chunk ) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def delete_keys( bucket, keys, batch_size=1000, workers=4, progress=None ):
+    """
+    Deletes keys from a boto3 bucket with DeleteObjects requests of up to batch_size keys,
+    issuing up to workers requests concurrently.  Returns the number of keys deleted.
+
+    progress
+        Optional callable issued with the running total of deleted keys after each batch.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    #Clients are thread safe, resources are not
+    client = bucket.meta.client
+
+    def delete( batch ):
+        response = client.delete_objects( 
+            Bucket=bucket.name,
+            Delete={'Objects':[{'Key':key} for key in batch], 'Quiet':True} )
+        return len( batch ) - len( response.get( 'Errors', [] ) )
+
+    deleted = 0
+    pending = set()
+    with ThreadPoolExecutor( max_workers=workers ) as pool:
+        #Bound the batches in flight so huge listings are not held in memory
+        for batch in chunked( keys, batch_size ):
+            pending.add( pool.submit( delete, batch ) )
+            if len( pending ) >= workers * 2:
+                done, pending = wait( pending, return_when=FIRST_COMPLETED )
+                for future in done:
+                    deleted += future.result()
+                    if progress:
+                        progress( deleted )
+
+        for future in pending:
+            deleted += future.result()
+            if progress:
+                progress( deleted )
+
+    return deleted
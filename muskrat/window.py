@@ -0,0 +1,239 @@
+"""
+" Copyright:    Loggly
+" Author:       Scott Griffin
+"
+" Windowed aggregation over an S3 routing key.  Messages are assigned to
+" tumbling or hopping windows by the timestamp in their key name, so window
+" contents do not depend on when consume() happens to run.  Each window keeps
+" a running aggregate built with a fold function and is emitted once the
+" watermark (the newest timestamp read, or the clock less a delay once the
+" consumer is caught up) passes its end.
+"
+" The cursor is only moved at window boundaries: it is kept on the key
+" preceding the first message of the oldest open window, so after a restart
+" the open windows are rebuilt from S3.  The end of the last emitted window
+" is written next to the cursor before it moves, and windows ending by then
+" are not rebuilt, so every window is emitted once.
+"
+"""
+from __future__ import absolute_import
+from   itertools import islice
+from   datetime import datetime, timedelta
+
+try: import simplejson as json
+except ImportError: import json
+
+from   muskrat.s3consumer import S3Consumer
+from   muskrat.state import FileStateStore
+from   muskrat.util import key_timestamp
+
+EPOCH = datetime( 1970, 1, 1 )
+WINDOW_SUFFIX = '.window'
+
+
+def _micros( timestamp ):
+    delta = timestamp - EPOCH
+    return ( delta.days * 86400 + delta.seconds ) * 1000000 + delta.microseconds
+
+
+class Window(object):
+    """ An open window and its running aggregate. """
+    def __init__( self, start, end, value, resume ):
+        self.start = start
+        self.end = end
+        self.value = value
+        #Cursor position to re-read this window from after a restart
+        self.resume = resume
+        self.count = 0
+
+
+class S3WindowConsumer( S3Consumer ):
+
+    def __init__( self, routing_key, func, fold, initial=None, size=60, slide=None, delay=None, **kwargs ):
+        """
+        Takes the S3Consumer options (except shards, workers and dedupe) and:
+
+        func
+            Callback issued with (start, end, value) for every window once it closes.  start
+            and end are datetimes; end is exclusive.
+        fold
+            Function issued with (value, message) for every message of a window, returning the
+            new value.  Messages are decoded with the serializer, if any.
+        initial
+            Callable returning the value of a new window.  Defaults to None.
+        size
+            Window length in seconds.
+        slide
+            Seconds between window starts.  Defaults to size (tumbling windows); less than size
+            gives hopping windows, which every message is folded into size / slide of.
+        delay
+            Once caught up, move the watermark to the current time less delay seconds, so
+            windows close without waiting for a newer message.  Messages arriving for closed
+            windows are dropped and counted as late.  Defaults to closing windows on newer
+            messages only.
+        """
+        for option in ( 'shards', 'workers', 'dedupe' ):
+            if kwargs.get( option ):
+                raise ValueError( 'S3WindowConsumer does not support %s' % option )
+
+        super( S3WindowConsumer, self ).__init__( routing_key, func, **kwargs )
+        if self.shards:
+            raise ValueError( 'S3WindowConsumer does not support sharded routing keys' )
+
+        self.fold = fold
+        self.initial = initial
+        self.size = timedelta( seconds=size )
+        self.slide = timedelta( seconds=slide or size )
+        self.delay = delay
+        if self.size <= timedelta( 0 ) or self.slide <= timedelta( 0 ):
+            raise ValueError( 'Window size and slide must be positive' )
+
+        self.windows = {}
+        self.watermark = None
+        self.position = self._cursor.get() or None
+        self._committed = self.position
+
+        #End of the last emitted window, kept next to the cursor
+        self._boundary = FileStateStore( self._cursor.filename + WINDOW_SUFFIX )
+        self.emitted_through = self._load_boundary()
+        self._saved_through = self.emitted_through
+        #Cursors written without a boundary: every window starting at or before the
+        #cursor was emitted before the restart
+        self._horizon = self._timestamp( self.position ) if self.position else None
+
+        self.late = 0
+        self.emitted = 0
+
+    def _load_boundary( self ):
+        data = self._boundary.load()
+        if not data:
+            return None
+        return EPOCH + timedelta( microseconds=json.loads( data.decode( 'utf-8' ) )['emitted_through'] )
+
+    def _timestamp( self, key ):
+        try:
+            return datetime.strptime( key_timestamp( key ), self.config.s3_timestamp_format )
+        except ValueError:
+            return None
+
+    def window_starts( self, timestamp ):
+        """ Starts of the windows a timestamp falls in, oldest first. """
+        micros = _micros( timestamp )
+        size = _micros( EPOCH + self.size )
+        slide = _micros( EPOCH + self.slide )
+
+        start = micros - micros % slide
+        starts = []
+        while start > micros - size:
+            starts.append( EPOCH + timedelta( microseconds=start ) )
+            start -= slide
+        return starts[::-1]
+
+    def _closed( self, start ):
+        if self.emitted_through is not None:
+            #Windows are emitted in order, so every window ending by the boundary was emitted
+            if start + self.size <= self.emitted_through:
+                return True
+        elif self._horizon is not None and start <= self._horizon:
+            return True
+        return self.watermark is not None and start + self.size <= self.watermark
+
+    def _add( self, obj ):
+        """ Folds a message into its open windows. """
+        timestamp = self._timestamp( obj.key )
+        if timestamp is None or not self._matches( obj ):
+            return
+
+        starts = [start for start in self.window_starts( timestamp ) if not self._closed( start )]
+        if not starts:
+            self.late += 1
+            return
+
+        message = self._decode( self._read( obj ) )
+        for start in starts:
+            window = self.windows.get( start )
+            if window is None:
+                value = self.initial() if self.initial is not None else None
+                window = self.windows[ start ] = Window( start, start + self.size, value, self.position )
+            window.value = self.fold( window.value, message )
+            window.count += 1
+
+        if self.watermark is None or timestamp > self.watermark:
+            self.watermark = timestamp
+
+    def _emit( self, watermark=None ):
+        """ Issues the callback for every window closed by the watermark, oldest first. """
+        emitted = 0
+        for start in sorted( self.windows ):
+            window = self.windows[ start ]
+            if watermark is not None and window.end > watermark:
+                break
+            self.callback( window.start, window.end, window.value )
+            del self.windows[ start ]
+            if self.emitted_through is None or window.end > self.emitted_through:
+                self.emitted_through = window.end
+            self.emitted += 1
+            emitted += 1
+        if emitted:
+            self._commit()
+        return emitted
+
+    def _commit( self ):
+        """
+        Records the end of the last emitted window, then moves the cursor to the resume point
+        of the oldest open window.  A crash in between only rereads messages.
+        """
+        if self.emitted_through != self._saved_through:
+            self._boundary.save( json.dumps( {'emitted_through':_micros( self.emitted_through )} ).encode( 'utf-8' ) )
+            self._saved_through = self.emitted_through
+
+        if self.windows:
+            position = self.windows[ min( self.windows ) ].resume
+        else:
+            position = self.position
+        if position and position != self._committed:
+            self._cursor.update( position )
+            self._committed = position
+
+    def consume( self, max_messages=None ):
+        """
+        Folds the messages after the last one read into their windows and emits the windows
+        that closed.  Returns the number of messages read.
+        """
+        collection = self._get_msg_iterator()
+        if self.position:
+            collection = collection.filter( Marker=self.position )
+
+        handled = 0
+        for obj in islice( collection.filter( Delimiter='/' ), max_messages ):
+            self._add( obj )
+            self.position = obj.key
+            handled += 1
+            if self.windows and self.watermark is not None and min( self.windows ) + self.size <= self.watermark:
+                self._emit( self.watermark )
+
+        if self.delay is not None and ( max_messages is None or handled < max_messages ):
+            #Caught up, so only messages still in flight can land behind the clock
+            clock = datetime.today() - timedelta( seconds=self.delay )
+            if self.watermark is None or clock > self.watermark:
+                self.watermark = clock
+            self._emit( self.watermark )
+
+        self._commit()
+        return handled
+
+    def flush( self ):
+        """ Emits every open window, complete or not, and moves the cursor to the last message read. """
+        self._emit()
+        self._commit()
+
+    def metrics( self ):
+        stats = super( S3WindowConsumer, self ).metrics()
+        stats['windows'] = {
+            'open':len( self.windows ),
+            'emitted':self.emitted,
+            'late':self.late,
+            'emitted_through':self.emitted_through.isoformat() if self.emitted_through is not None else None,
+            'watermark':self.watermark.isoformat() if self.watermark is not None else None,
+        }
+        return stats
@@ -14,5 +14,14 @@ setup(
     version=__version__,
     packages=['muskrat', 'muskrat.tests'],
     long_description=open( 'README.md' ).read(),
-    install_requires=open( 'requirements.txt' ).read().split()
+    install_requires=open( 'requirements.txt' ).read().split(),
+    entry_points={
+        'console_scripts':[
+            'muskrat-compact = muskrat.compaction:main',
+            'muskrat-retention = muskrat.retention:main',
+            'muskrat-redrive = muskrat.deadletter:main',
+            'muskrat-backlog = muskrat.backlog:main',
+            'muskrat-archive = muskrat.archiver:main',
+        ],
+    },
     )